@@ -170,6 +170,10 @@ cp -a etc/pki/* %{buildroot}%{_sysconfdir}/pki/mock/
 
 install -d %{buildroot}%{python_sitelib}/
 cp -a py/mockbuild %{buildroot}%{python_sitelib}/
+%if %{use_python2}
+# asyncio API is python 3 only
+rm %{buildroot}%{python_sitelib}/mockbuild/aio.py
+%endif
 
 install -d %{buildroot}%{_mandir}/man1
 cp -a docs/mockchain.1 docs/mock.1 %{buildroot}%{_mandir}/man1/
@@ -39,6 +39,7 @@ usage:
 """
 
 # library imports
+import atexit
 import errno
 import glob
 import grp
@@ -76,17 +77,29 @@ log = logging.getLogger()
 
 # our imports
 # pylint: disable=wrong-import-position
+# imports are only timed from here, as soon as possible
+import mockbuild.startup
+if '--profile-startup' in sys.argv[1:]:
+    mockbuild.startup.enable()
+# functions get trace wrappers at import time, long before options are parsed
+import mockbuild.trace_decorator
+mockbuild.trace_decorator.set_tracing('--trace' in sys.argv[1:])
 from mockbuild import util
 import mockbuild.backend
 from mockbuild.backend import Commands
-from mockbuild.buildroot import Buildroot
+from mockbuild.cgroups import Accounting
+from mockbuild.buildroot import Buildroot, root_path
 import mockbuild.exception
 from mockbuild.exception import BadCmdline
+import mockbuild.hostfacts
 from mockbuild.plugin import Plugins
+import mockbuild.repo
 from mockbuild.state import State
 from mockbuild.trace_decorator import traceLog
 import mockbuild.uid
 
+mockbuild.startup.mark("imports")
+
 
 # pylint: disable=unused-argument
 def scrub_callback(option, opt, value, parser):
@@ -306,6 +319,9 @@ def command_parse():
                       dest="verbose", help="quiet build")
     parser.add_option("--trace", action="store_true", default=False,
                       dest="trace", help="Enable internal mock tracing output.")
+    parser.add_option("--profile-startup", action="store_true", default=False,
+                      dest="profile_startup",
+                      help="Print the time spent importing modules and initializing mock to stderr.")
 
     # plugins
     parser.add_option("--enable-plugin", action="append",
@@ -527,10 +543,13 @@ def do_rebuild(config_opts, commands, buildroot, srpms):
 
         if config_opts["createrepo_on_rpms"]:
             log.info("Running createrepo on binary rpms in resultdir")
+            repo = mockbuild.repo.RepoMetadata(buildroot.resultdir,
+                                               command=shlex.split(config_opts["createrepo_command"]))
+            new_pkgs = [p for p in commands.build_results if not p.endswith('.src.rpm')]
             with buildroot.uid_manager:
-                cmd = shlex.split(config_opts["createrepo_command"])
-                cmd.append(buildroot.resultdir)
-                util.do(cmd)
+                ret, _, err = repo.generate(new_pkgs=new_pkgs)
+            if ret:
+                raise mockbuild.exception.Error("createrepo failed: %s" % err.strip())
 
     rebuild_generic(srpms, commands, buildroot, config_opts, cmd=build,
                     post=post_build, clean=clean)
@@ -620,6 +639,22 @@ def unshare_namespace(config_opts):
                 sys.exit(e.resultcode)
 
 
+@traceLog()
+def remove_accounting(accounting, uidManager):
+    uidManager.becomeUser(0, 0)
+    try:
+        accounting.remove()
+    finally:
+        uidManager.restorePrivs()
+
+
+@traceLog()
+def write_timeline(state, uidManager, resultdir):
+    """write the timing of the phases as the unprivileged user, like the logs"""
+    with uidManager:
+        state.timeline.write(resultdir)
+
+
 @traceLog()
 def main():
     "Main executable entry point."
@@ -644,6 +679,7 @@ def main():
         uidManager.dropPrivsTemp()
 
     (options, args) = command_parse()
+    mockbuild.startup.mark("parse command line")
 
     if options.printrootpath or options.list_snapshots:
         options.verbose = 0
@@ -658,6 +694,10 @@ def main():
     # cmdline options override config options
     util.set_config_opts_per_cmdline(config_opts, options, args)
 
+    # probe host facts only once, not in every mock process
+    mockbuild.hostfacts.setup(config_opts['cache_topdir'])
+    mockbuild.startup.mark("load configuration")
+
     # allow a different mock group to be specified
     if config_opts['chrootgid'] != mockgid:
         uidManager.restorePrivs()
@@ -669,6 +709,7 @@ def main():
 
     # configure logging
     setup_logging(config_path, config_opts, options)
+    mockbuild.startup.mark("set up logging")
 
     # verify that we're not trying to build an arch that we can't
     check_arch_combination(config_opts['rpmbuild_arch'], config_opts)
@@ -684,6 +725,15 @@ def main():
     py_version = '{0}.{1}.{2}'.format(*sys.version_info[:3])
     log.info("mock.py version %s starting (python version = %s)...",
              __VERSION__, py_version)
+
+    # read-only commands, without buildroots, package managers and plugins
+    if options.printrootpath:
+        print(os.path.join(root_path(config_opts), ''))
+        sys.exit(0)
+    if options.mode == 'debugconfig':
+        do_debugconfig(config_opts)
+        sys.exit(0)
+
     state = State()
     plugins = Plugins(config_opts, state)
 
@@ -706,7 +756,7 @@ def main():
         bootstrap_buildroot_config['yum_command'] = bootstrap_buildroot_config['system_yum_command']
         bootstrap_buildroot_config['dnf_command'] = bootstrap_buildroot_config['system_dnf_command']
 
-        bootstrap_buildroot_state = State(bootstrap=True)
+        bootstrap_buildroot_state = State(bootstrap=True, timeline=state.timeline)
         bootstrap_plugins = Plugins(bootstrap_buildroot_config, bootstrap_buildroot_state)
         bootstrap_buildroot = Buildroot(bootstrap_buildroot_config,
                                         uidManager, bootstrap_buildroot_state, bootstrap_plugins,
@@ -726,11 +776,20 @@ def main():
     if config_opts['use_bootstrap_container']:
         bootstrap_buildroot.config['chroot_setup_cmd'] = buildroot.pkg_manager.install_command
 
-    state.start("run")
+    if config_opts['cgroup_accounting'] and not options.list_snapshots:
+        # creating and removing the cgroup needs root
+        uidManager.becomeUser(0, 0)
+        try:
+            accounting = Accounting.create('%s-%d' % (config_opts['root'].replace('/', '_'), os.getpid()))
+        finally:
+            uidManager.restorePrivs()
+        # atexit runs this after the timing is written
+        atexit.register(remove_accounting, accounting, uidManager)
+        state.timeline.accounting = accounting
 
-    if options.printrootpath:
-        print(buildroot.make_chroot_path(''))
-        sys.exit(0)
+    mockbuild.startup.mark("construct buildroots")
+
+    state.start("run")
 
     if options.list_snapshots:
         plugins.call_hooks('list_snapshots', required=True)
@@ -738,6 +797,10 @@ def main():
             bootstrap_buildroot.plugins.call_hooks('list_snapshots', required=True)
         sys.exit(0)
 
+    # timing of the phases goes to the resultdir of builds, also when mock fails
+    if options.mode in ('rebuild', 'buildsrpm'):
+        atexit.register(write_timeline, state, uidManager, buildroot.resultdir)
+
     # dump configuration to log
     log.debug("mock final configuration:")
     for k, v in list(config_opts.items()):
@@ -851,9 +914,6 @@ def run_command(options, args, config_opts, commands, buildroot, state):
     elif options.mode == 'buildsrpm':
         do_buildsrpm(config_opts, commands, buildroot, options, args)
 
-    elif options.mode == 'debugconfig':
-        do_debugconfig(config_opts)
-
     elif options.mode == 'orphanskill':
         util.orphansKill(buildroot.make_chroot_path())
 
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""asyncio counterparts of util.do() and Buildroot.doChroot().
+
+Independent commands (host probes, repoqueries in the chroot, compression
+of several logs, ...) can be run concurrently:
+
+    from mockbuild import aio
+    cpu, mem = aio.run(aio.do(['lscpu'], returnOutput=True),
+                       aio.do(['free'], returnOutput=True))
+
+Arguments, logging, timeouts and errors are the same as with util.do(). The
+output can be streamed with the on_output(text, stderr) callback, which gets
+complete lines as they arrive. Privileges are never changed in mock's own
+process: what doChroot() does with UidManager.becomeUser() for nspawn is done
+in the child, so concurrent commands cannot see each other's uids.
+
+This module needs python 3.6, import it lazily.
+"""
+
+import asyncio
+import fcntl
+import os
+import pwd
+import signal
+import subprocess
+import sys
+import time
+
+from . import exception
+from . import util
+from .trace_decorator import getLog
+from .uid import getresgid, getresuid, setresuid
+
+READ_SIZE = 64 * 1024
+
+
+class _PrivilegedPreExec(util.ChildPreExec):
+    """become root in the child only (for nspawn), mock's own uids are left alone"""
+    def __call__(self, *args, **kargs):
+        setresuid(0, 0, 0)
+        os.setregid(0, 0)
+        super(_PrivilegedPreExec, self).__call__(*args, **kargs)
+
+
+async def _wait(watcher, timeout=None):
+    """wait for the child at most timeout seconds, return True when it exited"""
+    loop = asyncio.get_event_loop()
+    readable = loop.create_future()
+
+    def ready():
+        if not readable.done():
+            readable.set_result(None)
+    # removed before this returns, so that the fd can be waited for again
+    loop.add_reader(watcher.fileno(), ready)
+    try:
+        await asyncio.wait_for(readable, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(watcher.fileno())
+    return watcher.wait()
+
+
+async def _pump(pipe, stderr, exited, consume, printOutput=False):
+    """read pipe until EOF and pass complete lines to consume(text, stderr)
+
+    Returns False when the child exited (the exited event is set), but
+    something (orphans) kept the pipe open without writing for a second.
+    """
+    flags = fcntl.fcntl(pipe, fcntl.F_GETFL)
+    fcntl.fcntl(pipe, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    loop = asyncio.get_event_loop()
+    readable = asyncio.Event()
+    # one reader for the whole life of the pipe, it is set again and again while
+    # there is something to read
+    loop.add_reader(pipe.fileno(), readable.set)
+    tail = ''
+    try:
+        while True:
+            raw = pipe.read()
+            if raw is None:
+                readable.clear()
+                waiters = [asyncio.ensure_future(readable.wait())]
+                if not exited.is_set():
+                    waiters.append(asyncio.ensure_future(exited.wait()))
+                done, pending = await asyncio.wait(waiters, timeout=1 if exited.is_set() else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for waiter in pending:
+                    waiter.cancel()
+                if not done:
+                    return False
+                continue
+            if not raw:
+                return True
+            if printOutput:
+                sys.stdout.buffer.write(raw)
+                sys.stdout.flush()
+            text = tail + raw.decode(util.encoding, 'replace')
+            cut = text.rfind('\n')
+            if cut < 0:
+                tail = text
+                continue
+            tail = text[cut + 1:]
+            consume(text[:cut + 1], stderr)
+    finally:
+        loop.remove_reader(pipe.fileno())
+        if tail:
+            consume(tail, stderr)
+
+
+# pylint: disable=too-many-arguments,too-many-locals,unused-argument
+async def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True,
+             returnOutput=0, uid=None, gid=None, user=None, personality=None,
+             printOutput=False, env=None, nspawn_args=None, unshare_net=False,
+             output_limit=None, on_output=None, privileged=False, *_, **kargs):
+    """same as util.do() (without pty), returns the output when awaited
+
+    on_output(text, stderr) is called with each batch of complete lines
+    """
+    logger = kargs.get("logger", getLog())
+    if timeout == 0:
+        timeout = util._OPS_TIMEOUT  # pylint: disable=protected-access
+    if output_limit is None:
+        output_limit = util._OUTPUT_LIMIT  # pylint: disable=protected-access
+    start = time.time()
+    if env is None:
+        env = util.clean_env()
+    if shell and isinstance(command, list):
+        command = ['/bin/sh', '-c'] + command
+        shell = False
+    if chrootPath and util.USE_NSPAWN:
+        # pylint: disable=protected-access
+        command, unshare_net = util._nspawn_command(chrootPath, command, user=user, uid=uid, gid=gid,
+                                                    cwd=cwd, env=env, nspawn_args=nspawn_args,
+                                                    unshare_net=unshare_net)
+    preexec_class = _PrivilegedPreExec if privileged else util.ChildPreExec
+    preexec = preexec_class(personality, chrootPath, cwd, uid, gid,
+                            unshare_ipc=bool(chrootPath), unshare_net=unshare_net)
+    logger.debug("Executing command: %s with env %s and shell %s", command, env, shell)
+
+    output = util.OutputBuffer(limit=output_limit)
+    output_logger = util.OutputLogger(logger)
+
+    def consume(text, stderr):
+        output_logger.log(text, stderr=stderr)
+        if returnOutput:
+            output.write(text)
+        if on_output is not None:
+            on_output(text, stderr)
+
+    with open(os.devnull, "r") as stdin:
+        child = subprocess.Popen(command, shell=shell, env=env, bufsize=0, close_fds=True,
+                                 stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 preexec_fn=preexec)
+    watcher = util.ChildWatcher(child)
+    exited = asyncio.Event()
+
+    async def wait_exit():
+        await _wait(watcher)
+        exited.set()
+    try:
+        pumps = asyncio.gather(_pump(child.stdout, False, exited, consume, printOutput),
+                               _pump(child.stderr, True, exited, consume, printOutput))
+        try:
+            closed, _ = await asyncio.wait_for(asyncio.gather(pumps, wait_exit()),
+                                               start + timeout - time.time() if timeout else None)
+        except asyncio.TimeoutError:
+            os.killpg(child.pid, signal.SIGTERM)
+            if not await _wait(watcher, 1):
+                os.killpg(child.pid, signal.SIGKILL)
+            watcher.wait()
+            if isinstance(command, list):
+                command = ' '.join(command)
+            raise util.commandTimeoutExpired("Timeout(%s) expired for command:\n # %s\n%s"
+                                             % (timeout, command, output.getvalue()))
+        if not all(closed):
+            # the pipes stayed open and silent for a second after the child exited
+            logger.info("Child pid '%s' is dead", child.pid)
+            if chrootPath:
+                logger.info("Child dead, killing orphans")
+                util.orphansKill(chrootPath)
+        output_logger.flush()
+        result = output.getvalue()
+    except BaseException:
+        # cancelled or failed, kill the child if it isn't done
+        if child.returncode is None:
+            os.killpg(child.pid, signal.SIGKILL)
+            watcher.wait()
+        raise
+    finally:
+        watcher.close()
+        child.stdout.close()
+        child.stderr.close()
+
+    if isinstance(command, list):
+        command = ' '.join(command)
+    logger.debug("Child return code was: %s", child.returncode)
+    if raiseExc and child.returncode:
+        raise exception.Error("Command failed: \n # %s\n%s" % (command, result), child.returncode)
+    return result
+
+
+async def doChroot(buildroot, command, shell=False, nosync=False, **kargs):
+    """same as buildroot.doChroot(), returns the output when awaited"""
+    buildroot.nuke_rpm_db()
+    env = dict(buildroot.env)
+    if nosync and buildroot.nosync_path:
+        env['LD_PRELOAD'] = buildroot.nosync_path
+    if util.USE_NSPAWN:
+        if 'uid' not in kargs:
+            kargs['uid'] = getresuid()[1]
+        if 'gid' not in kargs:
+            kargs['gid'] = getresgid()[1]
+        if 'user' not in kargs:
+            kargs['user'] = pwd.getpwuid(kargs['uid'])[0]
+        kargs['privileged'] = True
+    return await do(command, chrootPath=buildroot.make_chroot_path(),
+                    env=env, shell=shell, **kargs)
+
+
+def run(*coroutines):
+    """run coroutines concurrently from blocking code, return list of their results
+
+    The first exception raised by any of them is re-raised.
+    """
+    async def gather():
+        return await asyncio.gather(*coroutines)
+    if hasattr(asyncio, 'run'):
+        return asyncio.run(gather())
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(gather())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -11,7 +11,6 @@ import os
 import shutil
 
 from mockbuild.mounts import BindMountPoint
-import rpm
 
 from . import util
 from .exception import PkgError
@@ -63,6 +62,20 @@ class Commands(object):
             nspawn_args.extend(self.config['nspawn_args'])
         return nspawn_args
 
+    @traceLog()
+    def _start_nspawn_session(self):
+        """one container for all doChroot() commands of a build, if configured"""
+        if not (util.USE_NSPAWN and self.config['nspawn_session']):
+            return None
+        session = util.NspawnSession(self.make_chroot_path(), self._get_nspawn_args(),
+                                     unshare_net=self.private_network, env=self.buildroot.env)
+        self.uid_manager.becomeUser(0, 0)
+        try:
+            session.start()
+        finally:
+            self.uid_manager.restorePrivs()
+        return session
+
     @traceLog()
     def backup_results(self):
         srcdir = os.path.join(self.buildroot.basedir, "result")
@@ -206,6 +219,7 @@ class Commands(object):
 
     @traceLog()
     def installSpecDeps(self, spec_file):
+        import rpm
         try:
             spec=rpm.spec(spec_file).sourceHeader.dsFromHeader()
             self.uid_manager.becomeUser(0, 0)
@@ -253,6 +267,7 @@ class Commands(object):
         # note: moved to do this before the user change below!
         self.buildroot.nuke_rpm_db()
         dropped_privs = False
+        session = self._start_nspawn_session()
         try:
             if not util.USE_NSPAWN:
                 self.uid_manager.becomeUser(self.buildroot.chrootuid, self.buildroot.chrootgid)
@@ -298,6 +313,12 @@ class Commands(object):
         finally:
             if dropped_privs:
                 self.uid_manager.restorePrivs()
+            if session is not None:
+                self.uid_manager.becomeUser(0, 0)
+                try:
+                    session.stop()
+                finally:
+                    self.uid_manager.restorePrivs()
             if self.state.result != 'success':
                 self.state.result = 'fail'
             # tell caching we are done building
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 # vim: noai:ts=4:sw=4:expandtab
 
-import fcntl
 import glob
 import grp
 import logging
@@ -13,6 +12,8 @@ import stat
 import tempfile
 import uuid
 
+from . import hostfacts
+from . import locks
 from . import mounts
 from . import uid
 from . import util
@@ -21,6 +22,16 @@ from .package_manager import package_manager
 from .trace_decorator import getLog, traceLog
 
 
+def root_path(config):
+    """the chroot directory of config, without constructing its Buildroot"""
+    if 'rootdir' in config:
+        return config['rootdir']
+    root = config['root']
+    if 'unique-ext' in config:
+        root = "%s-%s" % (root, config['unique-ext'])
+    return os.path.join(config['basedir'], root, 'root')
+
+
 class Buildroot(object):
     @traceLog()
     def __init__(self, config, uid_manager, state, plugins, bootstrap_buildroot=None, is_bootstrap=False):
@@ -31,21 +42,18 @@ class Buildroot(object):
         self.bootstrap_buildroot = bootstrap_buildroot
         self.is_bootstrap = is_bootstrap
         self.shared_root_name = config['root']
+        self.rootdir = root_path(config)
         if 'unique-ext' in config:
             config['root'] = "%s-%s" % (config['root'], config['unique-ext'])
         self.root_name = config['root']
         self.mockdir = config['basedir']
         self.basedir = os.path.join(config['basedir'], config['root'])
-        if 'rootdir' in config:
-            self.rootdir = config['rootdir']
-        else:
-            self.rootdir = os.path.join(self.basedir, 'root')
         self.resultdir = config['resultdir'] % config
         self.homedir = config['chroothome']
         self.cache_topdir = config['cache_topdir']
         self.cachedir = os.path.join(self.cache_topdir, self.shared_root_name)
         self.builddir = os.path.join(self.homedir, 'build')
-        self._lock_file = None
+        self._lock = None
         self.selinux = (not self.config['plugin_conf']['selinux_enable']
                         and util.selinuxEnabled())
 
@@ -93,7 +101,8 @@ class Buildroot(object):
         except BuildRootLocked:
             pass
         finally:
-            self._lock_buildroot(exclusive=False)
+            # wait for whoever is initializing it
+            self._lock_buildroot(exclusive=False, timeout=None)
         if do_log:
             self._resetLogging()
 
@@ -381,23 +390,22 @@ class Buildroot(object):
     @traceLog()
     def _open_lock(self):
         util.mkdirIfAbsent(self.basedir)
-        self._lock_file = open(os.path.join(self.basedir, "buildroot.lock"), "a+")
+        self._lock = locks.Lock(os.path.join(self.basedir, "buildroot.lock"), "buildroot", self.state)
 
     @traceLog()
-    def _lock_buildroot(self, exclusive):
-        lock_type = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
-        if not self._lock_file:
+    def _lock_buildroot(self, exclusive, timeout=0):
+        if not self._lock:
             self._open_lock()
-        try:
-            fcntl.lockf(self._lock_file.fileno(), lock_type | fcntl.LOCK_NB)
-        except IOError:
-            raise BuildRootLocked("Build root is locked by another process.")
+        if not self._lock.acquire(exclusive, timeout):
+            holder = self._lock.holder()
+            raise BuildRootLocked("Build root is locked by another process" +
+                                  (" ({0}).".format(holder) if holder else "."))
 
     @traceLog()
     def _unlock_buildroot(self):
-        if self._lock_file:
-            self._lock_file.close()
-        self._lock_file = None
+        if self._lock:
+            self._lock.close()
+        self._lock = None
 
     @traceLog()
     def _setup_dirs(self):
@@ -543,11 +551,13 @@ class Buildroot(object):
         nosync_unresolved = '/usr/$LIB/nosync/nosync.so'
 
         def copy_nosync(lib64=False):
+            libdir = 'lib64' if lib64 else 'lib'
+
             def resolve(path):
-                return path.replace('$LIB', 'lib64' if lib64 else 'lib')
-            nosync = resolve(nosync_unresolved)
-            if not os.path.exists(nosync):
+                return path.replace('$LIB', libdir)
+            if not hostfacts.nosync_libs()[libdir]:
                 return False
+            nosync = resolve(nosync_unresolved)
             for dst_unresolved in (tmp_libdir, mock_libdir):
                 dst = resolve(dst_unresolved)
                 util.mkdirIfAbsent(dst)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""CPU, memory and I/O accounting of mock's phases.
+
+With the unified (v2) cgroup hierarchy, mock moves itself into its own
+cgroup (CGROUP_ROOT/mock/<name>) which all its child commands inherit, and
+the counters of that cgroup are read at the start and finish of each phase.
+systemd-nspawn moves containers into their own machine scope, so commands
+run in nspawn containers are not part of that cgroup; getrusage() of the
+waited-for children is recorded in addition, which does include them.
+Without cgroup v2 (or without the privileges to create the cgroup), only
+the getrusage() numbers are available.
+"""
+
+import os
+import resource
+
+from .trace_decorator import getLog, traceLog
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CONTROLLERS = ('cpu', 'io', 'memory')
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def own_cgroup():
+    """path of the v2 cgroup of this process, None without cgroup v2"""
+    if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        return None
+    for line in (_read('/proc/self/cgroup') or '').splitlines():
+        if line.startswith('0::'):
+            return os.path.join(CGROUP_ROOT, line[3:].lstrip('/'))
+    return None
+
+
+def _flat_keyed(text):
+    """'key value' lines (cpu.stat) as dict of ints"""
+    result = {}
+    for line in (text or '').splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            result[fields[0]] = int(fields[1])
+    return result
+
+
+def _io_totals(text):
+    """io.stat summed over devices"""
+    totals = {}
+    for line in (text or '').splitlines():
+        for field in line.split()[1:]:
+            key, _, value = field.partition('=')
+            if value.isdigit():
+                totals[key] = totals.get(key, 0) + int(value)
+    return totals
+
+
+def rusage_snapshot():
+    """own and waited-for children resource usage"""
+    snapshot = {}
+    for who, prefix in ((resource.RUSAGE_SELF, 'self_'), (resource.RUSAGE_CHILDREN, 'children_')):
+        usage = resource.getrusage(who)
+        snapshot[prefix + 'user_usec'] = int(usage.ru_utime * 1e6)
+        snapshot[prefix + 'system_usec'] = int(usage.ru_stime * 1e6)
+        snapshot[prefix + 'inblock'] = usage.ru_inblock
+        snapshot[prefix + 'oublock'] = usage.ru_oublock
+        # peak, not a counter; kilobytes on Linux
+        snapshot[prefix + 'maxrss_kb'] = usage.ru_maxrss
+    return snapshot
+
+
+class Accounting(object):
+    """Snapshots of resource counters; delta() of two of them is a phase's usage."""
+    def __init__(self, path=None):
+        # cgroup of the build, None when only getrusage() is used
+        self.path = path
+        self._previous = None
+
+    @classmethod
+    @traceLog()
+    def create(cls, name):
+        """move this process to a new cgroup for accounting; needs root
+
+        Falls back to getrusage() accounting when that is not possible.
+        """
+        own = own_cgroup()
+        if own is None:
+            getLog().debug("cgroup v2 is not available, accounting with getrusage()")
+            return cls()
+        parent = os.path.join(CGROUP_ROOT, 'mock')
+        path = os.path.join(parent, name)
+        try:
+            enabled = set((_read(os.path.join(CGROUP_ROOT, 'cgroup.subtree_control')) or '').split())
+            wanted = [c for c in CONTROLLERS if c in enabled]
+            if not os.path.isdir(parent):
+                os.mkdir(parent)
+            _write(os.path.join(parent, 'cgroup.subtree_control'), ' '.join('+' + c for c in wanted))
+            os.mkdir(path)
+            _write(os.path.join(path, 'cgroup.procs'), str(os.getpid()))
+        except (IOError, OSError) as e:
+            getLog().warning("Cannot create cgroup %s, accounting with getrusage(): %s", path, e)
+            if os.path.isdir(path):
+                os.rmdir(path)
+            return cls()
+        accounting = cls(path)
+        accounting._previous = own
+        return accounting
+
+    @traceLog()
+    def remove(self):
+        """move this process back and remove the build cgroup; needs root"""
+        if self.path is None:
+            return
+        try:
+            _write(os.path.join(self._previous, 'cgroup.procs'), str(os.getpid()))
+            os.rmdir(self.path)
+        except (IOError, OSError) as e:
+            # e.g. daemonized orphans still live there
+            getLog().warning("Cannot remove cgroup %s: %s", self.path, e)
+        self.path = None
+
+    def snapshot(self):
+        snapshot = rusage_snapshot()
+        if self.path is not None:
+            for key, value in _flat_keyed(_read(os.path.join(self.path, 'cpu.stat'))).items():
+                snapshot['cgroup_cpu_' + key] = value
+            for key, value in _io_totals(_read(os.path.join(self.path, 'io.stat'))).items():
+                snapshot['cgroup_io_' + key] = value
+            for key in ('memory.current', 'memory.peak'):
+                value = _read(os.path.join(self.path, key))
+                if value is not None and value.strip().isdigit():
+                    snapshot['cgroup_' + key.replace('.', '_')] = int(value)
+        return snapshot
+
+    @staticmethod
+    def delta(start, end):
+        """usage between two snapshots; peaks and current values are taken from end"""
+        result = {}
+        for key, value in end.items():
+            if 'peak' in key or 'current' in key or 'maxrss' in key:
+                result[key] = value
+            else:
+                result[key] = value - start.get(key, 0)
+        return result
@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""Build ordering and scheduling for mockchain.
+
+The SRPMs given to mockchain are turned into a dependency graph: an edge
+A -> B exists when one of A's BuildRequires is (probably) provided by B.
+Source package headers only carry the source package name and its explicit
+Provides, not the names of the binary subpackages, so a BuildRequires of
+'foo-devel' or 'foo-libs' is attributed to the SRPM named 'foo' (longest
+matching name wins).
+
+SRPMs which are still being downloaded are added as placeholders (name
+guessed from the file name, nothing known about their BuildRequires) and
+filled in once they arrive; the scheduler does not start them earlier.
+
+A package may be given more than once (e.g. bootstrapping with a stage1
+build first); each later build waits for the previous one, and packages
+requiring it depend on the first one given. Nodes are identified by their
+index, the position on the command line.
+"""
+
+import json
+import os
+import re
+import threading
+
+from . import util
+from .trace_decorator import traceLog
+
+PLAN_VERSION = 2
+
+# build_func() return codes, the same as mockchain.do_build() uses
+BUILD_FAILED = 0
+BUILD_SUCCESS = 1
+BUILD_SKIPPED = 2
+
+_RICH_DEP_KEYWORDS = ('and', 'or', 'if', 'else', 'with', 'without', 'unless')
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def name_from_filename(filename):
+    """guess package name from name-version-release.src.rpm"""
+    nvr = os.path.basename(filename)
+    for suffix in ('.src.rpm', '.rpm'):
+        if nvr.endswith(suffix):
+            nvr = nvr[:-len(suffix)]
+            break
+    parts = nvr.rsplit('-', 2)
+    return parts[0] if len(parts) == 3 else nvr
+
+
+_MISSING_RES = (
+    # dnf
+    re.compile(r"No matching package to install: '([^'\s]+)"),
+    # yum, yum-builddep
+    re.compile(r"No Package found for ([^\s,]+)"),
+    # libsolv problem description
+    re.compile(r"nothing provides ([^\s,]+)"),
+)
+
+
+def missing_requires(log_text):
+    """capabilities the package manager could not install, from root.log"""
+    missing = set()
+    for regex in _MISSING_RES:
+        missing.update(regex.findall(log_text))
+    return missing
+
+
+def split_requires(requires):
+    """Return plain capability names from a list of (possibly rich) deps."""
+    names = set()
+    for req in requires:
+        req = _to_str(req)
+        if req.startswith('rpmlib(') or req.startswith('/'):
+            continue
+        if req.startswith('('):
+            for token in re.split(r'[\s()]+', req):
+                if not token or token in _RICH_DEP_KEYWORDS or token[0] in '<>=' or token[0].isdigit():
+                    continue
+                names.add(token)
+        else:
+            names.add(req)
+    return names
+
+
+def header_deps(hdr):
+    """return (name, provides, requires) of SRPM header"""
+    import rpm
+    name = _to_str(hdr[rpm.RPMTAG_NAME])
+    provides = [_to_str(p) for p in hdr[rpm.RPMTAG_PROVIDENAME] or []]
+    requires = split_requires(hdr[rpm.RPMTAG_REQUIRENAME] or [])
+    return name, provides, requires
+
+
+class ChainNode(object):
+    """One SRPM in the chain"""
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, name, path, provides=(), requires=(), index=0, available=True):
+        self.name = name
+        # False while the SRPM is not downloaded yet
+        self.available = available
+        self.path = path
+        self.provides = set(provides)
+        self.provides.add(name)
+        self.requires = set(requires)
+        self.index = index
+        # indexes of in-set packages this one needs built first
+        self.deps = set()
+        # indexes of in-set packages waiting for this one
+        self.rdeps = set()
+        # expected duration of this build and everything waiting for it
+        self.critical_path = 0
+        # number of packages (transitively) waiting for this one
+        self.dependents = 0
+
+    def priority(self):
+        """sort key, packages which delay the rest of the chain the most go first"""
+        return (-self.critical_path, -self.dependents, self.index)
+
+    def __repr__(self):
+        return "<ChainNode %s deps=%s>" % (self.name, sorted(self.deps))
+
+    def to_dict(self):
+        result = {
+            'name': self.name,
+            'path': self.path,
+            'provides': sorted(self.provides),
+            'requires': sorted(self.requires),
+        }
+        result.update(file_signature(self.path) if self.available else {})
+        return result
+
+
+def file_signature(path):
+    """size and mtime of path, to tell whether a plan entry still describes it"""
+    try:
+        statinfo = os.stat(path)
+    except OSError:
+        return {}
+    return {'size': statinfo.st_size, 'mtime': statinfo.st_mtime}
+
+
+class BuildGraph(object):
+    """Dependency graph of the SRPMs to be built"""
+    @traceLog()
+    def __init__(self):
+        # index -> node
+        self.nodes = {}
+        self._by_path = {}
+        # package name -> nodes, in command-line order
+        self._by_name = {}
+        # capability -> nodes providing it, in command-line order
+        self._providers = {}
+        # capability or name prefix of one -> indexes of nodes requiring it
+        self._requirers = {}
+        self._next_index = 0
+        # package name -> build duration in seconds, from previous builds
+        self.durations = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(sorted(self.nodes.values(), key=lambda n: n.index))
+
+    def get(self, index):
+        return self.nodes[index]
+
+    def by_path(self, path):
+        return self._by_path.get(path)
+
+    def _index(self, node):
+        self._by_name.setdefault(node.name, []).append(node)
+        self._by_name[node.name].sort(key=lambda n: n.index)
+        for capability in node.provides:
+            self._providers.setdefault(capability, []).append(node)
+            self._providers[capability].sort(key=lambda n: n.index)
+        for key in self._requirement_keys(node):
+            self._requirers.setdefault(key, set()).add(node.index)
+
+    def _unindex(self, node):
+        for key, index in [(node.name, self._by_name)] + [(c, self._providers) for c in node.provides]:
+            index[key].remove(node)
+            if not index[key]:
+                del index[key]
+        for key in self._requirement_keys(node):
+            self._requirers[key].discard(node.index)
+            if not self._requirers[key]:
+                del self._requirers[key]
+
+    @staticmethod
+    def _requirement_keys(node):
+        """requires of node and their prefixes provider_of() may match as name"""
+        keys = set()
+        for capability in node.requires:
+            keys.add(capability)
+            end = capability.rfind('-')
+            while end > 0:
+                keys.add(capability[:end])
+                end = capability.rfind('-', 0, end)
+        return keys
+
+    def _affected(self, node):
+        """indexes of nodes whose dependencies change with the name or provides of node"""
+        result = set([node.index])
+        for capability in node.provides:
+            result.update(self._requirers.get(capability, ()))
+        result.update(n.index for n in self._by_name.get(node.name, ()))
+        return result
+
+    @traceLog()
+    def add(self, name, path, provides=(), requires=(), available=True):
+        node = ChainNode(name, path, provides, requires, index=self._next_index, available=available)
+        self._next_index += 1
+        self.nodes[node.index] = node
+        self._by_path[path] = node
+        self._index(node)
+        return node
+
+    @traceLog()
+    def add_srpms(self, srpms, plan=None):
+        """read Name/Provides/BuildRequires from the SRPM headers, or from
+        plan (see read_plan) for the SRPMs which did not change since"""
+        known = {}
+        for path in srpms:
+            entry = (plan or {}).get(os.path.basename(path))
+            signature = file_signature(path)
+            # a rebuilt SRPM may keep its file name
+            if entry is not None and signature and \
+                    [entry.get(key) for key in signature] == list(signature.values()):
+                known[path] = (entry['name'], entry['provides'], entry['requires'])
+        unknown = [path for path in srpms if path not in known]
+        for path, hdr in zip(unknown, util.yieldSrpmHeaders(unknown)):
+            known[path] = header_deps(hdr)
+        for path in srpms:
+            name, provides, requires = known[path]
+            self.add(name, path, provides, requires)
+
+    @traceLog()
+    def add_placeholder(self, path, filename, entry=None):
+        """add SRPM which is not available yet, entry is its record from a previous plan"""
+        if entry is not None:
+            return self.add(entry['name'], path, entry['provides'], entry['requires'], available=False)
+        return self.add(name_from_filename(filename), path, available=False)
+
+    @traceLog()
+    def fill(self, node, path, name, provides, requires):
+        """SRPM of placeholder node arrived, update it in place; return the
+        nodes to pass to resolve()"""
+        affected = self._affected(node)
+        self._unindex(node)
+        del self._by_path[node.path]
+        self._by_path[path] = node
+        node.name = name
+        node.path = path
+        node.provides = set(provides)
+        node.provides.add(name)
+        node.requires = set(requires)
+        node.available = True
+        self._index(node)
+        affected.update(self._affected(node))
+        return [self.nodes[index] for index in sorted(affected)]
+
+    @traceLog()
+    def remove(self, node):
+        """drop node from the graph, return the nodes to pass to resolve()"""
+        affected = self._affected(node)
+        affected.discard(node.index)
+        self._unindex(node)
+        del self.nodes[node.index]
+        del self._by_path[node.path]
+        for dep in node.deps:
+            if dep in self.nodes:
+                self.nodes[dep].rdeps.discard(node.index)
+        return [self.nodes[index] for index in sorted(affected)]
+
+    def __contains__(self, node):
+        return self.nodes.get(node.index) is node
+
+    def provider_of(self, capability):
+        """find in-set package which provides the capability"""
+        nodes = self._providers.get(capability)
+        if nodes:
+            return nodes[0]
+        # foo-devel of the SRPM named foo, the longest matching name wins
+        end = len(capability)
+        while True:
+            end = capability.rfind('-', 0, end)
+            if end <= 0:
+                return None
+            nodes = self._by_name.get(capability[:end])
+            if nodes:
+                return nodes[0]
+
+    @traceLog()
+    def resolve(self, nodes=None):
+        """(re)compute edges from requires/provides, of all nodes or only of
+        the nodes returned by fill() or remove()"""
+        if nodes is None:
+            nodes = list(self.nodes.values())
+            for node in nodes:
+                node.rdeps = set()
+        else:
+            for node in nodes:
+                for dep in node.deps:
+                    if dep in self.nodes:
+                        self.nodes[dep].rdeps.discard(node.index)
+        for node in nodes:
+            node.deps = set()
+            for req in node.requires:
+                provider = self.provider_of(req)
+                if provider is not None and provider is not node:
+                    node.deps.add(provider.index)
+            # the same package given again is built after the previous one
+            same = [n for n in self._by_name[node.name] if n.index < node.index]
+            if same:
+                node.deps.add(same[-1].index)
+            for dep in node.deps:
+                self.nodes[dep].rdeps.add(node.index)
+        self._prioritize()
+
+    def _prioritize(self):
+        known = sorted(self.durations[n.name] for n in self.nodes.values() if n.name in self.durations)
+        # packages built for the first time are assumed to be average
+        default = known[len(known) // 2] if known else 1
+        order = self.order()
+        position = dict((node.index, i) for i, node in enumerate(order))
+        for node in reversed(order):
+            # edges to packages earlier in the order close a cycle, ignore them
+            later = [self.nodes[n] for n in node.rdeps if position[n] > position[node.index]]
+            node.critical_path = self.durations.get(node.name, default) + \
+                max([n.critical_path for n in later] or [0])
+        # bit i of waiting[node] is set when the node at position i (transitively)
+        # waits for node; propagated until nothing changes because of cycles
+        waiting = dict((node.index, 0) for node in order)
+        changed = True
+        while changed:
+            changed = False
+            for node in reversed(order):
+                bits = waiting[node.index]
+                for rdep in node.rdeps:
+                    bits |= waiting[rdep] | (1 << position[rdep])
+                if bits != waiting[node.index]:
+                    waiting[node.index] = bits
+                    changed = True
+        for node in order:
+            node.dependents = bin(waiting[node.index] & ~(1 << position[node.index])).count('1')
+
+    def order(self):
+        """topological order; packages in a dependency cycle keep command-line order"""
+        # index -> number of dependencies not in the result yet
+        remaining = dict((node.index, len(node.deps)) for node in self.nodes.values())
+        ready = sorted(index for index, count in remaining.items() if not count)
+        result = []
+        while remaining:
+            if not ready:
+                # cycle; break it at the first package given on command line
+                ready = [min(remaining)]
+            next_ready = []
+            for index in ready:
+                del remaining[index]
+                result.append(self.nodes[index])
+            for index in ready:
+                for rdep in self.nodes[index].rdeps:
+                    if rdep in remaining:
+                        remaining[rdep] -= 1
+                        if not remaining[rdep]:
+                            next_ready.append(rdep)
+            ready = sorted(next_ready)
+        return result
+
+    def to_plan(self):
+        return {
+            'version': PLAN_VERSION,
+            'order': [node.name for node in self.order()],
+            'packages': [dict(node.to_dict(), deps=sorted(self.nodes[d].name for d in node.deps))
+                         for node in self],
+        }
+
+    @traceLog()
+    def write_plan(self, filename):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_plan(), f, indent=2, sort_keys=True)
+        os.rename(tmp, filename)
+
+    @staticmethod
+    def read_plan(filename):
+        """return {basename: package dict} from previously written plan,
+        an empty dict for plans written by another version"""
+        with open(filename) as f:
+            plan = json.load(f)
+        if plan.get('version') != PLAN_VERSION:
+            return {}
+        return dict((os.path.basename(p['path']), p) for p in plan['packages'])
+
+
+class ChainScheduler(object):
+    """Run build_func(node, slot) for graph nodes, at most `jobs` at once.
+
+    A node is started once all its in-set dependencies were built. Slot is
+    a number in range(jobs) which is unique among concurrently running
+    builds, so it can be used to pick a distinct --uniqueext.
+
+    When a build fails, classify(node) may return the capabilities which
+    could not be installed. If some of them are provided by in-set packages
+    which are not built yet, the node is retried right after one of those
+    is built. Otherwise the failure is final and all packages depending on
+    the node are cancelled without being tried. Failures for other reasons
+    are final too, unless recurse is set; then they are retried once some
+    other package was built since.
+
+    Placeholder nodes wait until fill() or discard() is called for them,
+    which may happen from other threads while the scheduler runs. When
+    nothing runs and only placeholders could be started, idle() is called.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, graph, build_func, jobs=1, recurse=False, log=None, classify=None, idle=None):
+        self.graph = graph
+        self.build_func = build_func
+        self.jobs = max(1, jobs)
+        self.recurse = recurse
+        self.log = log or (lambda msg: None)
+        self.classify = classify
+        self.idle = idle
+        self.built = []
+        self.skipped = []
+        self.failed = []
+        self.cancelled = []
+        self._cond = threading.Condition()
+        self._pending = []
+        # index -> slot
+        self._running = {}
+        # indexes of built or skipped nodes
+        self._done = set()
+        # indexes of failed or cancelled nodes
+        self._dead = set()
+        # index -> (node, indexes of providers it waits for)
+        self._blocked = {}
+        # index -> (node, number of successes when it failed)
+        self._soft = {}
+        self._successes = 0
+        self._free_slots = list(range(self.jobs))
+        self._errors = []
+
+    def _ready(self):
+        ready = [node for node in self._pending if node.available and node.deps <= self._done]
+        if not ready:
+            return None
+        return min(ready, key=lambda node: node.priority())
+
+    @traceLog()
+    def fill(self, node, path, name, provides, requires):
+        """placeholder node became available, recompute dependencies"""
+        with self._cond:
+            self.graph.resolve(self.graph.fill(node, path, name, provides, requires))
+            self._cond.notify_all()
+
+    @traceLog()
+    def discard(self, node):
+        """drop node which will never become available"""
+        with self._cond:
+            self.graph.resolve(self.graph.remove(node))
+            if node in self._pending:
+                self._pending.remove(node)
+            self._cond.notify_all()
+
+    def _worker(self, node, slot):
+        missing = None
+        try:
+            ret = self.build_func(node, slot)
+            if ret == BUILD_FAILED and self.classify:
+                missing = self.classify(node)
+        # pylint: disable=broad-except
+        except Exception as e:
+            self._errors.append(e)
+            ret = BUILD_FAILED
+        with self._cond:
+            del self._running[node.index]
+            self._free_slots.append(slot)
+            if ret == BUILD_SUCCESS:
+                self.built.append(node)
+                self._succeeded(node)
+            elif ret == BUILD_SKIPPED:
+                self.skipped.append(node)
+                self._succeeded(node)
+            else:
+                self._build_failed(node, missing)
+            self._cond.notify_all()
+
+    def _names(self, indexes):
+        return sorted(self.graph.nodes[index].name for index in indexes)
+
+    def _succeeded(self, node):
+        self._done.add(node.index)
+        self._successes += 1
+        for index, (blocked, providers) in list(self._blocked.items()):
+            if node.index in providers:
+                del self._blocked[index]
+                self.log("Retrying %s, %s is built now" % (blocked.name, node.name))
+                self._pending.append(blocked)
+
+    def _build_failed(self, node, missing):
+        if missing:
+            providers = set()
+            for capability in missing:
+                provider = self.graph.provider_of(capability)
+                if provider is not None and provider is not node and \
+                        provider.index not in self._done and provider.index not in self._dead:
+                    providers.add(provider.index)
+            if providers:
+                self.log("%s is missing %s, will try again after %s is built" %
+                         (node.name, ', '.join(sorted(missing)), ' or '.join(self._names(providers))))
+                self._blocked[node.index] = (node, providers)
+                return
+            self.log("%s is missing %s, no package in the chain provides it" %
+                     (node.name, ', '.join(sorted(missing))))
+        elif self.recurse:
+            self.log("Will try to build %s again (if some other package will succeed)." % node.name)
+            self._soft[node.index] = (node, self._successes)
+            return
+        self._fail(node)
+
+    def _fail(self, node):
+        """final failure, cancel everything which depends on node"""
+        self.failed.append(node)
+        self._dead.add(node.index)
+        self._unblock(node)
+        self._cancel_dependents(node)
+
+    def _unblock(self, dead):
+        """dead will never be built, nodes waiting only for it fail"""
+        for index, (blocked, providers) in list(self._blocked.items()):
+            if dead.index in providers:
+                providers.discard(dead.index)
+                if not providers:
+                    del self._blocked[index]
+                    self._fail(blocked)
+
+    def _cancel_dependents(self, node):
+        todo = [node]
+        while todo:
+            dead = todo.pop()
+            for index in sorted(dead.rdeps):
+                dependent = self.graph.nodes.get(index)
+                if dependent is None or index in self._dead or index in self._done or index in self._running:
+                    continue
+                self.log("Skipping %s, it depends on %s which failed" % (dependent.name, dead.name))
+                if dependent in self._pending:
+                    self._pending.remove(dependent)
+                self._blocked.pop(index, None)
+                self._soft.pop(index, None)
+                self.cancelled.append(dependent)
+                self._dead.add(index)
+                self._unblock(dependent)
+                todo.append(dependent)
+
+    def _stalled(self):
+        """nothing runs and nothing is ready, return node to start or None when all is done"""
+        retry = [node for node, successes in self._soft.values() if successes < self._successes]
+        if retry:
+            for node in retry:
+                del self._soft[node.index]
+                self._pending.append(node)
+            self.log('Some package succeeded, trying to rebuild %s failed pkgs, because --recurse is set.'
+                     % len(retry))
+            return self._ready()
+        if self._soft:
+            # nothing was built since they failed, no point in trying again
+            for node, _ in sorted(self._soft.values(), key=lambda n: n[0].index):
+                del self._soft[node.index]
+                self._fail(node)
+            return self._ready()
+        pending = set(node.index for node in self._pending)
+        for index, (blocked, providers) in sorted(self._blocked.items()):
+            if not providers & pending:
+                del self._blocked[index]
+                self.log("Giving up on %s, %s can not be built" %
+                         (blocked.name, ' or '.join(self._names(providers))))
+                self._fail(blocked)
+        ready = self._ready()
+        if ready is None and self._pending:
+            # dependency cycle
+            ready = sorted(self._pending, key=lambda n: n.index)[0]
+            self.log("Dependency cycle detected, building %s anyway" % ready.name)
+        return ready
+
+    @traceLog()
+    def run(self):
+        """build everything, return list of failed and cancelled nodes"""
+        threads = []
+        with self._cond:
+            self._pending = list(self.graph)
+            while True:
+                if not self._free_slots:
+                    self._cond.wait()
+                    continue
+                node = self._ready()
+                if node is None:
+                    if self._running or [n for n in self._pending if not n.available]:
+                        if not self._running and self.idle:
+                            self.idle()
+                        self._cond.wait()
+                        continue
+                    node = self._stalled()
+                    if node is None:
+                        if self._pending or self._blocked or self._soft:
+                            continue
+                        break
+                self._pending.remove(node)
+                slot = self._free_slots.pop(0)
+                self._running[node.index] = slot
+                thread = threading.Thread(target=self._worker, args=(node, slot),
+                                          name="mockchain-%s" % node.name)
+                thread.daemon = True
+                threads.append(thread)
+                thread.start()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return self.failed + self.cancelled
@@ -40,6 +40,7 @@ class Error(Exception):
 # 65 = LVM thinpool locked
 # 70 = result dir could not be created
 # 80 = unshare of namespace failed
+# 85 = timeout waiting for a lock
 # 110 = unbalanced call to state functions
 
 class BuildError(Error):
@@ -136,6 +137,15 @@ class UnshareFailed(Error):
         self.resultcode = 80
 
 
+class LockTimeout(Error):
+    "lock not obtained in time"
+
+    def __init__(self, msg):
+        Error.__init__(self, msg)
+        self.msg = msg
+        self.resultcode = 85
+
+
 class StateError(Error):
     "unbalanced call to state functions"
 
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""Static facts about the build host, probed once.
+
+Facts (host distribution, SELinux, nosync libraries, ...) are kept in
+memory and in a small JSON file in cache_topdir shared by all mock
+processes. The file is thrown away when the host was rebooted (boot id) or
+packages were installed or removed (rpmdb mtime). Mount points change all
+the time, so filesystem types are looked up in /proc/self/mounts instead
+of being cached.
+"""
+
+import json
+import os
+import re
+import tempfile
+
+from .trace_decorator import getLog
+
+FACTS_FILE = 'host-facts.json'
+FACTS_VERSION = 2
+
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+RPMDB_DIRS = ('/var/lib/rpm', '/usr/lib/sysimage/rpm')
+NOSYNC_LIB = '/usr/%s/nosync/nosync.so'
+MACHINECTL = '/usr/bin/machinectl'
+
+
+def _stamp():
+    """what the facts depend on, (boot id, rpmdb mtime)"""
+    try:
+        with open(BOOT_ID) as f:
+            boot_id = f.read().strip()
+    except (IOError, OSError):
+        boot_id = None
+    rpmdb_mtime = 0
+    for rpmdb in RPMDB_DIRS:
+        try:
+            for name in os.listdir(rpmdb):
+                rpmdb_mtime = max(rpmdb_mtime, os.stat(os.path.join(rpmdb, name)).st_mtime)
+        except OSError:
+            continue
+    return [FACTS_VERSION, boot_id, rpmdb_mtime]
+
+
+class HostFacts(object):
+    """facts probed at most once per boot and package set"""
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.stamp = _stamp()
+        self.facts = {}
+        if filename:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('stamp') == self.stamp:
+            self.facts = data.get('facts', {})
+
+    def _save(self):
+        if not self.filename:
+            return
+        # several mock processes may write at once, replace the file atomically
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='.' + FACTS_FILE, dir=os.path.dirname(self.filename))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'stamp': self.stamp, 'facts': self.facts}, f)
+            os.chmod(tmp, 0o664)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError) as e:
+            getLog().debug("Cannot save host facts to %s: %s", self.filename, e)
+
+    def get(self, name, probe):
+        """return fact name, probe() (returning JSON data) if not known yet"""
+        if name not in self.facts:
+            self.facts[name] = probe()
+            self._save()
+        return self.facts[name]
+
+
+_facts = HostFacts()
+
+
+def setup(cache_topdir):
+    """share the facts with other mock processes through a file in cache_topdir"""
+    global _facts
+    if os.path.isdir(cache_topdir):
+        _facts = HostFacts(os.path.join(cache_topdir, FACTS_FILE))
+
+
+def distribution():
+    """(id, version) of the host distribution, e.g. ('fedora', '27')"""
+    def probe():
+        import distro
+        return list(distro.linux_distribution(full_distribution_name=False)[0:2])
+    return tuple(_facts.get('distribution', probe))
+
+
+def _probe_selinux():
+    with open("/proc/mounts") as f:
+        for mount in f.readlines():
+            (fstype, mountpoint, _) = mount.split(None, 2)
+            if fstype == "selinuxfs":
+                selinux_mountpoint = mountpoint
+                break
+        else:
+            selinux_mountpoint = "/selinux"
+
+    try:
+        enforce_filename = os.path.join(selinux_mountpoint, "enforce")
+        with open(enforce_filename) as f:
+            if f.read().strip() in ("1", "0"):
+                return True
+    except (IOError, OSError):
+        pass
+    return False
+
+
+def selinux_enabled():
+    """SELinux is enabled (enforcing or permissive)"""
+    return _facts.get('selinux', _probe_selinux)
+
+
+def nosync_libs():
+    """{'lib': bool, 'lib64': bool}, whether nosync.so is installed for the libdir"""
+    return _facts.get('nosync', lambda: dict(
+        (libdir, os.path.exists(NOSYNC_LIB % libdir)) for libdir in ('lib', 'lib64')))
+
+
+def have_machinectl():
+    return _facts.get('machinectl', lambda: os.path.exists(MACHINECTL))
+
+
+_MOUNT_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+
+def fs_type(path):
+    """type of the filesystem path is on (following symlinks), e.g. 'xfs' or 'nfs4'"""
+    path = os.path.realpath(path)
+    best, result = -1, ''
+    with open('/proc/self/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            mountpoint = _MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), fields[1])
+            prefix = mountpoint.rstrip('/') + '/'
+            # later mounts over the same mount point win
+            if (path == mountpoint or path.startswith(prefix)) and len(mountpoint) >= best:
+                best, result = len(mountpoint), fields[2]
+    return result
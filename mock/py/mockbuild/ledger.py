@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""Persistent record of mockchain builds.
+
+Builds are keyed by the sha256 of the SRPM content and a hash of the
+resolved mock configuration, so a rebuilt SRPM with the same file name or
+a changed config is never mistaken for an already built package. The whole
+ledger is one sqlite file in the local repo dir; whether to skip a set of
+packages is decided with a single query. Recorded durations are also used
+to decide which of the packages ready to build should go first.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import util
+from .trace_decorator import traceLog
+
+LEDGER_FILE = 'mockchain-ledger.sqlite'
+
+STATUS_SUCCESS = 'success'
+STATUS_FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    srpm_sha256 TEXT NOT NULL,
+    config_sha256 TEXT NOT NULL,
+    name TEXT,
+    srpm TEXT,
+    status TEXT NOT NULL,
+    started REAL,
+    duration REAL,
+    results TEXT,
+    PRIMARY KEY (srpm_sha256, config_sha256)
+);
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_sha256(*parts):
+    """hash of resolved config file content and extra options (e.g. mock command line)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode('utf-8')
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def rpm_nevras(paths):
+    import rpm
+    nevras = []
+    for hdr in util.yieldSrpmHeaders(paths, plainRpmOk=1):
+        nevra = hdr[rpm.RPMTAG_NEVRA]
+        if isinstance(nevra, bytes):
+            nevra = nevra.decode('utf-8', 'replace')
+        nevras.append(nevra)
+    return sorted(nevras)
+
+
+class BuildLedger(object):
+    """sqlite ledger of builds, safe to use from several threads"""
+    @traceLog()
+    def __init__(self, filename, config_hash):
+        self.filename = filename
+        self.config_hash = config_hash
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, timeout=60)
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @traceLog()
+    def digests(self, paths):
+        """return {path: sha256}; unchanged files (size and mtime) are not read again"""
+        with self._lock:
+            known = dict((row[0], row[1:]) for row in
+                         self._db.execute("SELECT path, size, mtime, sha256 FROM digests"))
+        result = {}
+        new = []
+        for path in paths:
+            st = os.stat(path)
+            cached = known.get(path)
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+                result[path] = cached[2]
+            else:
+                result[path] = file_sha256(path)
+                new.append((path, st.st_size, st.st_mtime, result[path]))
+        if new:
+            with self._lock:
+                self._db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)", new)
+                self._db.commit()
+        return result
+
+    @traceLog()
+    def statuses(self):
+        """return {srpm_sha256: status} of all builds done with the current config"""
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT srpm_sha256, status FROM builds WHERE config_sha256 = ?", (self.config_hash,)))
+
+    @traceLog()
+    def durations(self):
+        """return {name: seconds} of the latest successful build of each package
+
+        builds with the current config are preferred, but any will do
+        """
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT name, duration FROM builds WHERE status = ? ORDER BY config_sha256 = ?, started",
+                (STATUS_SUCCESS, self.config_hash)))
+
+    @traceLog()
+    def record(self, srpm_hash, name, srpm, status, started, results=()):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (srpm_hash, self.config_hash, name, srpm, status, started,
+                 time.time() - started, json.dumps(list(results))))
+            self._db.commit()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""File locks shared by concurrent mock processes.
+
+Locks are open file description (OFD) locks, or flock(2) locks on kernels
+without them. They belong to the open lock file, so they are released when
+the process dies and never go stale, and waiters sleep in the kernel
+instead of polling. OFD locks also conflict with the lockf(3) locks older
+mock versions took on the same files.
+
+The exclusive holder writes "pid<TAB>since<TAB>command" to the lock file,
+which is used in messages about waiting for the lock. Time spent waiting
+is recorded in the state log as "Waiting for <name> lock".
+"""
+
+import contextlib
+import errno
+import fcntl
+import os
+import struct
+import sys
+import time
+
+from .exception import LockTimeout
+from .trace_decorator import getLog
+
+# python 2 has no monotonic clock
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# not in the fcntl module of python < 3.9
+F_OFD_SETLK = getattr(fcntl, 'F_OFD_SETLK', 37)
+F_OFD_SETLKW = getattr(fcntl, 'F_OFD_SETLKW', 38)
+# struct flock: l_type, l_whence, l_start, l_len, l_pid (0 for OFD locks)
+_FLOCK = 'hhqqi'
+
+# sleep between attempts when waiting with a timeout, doubled up to the max
+POLL_INTERVAL = 0.01
+POLL_INTERVAL_MAX = 0.5
+
+_ofd_supported = True
+
+
+def _setlk(fd, lock_type, block):
+    """lock or unlock fd, return False when it is locked by someone else"""
+    global _ofd_supported
+    if _ofd_supported:
+        try:
+            fcntl.fcntl(fd, F_OFD_SETLKW if block else F_OFD_SETLK,
+                        struct.pack(_FLOCK, lock_type, os.SEEK_SET, 0, 0, 0))
+            return True
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            if e.errno != errno.EINVAL:
+                raise
+            # kernel older than 3.15
+            _ofd_supported = False
+    operation = {fcntl.F_WRLCK: fcntl.LOCK_EX, fcntl.F_RDLCK: fcntl.LOCK_SH, fcntl.F_UNLCK: fcntl.LOCK_UN}[lock_type]
+    try:
+        fcntl.flock(fd, operation | (0 if block else fcntl.LOCK_NB))
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Lock(object):
+    """shared/exclusive lock on file path, see the module documentation
+
+    Taking the lock again in the other mode converts it atomically.
+    """
+    def __init__(self, path, name=None, state=None):
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self.state = state
+        # None when not held, otherwise whether it is held exclusively
+        self.exclusive = None
+        # seconds spent waiting for the lock and how many times
+        self.wait_time = 0.0
+        self.waits = 0
+        self._file = None
+
+    def __repr__(self):
+        return "<mockbuild.locks.Lock: {0} ({1})>".format(self.name, self.path)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a+')
+        return self._file.fileno()
+
+    def holder(self):
+        """description of the exclusive holder for messages, None if not known"""
+        try:
+            with open(self.path) as f:
+                pid, since, command = f.readline().rstrip('\n').split('\t', 2)
+            pid = int(pid)
+        except (IOError, OSError, ValueError):
+            return None
+        if pid == os.getpid() or not _pid_alive(pid):
+            return None
+        return "pid {0} ({1}) since {2}".format(pid, command, time.ctime(float(since)))
+
+    def _record(self, exclusive):
+        """write or clear the holder information"""
+        try:
+            self._file.truncate(0)
+            if exclusive:
+                self._file.write("{0}\t{1}\t{2}\n".format(os.getpid(), time.time(), ' '.join(sys.argv)))
+            self._file.flush()
+        except (IOError, OSError) as e:
+            getLog().debug("Cannot record the holder of %s: %s", self.path, e)
+
+    def _poll(self, fd, lock_type, deadline):
+        interval = POLL_INTERVAL
+        while True:
+            if _setlk(fd, lock_type, block=False):
+                return True
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+    def acquire(self, exclusive=True, timeout=None):
+        """lock, waiting for other holders at most timeout seconds (None waits
+        forever, 0 not at all); returns False if the lock was not obtained"""
+        fd = self._open()
+        lock_type = fcntl.F_WRLCK if exclusive else fcntl.F_RDLCK
+        acquired = _setlk(fd, lock_type, block=False)
+        if not acquired and (timeout is None or timeout > 0):
+            getLog().debug("Waiting for %s lock held by %s", self.name, self.holder() or "another process")
+            wait_state = "Waiting for {0} lock".format(self.name)
+            if self.state:
+                self.state.start(wait_state)
+            start = _monotonic()
+            try:
+                if timeout is None:
+                    acquired = _setlk(fd, lock_type, block=True)
+                else:
+                    acquired = self._poll(fd, lock_type, start + timeout)
+            finally:
+                self.waits += 1
+                self.wait_time += _monotonic() - start
+                if self.state:
+                    self.state.finish(wait_state)
+        if acquired:
+            if exclusive or self.exclusive:
+                self._record(exclusive)
+            self.exclusive = exclusive
+        return acquired
+
+    def release(self):
+        if self.exclusive is None:
+            return
+        if self.exclusive:
+            self._record(False)
+        _setlk(self._file.fileno(), fcntl.F_UNLCK, block=False)
+        self.exclusive = None
+
+    def close(self):
+        """release the lock and close the lock file"""
+        if self._file is not None:
+            self.release()
+            self._file.close()
+            self._file = None
+
+    @contextlib.contextmanager
+    def held(self, exclusive=True, timeout=None):
+        """hold the lock in the with block, LockTimeout if not obtained in time"""
+        if not self.acquire(exclusive, timeout):
+            raise LockTimeout("Timeout ({0}s) waiting for {1} lock held by {2}".format(
+                timeout, self.name, self.holder() or "another process"))
+        try:
+            yield self
+        finally:
+            self.release()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""Content-addressed store of the files of chroots, shared by all configs.
+
+A tree is saved as a manifest, a JSON list of its entries (path, type, mode,
+owner, mtime, xattrs), where regular files refer to objects named by the
+sha256 of their content and metadata. Each object is stored once, however
+many manifests refer to it, and trees are materialized by reflinking the
+objects where the filesystem allows, copying them otherwise, never by
+hardlinking them, so writing to a materialized file cannot change the store.
+gc() removes the objects no registered manifest refers to.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from . import locks
+from .trace_decorator import getLog, traceLog
+
+# ioctl cloning a file on btrfs and XFS, linux/fs.h
+FICLONE = 0x40049409
+
+# see https://bford.info/cachedir/
+CACHEDIR_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+_TYPES = [
+    (stat.S_ISDIR, 'd'),
+    (stat.S_ISREG, 'f'),
+    (stat.S_ISLNK, 'l'),
+    (stat.S_ISCHR, 'c'),
+    (stat.S_ISBLK, 'b'),
+    (stat.S_ISFIFO, 'p'),
+]
+_NODE_TYPES = {'c': stat.S_IFCHR, 'b': stat.S_IFBLK, 'p': stat.S_IFIFO}
+
+# xattr functions are missing in python 2
+_listxattr = getattr(os, 'listxattr', None)
+
+
+def _file_type(mode):
+    for test, name in _TYPES:
+        if test(mode):
+            return name
+    return None
+
+
+def _xattrs(path):
+    if _listxattr is None:
+        return {}
+    try:
+        return dict((name, os.getxattr(path, name, follow_symlinks=False).hex())
+                    for name in _listxattr(path, follow_symlinks=False))
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.ENODATA):
+            return {}
+        raise
+
+
+def _set_metadata(path, entry, follow_symlinks=True):
+    if entry['type'] == 'l':
+        os.lchown(path, entry['uid'], entry['gid'])
+    else:
+        os.chown(path, entry['uid'], entry['gid'])
+        os.chmod(path, entry['mode'])
+        os.utime(path, (entry['mtime'], entry['mtime']))
+    if _listxattr is None:
+        return
+    for name, value in entry.get('xattrs', {}).items():
+        try:
+            os.setxattr(path, name, bytes.fromhex(value), follow_symlinks=follow_symlinks)
+        except OSError as e:
+            getLog().debug("Cannot set %s on %s: %s", name, path, e)
+
+
+def _is_cache_dir(path):
+    try:
+        with open(os.path.join(path, 'CACHEDIR.TAG'), 'rb') as f:
+            return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+    except (IOError, OSError):
+        return False
+
+
+class ObjectStore(object):
+    """objects and registered manifests under path"""
+    def __init__(self, path, state=None):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.manifests = os.path.join(path, 'manifests')
+        self.lock = locks.Lock(os.path.join(path, 'store.lock'), 'rootcache store', state)
+        # cleared when the filesystem turns out not to support FICLONE
+        self._can_clone = True
+
+    def _object_path(self, key):
+        return os.path.join(self.objects, key[:2], key[2:])
+
+    def _clone(self, src, dst):
+        """reflink src to new file dst, False when not supported"""
+        if not self._can_clone:
+            return False
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return True
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+                    raise
+                self._can_clone = False
+                return False
+
+    def _copy(self, src, dst):
+        if not self._clone(src, dst):
+            shutil.copyfile(src, dst)
+
+    def _add_file(self, path, entry):
+        """store the file path with the metadata of entry, return its key"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        digest.update(json.dumps([entry['mode'], entry['uid'], entry['gid'], entry['mtime'],
+                                  sorted(entry['xattrs'].items())]).encode())
+        key = digest.hexdigest()
+        target = self._object_path(key)
+        if not os.path.exists(target):
+            directory = os.path.dirname(target)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+            os.close(fd)
+            try:
+                self._copy(path, tmp)
+                _set_metadata(tmp, entry)
+                os.rename(tmp, target)
+            except:
+                os.unlink(tmp)
+                raise
+        return key
+
+    def _walk(self, root, exclude):
+        """entries of the tree root, like tar --one-file-system --exclude-caches-under"""
+        root_dev = os.lstat(root).st_dev
+        inodes = {}
+        stack = ['.']
+        while stack:
+            rel = stack.pop()
+            path = os.path.normpath(os.path.join(root, rel))
+            st = os.lstat(path)
+            kind = _file_type(st.st_mode)
+            if kind is None:
+                continue
+            entry = {'path': rel, 'type': kind, 'mode': stat.S_IMODE(st.st_mode),
+                     'uid': st.st_uid, 'gid': st.st_gid, 'mtime': st.st_mtime, 'xattrs': _xattrs(path)}
+            if kind == 'f' and st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in inodes:
+                    entry = {'path': rel, 'type': 'h', 'target': inodes[(st.st_dev, st.st_ino)]}
+                else:
+                    inodes[(st.st_dev, st.st_ino)] = rel
+            if entry['type'] == 'f':
+                entry['object'] = self._add_file(path, entry)
+            elif kind == 'l':
+                entry['target'] = os.readlink(path)
+            elif kind in ('c', 'b'):
+                entry['rdev'] = st.st_rdev
+            yield entry
+            if kind == 'd' and st.st_dev == root_dev and not (rel != '.' and _is_cache_dir(path)):
+                for name in sorted(os.listdir(path), reverse=True):
+                    child = os.path.normpath(os.path.join(rel, name))
+                    if child not in exclude:
+                        stack.append(child)
+
+    @traceLog()
+    def save(self, root, manifest, exclude=()):
+        """store the tree root and write its manifest; paths in exclude are
+        relative to root"""
+        exclude = set(os.path.normpath(path.lstrip('/')) for path in exclude)
+        for directory in (self.objects, self.manifests):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        # gc() must not run before the new objects are referenced
+        with self.lock.held(exclusive=False):
+            entries = list(self._walk(root, exclude))
+            fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(manifest))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, separators=(',', ':'))
+            os.rename(tmp, manifest)
+            self.register(manifest)
+        return entries
+
+    def register(self, manifest):
+        """protect the objects of manifest from gc() while it exists"""
+        manifest = os.path.abspath(manifest)
+        link = os.path.join(self.manifests, hashlib.sha1(manifest.encode()).hexdigest())
+        if os.path.islink(link):
+            os.unlink(link)
+        os.symlink(manifest, link)
+
+    @traceLog()
+    def materialize(self, manifest, root):
+        """create the tree of manifest in root, reflinking the objects
+        (copying them where not supported)"""
+        with open(manifest) as f:
+            entries = json.load(f)
+        directories = []
+        with self.lock.held(exclusive=False):
+            for entry in entries:
+                path = os.path.normpath(os.path.join(root, entry['path']))
+                kind = entry['type']
+                if kind == 'd':
+                    if not os.path.isdir(path):
+                        os.mkdir(path)
+                    directories.append((path, entry))
+                    continue
+                if os.path.lexists(path):
+                    os.unlink(path)
+                if kind == 'f':
+                    self._copy(self._object_path(entry['object']), path)
+                elif kind == 'h':
+                    os.link(os.path.join(root, entry['target']), path)
+                    continue
+                elif kind == 'l':
+                    os.symlink(entry['target'], path)
+                    _set_metadata(path, entry, follow_symlinks=False)
+                    continue
+                else:
+                    os.mknod(path, entry['mode'] | _NODE_TYPES[kind], entry.get('rdev', 0))
+                _set_metadata(path, entry)
+        # creating the content changed the mtime of the directories
+        for path, entry in reversed(directories):
+            _set_metadata(path, entry)
+
+    @traceLog()
+    def gc(self):
+        """remove the objects of no registered manifest, return their number
+        and size, or None when the store is in use"""
+        if not self.lock.acquire(exclusive=True, timeout=0):
+            getLog().debug("Root cache store in use, skipping garbage collection")
+            return None
+        try:
+            referenced = set()
+            for name in os.listdir(self.manifests):
+                link = os.path.join(self.manifests, name)
+                try:
+                    with open(link) as f:
+                        referenced.update(e['object'] for e in json.load(f) if 'object' in e)
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # the manifest was removed, e.g. by --scrub
+                    os.unlink(link)
+            removed = size = 0
+            for prefix in os.listdir(self.objects):
+                directory = os.path.join(self.objects, prefix)
+                for name in os.listdir(directory):
+                    if prefix + name not in referenced:
+                        path = os.path.join(directory, name)
+                        size += os.lstat(path).st_size
+                        os.unlink(path)
+                        removed += 1
+            getLog().debug("Removed %d unreferenced objects (%d bytes) from %s", removed, size, self.path)
+            return removed, size
+        finally:
+            self.lock.release()
@@ -6,10 +6,10 @@ import os.path
 import shutil
 from textwrap import dedent
 
-import distro
 # pylint: disable=redefined-builtin
 from six.moves import input
 
+from . import hostfacts
 from . import util
 from .exception import BuildError, Error, YumError
 from .trace_decorator import traceLog
@@ -23,7 +23,7 @@ def package_manager(config_opts, buildroot, plugins, bootstrap_buildroot=None):
         if os.path.isfile(config_opts['dnf_command']) or bootstrap_buildroot is not None:
             return Dnf(config_opts, buildroot, plugins, bootstrap_buildroot)
         # RHEL without DNF and without bootstrap buildroot
-        (distribution, version) = distro.linux_distribution(full_distribution_name=False)[0:2]
+        (distribution, version) = hostfacts.distribution()
         if distribution in ['redhat', 'rhel', 'centos', 'ol']:
             version = int(version.split('.')[0])
             if version < 8:
@@ -3,12 +3,20 @@
 
 import imp
 
+from . import startup
 from .exception import Error
 from .trace_decorator import traceLog
 
 current_api_version = '1.1'
 
 
+def _hook_name(hook):
+    owner = getattr(hook, '__self__', None)
+    if owner is not None:
+        return "%s.%s" % (type(owner).__name__, hook.__name__)
+    return getattr(hook, '__name__', repr(hook))
+
+
 class Plugins(object):
     @traceLog()
     def __init__(self, config, state):
@@ -40,6 +48,7 @@ class Plugins(object):
                 self.plugin_conf[key]['resultdir'] = buildroot.resultdir
 
         self.state.start("init plugins")
+        startup.mark("construct buildroot" + (" (bootstrap)" if buildroot.is_bootstrap else ""))
         # Import plugins  (simplified copy of what yum does). Can add yum
         # features later when we prove we need them.
         for plugin in self.plugins:
@@ -63,6 +72,7 @@ class Plugins(object):
                                 % (requested_api_version, current_api_version))
 
                 module.init(self, self.plugin_conf["{0}_opts".format(plugin)], buildroot)
+                startup.mark("plugin " + plugin)
         self.state.finish("init plugins")
 
     @traceLog()
@@ -75,7 +85,8 @@ class Plugins(object):
             raise Error(
                 "Feature {0} is not provided by any of enabled plugins".format(stage))
         for hook in hooks:
-            hook(*args, **kwargs)
+            with self.state.span("%s hook %s" % (stage, _hook_name(hook))):
+                hook(*args, **kwargs)
 
     @traceLog()
     def add_hook(self, stage, function):
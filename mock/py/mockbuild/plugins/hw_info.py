@@ -5,6 +5,8 @@
 # python library imports
 import codecs
 
+from six import PY3
+
 # our imports
 from mockbuild.trace_decorator import getLog, traceLog
 import mockbuild.util
@@ -37,20 +39,22 @@ class HwInfo(object):
         out_file = self.buildroot.resultdir + '/hw_info.log'
         out = codecs.open(out_file, 'w', 'utf-8', 'replace')
 
-        cmd = ["/usr/bin/lscpu"]
-        output = mockbuild.util.do(cmd, shell=False, returnOutput=True, raiseExc=False)
-        out.write("CPU info:\n")
-        out.write(output)
-
-        cmd = ["/usr/bin/free"]
-        output = mockbuild.util.do(cmd, shell=False, returnOutput=True, raiseExc=False)
-        out.write("\n\nMemory:\n")
-        out.write(output)
-
-        cmd = ["/usr/bin/df", "-H", self.buildroot.make_chroot_path()]
-        output = mockbuild.util.do(cmd, shell=False, returnOutput=True, raiseExc=False)
-        out.write("\n\nStorage:\n")
-        out.write(output)
+        commands = [
+            ("CPU info:\n", ["/usr/bin/lscpu"]),
+            ("\n\nMemory:\n", ["/usr/bin/free"]),
+            ("\n\nStorage:\n", ["/usr/bin/df", "-H", self.buildroot.make_chroot_path()]),
+        ]
+        if PY3:
+            # the probes are independent, run them at once
+            from mockbuild import aio
+            outputs = aio.run(*[aio.do(cmd, shell=False, returnOutput=True, raiseExc=False)
+                                for _, cmd in commands])
+        else:
+            outputs = [mockbuild.util.do(cmd, shell=False, returnOutput=True, raiseExc=False)
+                       for _, cmd in commands]
+        for (title, _), output in zip(commands, outputs):
+            out.write(title)
+            out.write(output)
 
         out.close()
         self.buildroot.uid_manager.changeOwner(out_file, gid=self.config['chrootgid'])
@@ -1,14 +1,11 @@
 # -*- coding: utf-8 -*-
 # vim: noai:ts=4:sw=4:expandtab
 
-import errno
-import fcntl
 import os
 import re
 from textwrap import dedent
-import time
 
-from mockbuild import mounts, util
+from mockbuild import locks, mounts, util
 from mockbuild.exception import LvmError, LvmLocked
 
 requires_api_version = "1.1"
@@ -29,37 +26,44 @@ def current_mounts():
         yield src, target
 
 
-class Lock(object):
-    def __init__(self, path, name, sleep_time):
+class Lock(locks.Lock):
+    def __init__(self, path, name, state, sleep_time):
         lock_name = '.{0}.lock'.format(name)
-        lock_path = os.path.join(path, lock_name)
-        self.lock_file = open(lock_path, 'a+')
+        super(Lock, self).__init__(os.path.join(path, lock_name), name, state)
         self.sleep_time = sleep_time
 
     def lock(self, exclusive, block=False):
-        lock_type = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
-        try:
-            fcntl.lockf(self.lock_file.fileno(),
-                        lock_type | (0 if block else fcntl.LOCK_NB))
-        except IOError as e:
-            if e.errno in (errno.EACCES, errno.EAGAIN):
-                raise LvmLocked("LVM is locked")
-            raise
+        if not self.acquire(exclusive, timeout=None if block else 0):
+            raise LvmLocked("LVM is locked")
 
     def cond_lock(self, cond_fn, acquired_fn, wait_fn=None, unsatisfied_fn=None):
-        waiting = False
-        while cond_fn():
-            try:
-                self.lock(exclusive=True)
-            except LvmLocked:
-                if not waiting and wait_fn:
-                    wait_fn()
+        # other mocks keep the lock shared for their whole build, so wait for
+        # it only sleep_time at a time and check whether one of them did the
+        # work meanwhile
+        state = self.state
+        wait_state = "Waiting for {0} lock".format(self.name)
+        waiting = satisfied = False
+        try:
+            while cond_fn():
+                if self.acquire(exclusive=True, timeout=self.sleep_time if waiting else 0):
+                    # someone else might have done it just before we got the lock
+                    satisfied = cond_fn()
+                    break
+                if not waiting:
                     waiting = True
-                time.sleep(self.sleep_time)
-            else:
-                acquired_fn()
-                return
-        if unsatisfied_fn:
+                    if wait_fn:
+                        wait_fn()
+                    # one wait state for the whole loop, not one per attempt
+                    if state:
+                        state.start(wait_state)
+                    self.state = None
+        finally:
+            self.state = state
+            if waiting and state:
+                state.finish(wait_state)
+        if satisfied:
+            acquired_fn()
+        elif unsatisfied_fn:
             unsatisfied_fn()
 
 
@@ -76,7 +80,6 @@ class LvmPlugin(object):
         self.ext = self.buildroot.config.get('unique-ext', 'head')
         self.head_lv = '+{0}.{1}'.format(self.conf_id, self.ext)
         self.fs_type = lvm_conf.get('filesystem', 'ext4')
-        self.sleep_time = lvm_conf.get('sleep_time', 1)
         self.root_path = os.path.realpath(self.buildroot.make_chroot_path())
         if not self.vg_name:
             raise LvmError("Volume group must be specified")
@@ -84,6 +87,7 @@ class LvmPlugin(object):
         snapinfo_name = '.snapinfo-{0}.{1}'.format(self.conf_id, self.ext)
         self.basepath = buildroot.mockdir
         self.snap_info = os.path.join(self.basepath, snapinfo_name)
+        self.sleep_time = lvm_conf.get('sleep_time', 1)
         self.lock = self.create_lock('lvm')
         self.pool_lock = self.create_lock('lmv-pool')
         self.mount = None
@@ -96,7 +100,8 @@ class LvmPlugin(object):
                 plugins.add_hook(hook_name, method)
 
     def create_lock(self, name):
-        return Lock(self.basepath, '{0}-{1}'.format(name, self.conf_id), self.sleep_time)
+        return Lock(self.basepath, '{0}-{1}'.format(name, self.conf_id), self.buildroot.state,
+                    self.sleep_time)
 
     def prefix_name(self, name=''):
         return self.conf_id + '.' + name
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import os
+import tempfile
+
+# our imports
+from mockbuild.exception import Error
+from mockbuild.trace_decorator import getLog, traceLog
+import mockbuild.util
+
+requires_api_version = "1.1"
+
+YUM_CACHE_LOCK_STATE = "Waiting for yumcache lock"
+
+
+# plugin entry point
+@traceLog()
+def init(plugins, conf, buildroot):
+    if not buildroot.is_bootstrap:
+        Metrics(plugins, conf, buildroot)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metrics(object):
+    """writes metrics of the run for the node_exporter textfile collector"""
+    # pylint: disable=too-few-public-methods
+    @traceLog()
+    def __init__(self, plugins, conf, buildroot):
+        self.buildroot = buildroot
+        self.config = buildroot.config
+        self.state = buildroot.state
+        self.metrics_opts = conf
+        self.filename = os.path.join(self.metrics_opts['dir'], self.metrics_opts['file'] % self.metrics_opts)
+        self.pm_invocations = 0
+        plugins.add_hook("preyum", self._metricsPreYumHook)
+        plugins.add_hook("postinit", self._write_metrics)
+        plugins.add_hook("postbuild", self._write_metrics)
+
+    @traceLog()
+    def _metricsPreYumHook(self):
+        self.pm_invocations += 1
+
+    def _resultdir_bytes(self, since):
+        """size of the files in resultdir written by this run"""
+        total = 0
+        for dirpath, _, filenames in os.walk(self.buildroot.resultdir):
+            for filename in filenames:
+                try:
+                    statinfo = os.lstat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                if statinfo.st_mtime >= since:
+                    total += statinfo.st_size
+        return total
+
+    def _metrics(self):
+        timeline = self.state.timeline
+        labels = 'root="%s"' % _escape(self.config['root'])
+        phases = {}
+        lock_wait = 0.0
+        for span in timeline.to_json()['spans']:
+            key = (span['name'], span['bootstrap'])
+            phases[key] = phases.get(key, 0.0) + span['duration']
+            if span['name'] == YUM_CACHE_LOCK_STATE:
+                lock_wait += span['duration']
+
+        yield '# HELP mock_last_run_timestamp_seconds Time the last mock run started.'
+        yield '# TYPE mock_last_run_timestamp_seconds gauge'
+        yield 'mock_last_run_timestamp_seconds{%s} %f' % (labels, timeline.wall_origin)
+        yield '# HELP mock_build_success Whether the last build succeeded.'
+        yield '# TYPE mock_build_success gauge'
+        yield 'mock_build_success{%s} %d' % (labels, self.state.result == 'success')
+        yield '# HELP mock_build_result Result of the last run (unknown, success or fail).'
+        yield '# TYPE mock_build_result gauge'
+        for result in ('unknown', 'success', 'fail'):
+            yield 'mock_build_result{%s,result="%s"} %d' % (labels, result, self.state.result == result)
+        yield '# HELP mock_phase_duration_seconds Time spent in the phases of the last run.'
+        yield '# TYPE mock_phase_duration_seconds gauge'
+        for (name, bootstrap), duration in sorted(phases.items()):
+            yield 'mock_phase_duration_seconds{%s,phase="%s",bootstrap="%s"} %f' % (
+                labels, _escape(name), str(bootstrap).lower(), duration)
+        status = getattr(self.buildroot, 'root_cache_status', None)
+        if status is not None:
+            yield '# HELP mock_root_cache Root cache hit, miss or rebuild in the last run.'
+            yield '# TYPE mock_root_cache gauge'
+            for value in ('hit', 'miss', 'rebuild'):
+                yield 'mock_root_cache{%s,status="%s"} %d' % (labels, value, status == value)
+        yield '# HELP mock_yum_cache_lock_wait_seconds Time spent waiting for the yum cache lock.'
+        yield '# TYPE mock_yum_cache_lock_wait_seconds gauge'
+        yield 'mock_yum_cache_lock_wait_seconds{%s} %f' % (labels, lock_wait)
+        yield '# HELP mock_package_manager_invocations Package manager commands run in the last run.'
+        yield '# TYPE mock_package_manager_invocations gauge'
+        yield 'mock_package_manager_invocations{%s} %d' % (labels, self.pm_invocations)
+        yield '# HELP mock_resultdir_written_bytes Size of the files written to resultdir.'
+        yield '# TYPE mock_resultdir_written_bytes gauge'
+        yield 'mock_resultdir_written_bytes{%s} %d' % (labels, self._resultdir_bytes(timeline.wall_origin))
+
+    @traceLog()
+    def _write_metrics(self):
+        # the collector may read at any time, replace the file atomically
+        directory = os.path.dirname(self.filename)
+        try:
+            mockbuild.util.mkdirIfAbsent(directory)
+            fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(self._metrics()) + '\n')
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError, Error) as e:
+            getLog().warning("Cannot write metrics to %s: %s", self.filename, e)
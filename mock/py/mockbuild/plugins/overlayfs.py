@@ -126,6 +126,8 @@
 # - they mostly call SNAPSHOTS methods and other internal methods
 # - additional locking is performed, to make sure, they are not concurently used
 #   in a way, which could lead to corruption of internal file structures.
+# - several mocks may use mounted root at once, it is unmounted (or remounted
+#   to make postinit snapshot) only when no other mock uses it
 # - I also tried to make these only methods, which contain mock specific code...
 
 
@@ -136,6 +138,8 @@ import subprocess
 import uuid
 import re
 
+from mockbuild import locks
+
 requires_api_version = "1.1"
 
 def init(plugins, conf, buildroot):
@@ -158,6 +162,7 @@ class OverlayFsPlugin(object):
         self.touchRpmdbEnabled = conf.get('touch_rpmdb')
         if not self.touchRpmdbEnabled:
             self.touchRpmdbEnabled = False
+        self.locks = {}
         plugins.add_hook("make_snapshot", self.hook_make_snapshot)
         plugins.add_hook("remove_snapshot", self.hook_remove_snapshot)
         plugins.add_hook("rollback_to", self.hook_rollback_to)
@@ -235,6 +240,10 @@ class OverlayFsPlugin(object):
     def getMountLockFile(self):
         return os.path.join(self.getLocksDir(), "mount.lock")
 
+    # lock file held (shared) by every mock using mounted root
+    def getRootLockFile(self):
+        return os.path.join(self.getLocksDir(), "root.lock")
+
 
     # directory used as workdir for overlayfs
     def getWorkDir(self):
@@ -607,31 +616,48 @@ class OverlayFsPlugin(object):
         isRootMounted = os.path.exists(rootMountFlagFile)
         return isRootMounted
 
+    def getLock(self, lockFile, name):
+        if lockFile not in self.locks:
+            # older versions used directories as locks
+            if os.path.isdir(lockFile):
+                os.rmdir(lockFile)
+            self.locks[lockFile] = locks.Lock(lockFile, name, self.buildroot.state)
+        return self.locks[lockFile]
+
     # lock on snapshot operations ( used to prevent concurent modification of
-    # refs/layers by mock )
-    def snapshotLock(self):
-        snapshotLockFile = self.getSnapshotLockFile()
-        try:
-            os.mkdir(snapshotLockFile)
-        except OSError:
-            raise Exception("Failed to obtain snapshot lock !")
+    # refs/layers by mock ), snapshots are not changed while root is mounted
+    def snapshotLock(self, allowMounted=False):
+        lock = self.getLock(self.getSnapshotLockFile(), "overlayfs snapshot")
+        lock.acquire(exclusive=True)
+        if not allowMounted and self.isRootMounted():
+            lock.release()
+            raise Exception("Root is mounted, umount it first !")
 
     def snapshotUnlock(self):
-        snapshotLockFile = self.getSnapshotLockFile()
-        if os.path.exists(snapshotLockFile):
-            os.rmdir(snapshotLockFile)
+        self.getLock(self.getSnapshotLockFile(), "overlayfs snapshot").release()
 
     # lock on mount operations
     def mountLock(self):
-        mountLockFile = self.getMountLockFile()
-        try:
-            os.mkdir(mountLockFile)
-        except OSError:
-            raise Exception("Failed to obtain mount lock !")
+        self.getLock(self.getMountLockFile(), "overlayfs mount").acquire(exclusive=True)
 
     def mountUnlock(self):
-        mountLockFile = self.getMountLockFile()
-        os.rmdir(mountLockFile)
+        self.getLock(self.getMountLockFile(), "overlayfs mount").release()
+
+    # root lock is held shared from mount_root until root is unmounted, so
+    # mocks sharing mounted root know whether they are the last one using it;
+    # it is only taken exclusively (and never waited for) under mount lock
+    def rootLock(self):
+        return self.getLock(self.getRootLockFile(), "overlayfs root")
+
+    # True (and root lock held exclusively) if no other mock uses root
+    def rootLockExclusive(self):
+        lock = self.rootLock()
+        if lock.acquire(exclusive=True, timeout=0):
+            return True
+        # failed conversion of flock(2) lock drops it, take it again
+        if lock.exclusive is not None:
+            lock.acquire(exclusive=False)
+        return False
 
     def traceHook(self, name):
         if self.traceHooks:
@@ -695,7 +721,7 @@ class OverlayFsPlugin(object):
     def hook_list_snapshots(self):
         self.traceHook("hook_list_snapshots")
         self.basicInit()
-        self.snapshotLock()
+        self.snapshotLock(allowMounted=True)
         try:
             self.initLayers()
             snapshots = self.listSnapshots()
@@ -717,12 +743,21 @@ class OverlayFsPlugin(object):
         self.basicInit()
         self.mountLock()
         try:
-            # prevent snapshot operations (by mock) while root is mounted
-            self.snapshotLock()
-            self.initLayers()
-            self.mountRoot()
-            if self.touchRpmdbEnabled:
-                self.touchRpmdb()
+            # another mock may use the same root, it is unmounted by last one
+            self.rootLock().acquire(exclusive=False)
+            # snapshot operations (by mock) are refused while root is mounted
+            self.snapshotLock(allowMounted=True)
+            try:
+                self.initLayers()
+                # flag left by mock which did not unmount root (e.g. reboot)
+                if self.isRootMounted() and not os.path.ismount(self.getRootDir()):
+                    self.recordRootMounted(False)
+                if not self.isRootMounted():
+                    self.mountRoot()
+                    if self.touchRpmdbEnabled:
+                        self.touchRpmdb()
+            finally:
+                self.snapshotUnlock()
         finally:
             self.mountUnlock()
 
@@ -735,9 +770,13 @@ class OverlayFsPlugin(object):
             self.mountLock()
             try:
                 self.buildroot.mounts.umountall()
-                self.unmountRoot()
-                # again allow snapshot operations (by mock) after unmount
-                self.snapshotUnlock()
+                try:
+                    if self.rootLockExclusive():
+                        self.unmountRoot()
+                    else:
+                        self.buildroot.root_log.info("Overlayfs root is used by another mock, not unmounting it")
+                finally:
+                    self.rootLock().release()
             finally:
                 self.mountUnlock()
 
@@ -750,9 +789,13 @@ class OverlayFsPlugin(object):
             self.mountLock()
             try:
                 self.buildroot.mounts.umountall()
-                self.unmountRoot()
-                # again allow snapshot operations (by mock) after unmount
-                self.snapshotUnlock()
+                try:
+                    if self.rootLockExclusive():
+                        self.unmountRoot()
+                    else:
+                        self.buildroot.root_log.info("Overlayfs root is used by another mock, not unmounting it")
+                finally:
+                    self.rootLock().release()
             finally:
                 self.mountUnlock()
 
@@ -766,23 +809,28 @@ class OverlayFsPlugin(object):
         self.mountLock()
         try:
             if self.isRootMounted():
-                # we do not acquire snapshot lock here, because fact that root
-                # is mounted means it was already acquired by mount_root hook
-
-                postinitSnapshotName = self.getPostinitLayerRef()
-                # if postinit snapshot was not created yet...
-                if not self.refExists(postinitSnapshotName):
-                    # unmount everything, so we can do snapshot
-                    self.buildroot.mounts.umountall()
-                    self.unmountRoot()
-                    # do snapshot
-                    self.initLayers()
-                    self.createSnapshot(postinitSnapshotName)
-                    # mount everything again
-                    self.mountRoot()
-                    self.buildroot.mounts.mountall_managed()
-                    if self.touchRpmdbEnabled:
-                        self.touchRpmdb()
+                self.snapshotLock(allowMounted=True)
+                try:
+                    postinitSnapshotName = self.getPostinitLayerRef()
+                    # if postinit snapshot was not created yet (and root can be
+                    # unmounted, i.e. no other mock uses it)...
+                    if not self.refExists(postinitSnapshotName) and self.rootLockExclusive():
+                        try:
+                            # unmount everything, so we can do snapshot
+                            self.buildroot.mounts.umountall()
+                            self.unmountRoot()
+                            # do snapshot
+                            self.initLayers()
+                            self.createSnapshot(postinitSnapshotName)
+                            # mount everything again
+                            self.mountRoot()
+                            self.buildroot.mounts.mountall_managed()
+                            if self.touchRpmdbEnabled:
+                                self.touchRpmdb()
+                        finally:
+                            self.rootLock().acquire(exclusive=False)
+                finally:
+                    self.snapshotUnlock()
         finally:
             self.mountUnlock()
 
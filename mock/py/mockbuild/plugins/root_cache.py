@@ -6,15 +6,87 @@
 
 # python library imports
 import fcntl
+import glob
+import hashlib
+import json
 import os
+import re
+import shutil
+import tempfile
 import time
 
 # our imports
+from mockbuild import locks
+from mockbuild.exception import Error
+from mockbuild.objectstore import FICLONE, ObjectStore
 from mockbuild.trace_decorator import getLog, traceLog
 import mockbuild.util
 
 requires_api_version = "1.1"
 
+# compression programs tar can use for the cache, by preference for 'auto',
+# and the extension of what they write
+CODECS = [
+    ('zstd', '.zst'),
+    ('pigz', '.gz'),
+    ('gzip', '.gz'),
+    ('pixz', '.xz'),
+    ('xz', '.xz'),
+]
+AUTO_CODECS = ('zstd', 'pigz', 'gzip')
+
+# the config options which decide the content of the cache
+CACHE_KEY_OPTS = ('chroot_setup_cmd', 'chroot_additional_packages', 'module_enable', 'module_install',
+                  'yum.conf', 'dnf.conf', 'releasever', 'target_arch', 'package_manager')
+
+# inode number of the root directory of each btrfs subvolume
+BTRFS_SUBVOLUME_INO = 256
+
+
+def _available(program):
+    return os.path.exists(os.path.join('/usr/bin', program))
+
+
+def compress_command(program, level=None, threads=0, zstd_long=False):
+    """the --use-compress-program value for program, tar adds -d to unpack;
+    threads 0 means one per CPU"""
+    args = [program]
+    if program == 'zstd':
+        args += ['-q', '-T%d' % threads]
+        if level is not None and level > 19:
+            args.append('--ultra')
+        if zstd_long is True:
+            args.append('--long')
+        elif zstd_long:
+            args.append('--long=%d' % zstd_long)
+    elif program == 'xz':
+        args.append('-T%d' % threads)
+    elif program in ('pigz', 'pixz') and threads:
+        args += ['-p', str(threads)]
+    if level is not None:
+        args.append('-%d' % level)
+    return ' '.join(args)
+
+
+def _can_reflink(src_dir, dst_dir):
+    """whether files in src_dir can be cloned to dst_dir"""
+    try:
+        with tempfile.TemporaryFile(dir=src_dir) as src, tempfile.TemporaryFile(dir=dst_dir) as dst:
+            src.write(b'x')
+            src.flush()
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _is_subvolume(path):
+    try:
+        return (os.stat(path).st_ino == BTRFS_SUBVOLUME_INO
+                and mockbuild.util.get_fs_type(path) == 'btrfs')
+    except OSError:
+        return False
+
 
 # plugin entry point
 @traceLog()
@@ -32,17 +104,34 @@ class RootCache(object):
         self.config = buildroot.config
         self.state = buildroot.state
         self.rootSharedCachePath = self.root_cache_opts['dir'] % self.root_cache_opts
-        self.rootCacheFile = os.path.join(self.rootSharedCachePath, "cache.tar")
+        # the cache of these options, next to the caches of other options
+        self.rootCacheDir = self.rootSharedCachePath
+        if self.root_cache_opts.get('content_key', True):
+            self.cacheInputs = self._cache_inputs()
+            key = hashlib.sha256(json.dumps(self.cacheInputs, sort_keys=True).encode()).hexdigest()[:16]
+            self.rootCacheDir = os.path.join(self.rootSharedCachePath, "variants", key)
+        self.rootCacheFile = os.path.join(self.rootCacheDir, "cache.tar")
+        # the cache unpacked, restored by snapshot or reflinks when possible
+        self.rootCacheTree = os.path.join(self.rootCacheDir, "root")
         self.rootCacheLock = None
         self.compressProgram = self.root_cache_opts['compress_program']
-        if self.compressProgram == 'pigz' and not os.path.exists('/usr/bin/pigz'):
-            getLog().warning("specified 'pigz' as the root cache compress program but not available; using gzip")
-            self.compressProgram = 'gzip'
+        extensions = dict(CODECS)
+        if self.compressProgram in extensions and not _available(self.compressProgram):
+            getLog().warning("specified '%s' as the root cache compress program but not available; using auto",
+                             self.compressProgram)
+            self.compressProgram = 'auto'
+        if self.compressProgram == 'auto':
+            self.compressProgram = next((p for p in AUTO_CODECS if _available(p)), 'gzip')
         if self.compressProgram:
-            self.compressArgs = ['--use-compress-program', self.compressProgram]
-            self.rootCacheFile = self.rootCacheFile + self.root_cache_opts['extension']
+            self.compressArgs = ['--use-compress-program', self.compress_command(self.compressProgram)]
+            self.rootCacheFile = self.rootCacheFile + (self.root_cache_opts.get('extension') or
+                                                       extensions.get(self.compressProgram, ''))
         else:
             self.compressArgs = []
+        self.store = None
+        if self.root_cache_opts.get('backend', 'tar') == 'store':
+            self.store = ObjectStore(self.root_cache_opts['store_dir'] % self.root_cache_opts, self.state)
+            self.rootCacheFile = os.path.join(self.rootCacheDir, "cache.manifest")
         plugins.add_hook("preinit", self._rootCachePreInitHook)
         plugins.add_hook("preshell", self._rootCachePreShellHook)
         plugins.add_hook("prechroot", self._rootCachePreShellHook)
@@ -54,24 +143,189 @@ class RootCache(object):
         self.exclude_dirs = self.root_cache_opts['exclude_dirs']
         self.exclude_tar_cmds = ["--exclude=" + item for item in self.exclude_dirs]
 
+    def compress_command(self, program):
+        return compress_command(program,
+                                self.root_cache_opts.get('compress_level'),
+                                self.root_cache_opts.get('compress_threads', 0),
+                                self.root_cache_opts.get('zstd_long', False))
+
     # =============
     # 'Private' API
     # =============
+    def _cache_inputs(self):
+        inputs = dict((key, self.config.get(key)) for key in CACHE_KEY_OPTS)
+        if self.root_cache_opts.get('key_repo_revision', False):
+            inputs['repo_revisions'] = self._repo_revisions()
+        return inputs
+
+    def _repo_revisions(self):
+        """revision of the repo metadata last downloaded to the yum_cache dir"""
+        yum_cache_opts = dict(self.config['plugin_conf']['yum_cache_opts'],
+                              package_manager=self.config['package_manager'])
+        cache_dir = yum_cache_opts['dir'] % yum_cache_opts
+        revisions = {}
+        for repomd in glob.glob(os.path.join(cache_dir, '*', 'repodata', 'repomd.xml')):
+            try:
+                with open(repomd, 'rb') as f:
+                    content = f.read()
+            except (IOError, OSError):
+                continue
+            match = re.search(br'<revision>([^<]*)</revision>', content)
+            revision = match.group(1) if match else hashlib.sha256(content).hexdigest().encode()
+            revisions[os.path.relpath(repomd, cache_dir)] = revision.decode('utf-8', 'replace')
+        return revisions
+
+    def _mark_used(self):
+        """for the eviction of the least recently used variants"""
+        if self.rootCacheDir != self.rootSharedCachePath:
+            try:
+                os.utime(self.rootCacheDir, None)
+            except OSError as e:
+                getLog().debug("Cannot touch %s: %s", self.rootCacheDir, e)
+
     @traceLog()
-    def _rootCacheLock(self, shared=1):
-        lockType = fcntl.LOCK_EX
-        if shared:
-            lockType = fcntl.LOCK_SH
+    def _evict_variants(self):
+        """keep only max_variants most recently used caches of the chroot"""
+        limit = self.root_cache_opts.get('max_variants', 3)
+        variants_dir = os.path.join(self.rootSharedCachePath, "variants")
+        if not limit or not os.path.isdir(variants_dir):
+            return
+        variants = [os.path.join(variants_dir, name) for name in os.listdir(variants_dir)]
+        variants.sort(key=lambda path: os.stat(path).st_mtime, reverse=True)
+        for path in variants[limit:]:
+            if path == self.rootCacheDir:
+                continue
+            getLog().info("removing least recently used root cache variant %s", os.path.basename(path))
+            self._remove_tree(os.path.join(path, "root"))
+            mockbuild.util.rmtree(path)
+
+    def _remove_unkeyed_cache(self):
+        """the cache written before content_key was enabled"""
+        for extension in set([''] + [e for _, e in CODECS]):
+            path = os.path.join(self.rootSharedCachePath, "cache.tar" + extension)
+            if os.path.exists(path):
+                os.remove(path)
+        for name in ("cache.manifest", "cache.log"):
+            path = os.path.join(self.rootSharedCachePath, name)
+            if os.path.exists(path):
+                os.remove(path)
+        self._remove_tree(os.path.join(self.rootSharedCachePath, "root"))
+
+    def _other_caches(self, available_only=True):
+        """caches written with another compress program or backend before the
+        config changed, with the tar arguments to unpack them"""
+        base = os.path.join(self.rootCacheDir, "cache.tar")
+        seen = set([self.rootCacheFile])
+        for program, extension in CODECS:
+            path = base + extension
+            if path in seen or (available_only and not _available(program)):
+                continue
+            seen.add(path)
+            if os.path.exists(path):
+                command = compress_command(program, threads=self.root_cache_opts.get('compress_threads', 0),
+                                           zstd_long=self.root_cache_opts.get('zstd_long', False))
+                yield path, ['--use-compress-program', command]
+
+    @staticmethod
+    def _remove_tree(path):
+        if _is_subvolume(path):
+            try:
+                mockbuild.util.do(["btrfs", "subvolume", "delete", path], shell=False)
+            except (Error, OSError) as e:
+                getLog().debug("Cannot delete subvolume %s: %s", path, e)
+        if os.path.exists(path):
+            mockbuild.util.rmtree(path)
+
+    @traceLog()
+    def _update_cache_tree(self):
+        """unpack the new cache to rootCacheTree, if it can be restored cheaply"""
+        new_tree = self.rootCacheTree + ".new"
+        self._remove_tree(new_tree)
+        created = False
+        if mockbuild.util.get_fs_type(self.rootSharedCachePath) == 'btrfs':
+            try:
+                mockbuild.util.do(["btrfs", "subvolume", "create", new_tree], shell=False)
+                created = True
+            except (Error, OSError) as e:
+                getLog().debug("Cannot create subvolume %s: %s", new_tree, e)
+        if not created:
+            if not _can_reflink(self.rootSharedCachePath, self.rootSharedCachePath):
+                getLog().debug("%s supports neither snapshots nor reflinks, restoring the root cache with tar",
+                               self.rootSharedCachePath)
+                self._remove_tree(self.rootCacheTree)
+                return
+            os.mkdir(new_tree)
+        try:
+            mockbuild.util.do(["tar"] + self.compressArgs + ["-xf", self.rootCacheFile, "-C", new_tree],
+                              shell=False)
+        except:
+            self._remove_tree(new_tree)
+            raise
+        self._remove_tree(self.rootCacheTree)
+        os.rename(new_tree, self.rootCacheTree)
+
+    @traceLog()
+    def _restore_cache_tree(self):
+        """clone rootCacheTree to the chroot, False if it cannot be done"""
+        if not self.root_cache_opts.get('cow_restore', True) or not os.path.isdir(self.rootCacheTree):
+            return False
+        chroot = self.buildroot.make_chroot_path()
+        # the tmpdir with the nosync library is created in the chroot before
+        # preinit, keep a copy of it aside while the chroot is cloned
+        tmpdir = self.buildroot.tmpdir and self.buildroot.make_chroot_path(self.buildroot.tmpdir)
+        saved = None
+        if tmpdir and os.path.isdir(tmpdir):
+            saved = os.path.join(tempfile.mkdtemp(prefix='mock-root-cache-'), 'tmpdir')
+            shutil.copytree(tmpdir, saved, symlinks=True)
+            shutil.rmtree(tmpdir)
+            parent = os.path.dirname(tmpdir)
+            while parent != chroot and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
         try:
-            fcntl.lockf(self.rootCacheLock.fileno(), lockType | fcntl.LOCK_NB)
-        except IOError:
-            self.state.start("Waiting for rootcache lock")
-            fcntl.lockf(self.rootCacheLock.fileno(), lockType)
-            self.state.finish("Waiting for rootcache lock")
+            if os.listdir(chroot):
+                getLog().info("chroot is not empty, cannot clone %s", self.rootCacheTree)
+                restored = False
+            else:
+                restored = self._clone_cache_tree(chroot)
+            if not restored:
+                getLog().info("falling back to unpacking the root cache tarball")
+            return restored
+        finally:
+            if saved:
+                if os.path.isdir(tmpdir):
+                    shutil.rmtree(tmpdir)
+                shutil.copytree(saved, tmpdir, symlinks=True)
+                shutil.rmtree(os.path.dirname(saved))
+
+    def _clone_cache_tree(self, chroot):
+        if _is_subvolume(self.rootCacheTree) and not os.path.ismount(chroot):
+            os.rmdir(chroot)
+            try:
+                mockbuild.util.do(["btrfs", "subvolume", "snapshot", self.rootCacheTree, chroot], shell=False)
+                getLog().info("restored root cache as a snapshot of %s", self.rootCacheTree)
+                return True
+            except (Error, OSError) as e:
+                getLog().info("Cannot snapshot %s: %s", self.rootCacheTree, e)
+                mockbuild.util.mkdirIfAbsent(chroot)
+        if _can_reflink(self.rootSharedCachePath, chroot):
+            try:
+                mockbuild.util.do(["cp", "-a", "--reflink=always", self.rootCacheTree + "/.", chroot], shell=False)
+                getLog().info("restored root cache as reflinks to %s", self.rootCacheTree)
+                return True
+            except (Error, OSError) as e:
+                getLog().info("Cannot reflink %s: %s", self.rootCacheTree, e)
+        else:
+            getLog().info("Cannot reflink %s to %s", self.rootSharedCachePath, chroot)
+        return False
+
+    @traceLog()
+    def _rootCacheLock(self, shared=1):
+        self.rootCacheLock.acquire(exclusive=not shared)
 
     @traceLog()
     def _rootCacheUnlock(self):
-        fcntl.lockf(self.rootCacheLock.fileno(), fcntl.LOCK_UN)
+        self.rootCacheLock.release()
 
     @traceLog()
     def _rootCachePreInitHook(self):
@@ -85,34 +339,44 @@ class RootCache(object):
 
     @traceLog()
     def _unpack_root_cache(self):
+        cache_file, compress_args = self.rootCacheFile, self.compressArgs
+        if not os.path.exists(cache_file):
+            cache_file, compress_args = next(self._other_caches(), (cache_file, compress_args))
         # check cache status
         try:
             if self.root_cache_opts['age_check']:
                 # see if it aged out
-                statinfo = os.stat(self.rootCacheFile)
+                statinfo = os.stat(cache_file)
                 file_age_days = (time.time() - statinfo.st_ctime) / (60 * 60 * 24)
                 if file_age_days > self.root_cache_opts['max_age_days']:
                     getLog().info("root cache aged out! cache will be rebuilt")
-                    os.unlink(self.rootCacheFile)
-                else:
+                    os.unlink(cache_file)
+                    self._remove_tree(self.rootCacheTree)
+                    self.buildroot.root_cache_status = 'rebuild'
+                elif self.rootCacheDir == self.rootSharedCachePath:
                     # make sure no config file is newer than the cache file
                     for cfg in self.config['config_paths']:
                         if os.stat(cfg).st_mtime > statinfo.st_mtime:
                             getLog().info("%s newer than root cache; cache will be rebuilt", cfg)
-                            os.unlink(self.rootCacheFile)
+                            os.unlink(cache_file)
+                            self._remove_tree(self.rootCacheTree)
+                            self.buildroot.root_cache_status = 'rebuild'
                             break
             else:
                 getLog().info("skipping root_cache aging check")
         except OSError:
             pass
 
-        mockbuild.util.mkdirIfAbsent(self.rootSharedCachePath)
+        mockbuild.util.mkdirIfAbsent(self.rootSharedCachePath, self.rootCacheDir)
         # lock so others dont accidentally use root cache while we operate on it.
         if self.rootCacheLock is None:
-            self.rootCacheLock = open(os.path.join(self.rootSharedCachePath, "rootcache.lock"), "a+")
+            self.rootCacheLock = locks.Lock(os.path.join(self.rootSharedCachePath, "rootcache.lock"),
+                                            "rootcache", self.state)
 
         # optimization: don't unpack root cache if chroot was not cleaned (unless we are using tmpfs)
-        if os.path.exists(self.rootCacheFile):
+        if not os.path.exists(cache_file) and not hasattr(self.buildroot, 'root_cache_status'):
+            self.buildroot.root_cache_status = 'miss'
+        if os.path.exists(cache_file):
             if (not self.buildroot.chroot_was_initialized or self._haveVolatileRoot()):
                 self.state.start("unpacking root cache")
                 self._rootCacheLock()
@@ -123,14 +387,19 @@ class RootCache(object):
                     prev_cwd = os.getcwd()
                     os.chdir(mockbuild.util.find_non_nfs_dir())
                 mockbuild.util.mkdirIfAbsent(self.buildroot.make_chroot_path())
-                mockbuild.util.do(
-                    ["tar"] + self.compressArgs + ["-xf", self.rootCacheFile, "-C", self.buildroot.make_chroot_path()],
-                    shell=False, printOutput=True
-                )
+                if self.store and cache_file == self.rootCacheFile:
+                    self.store.materialize(cache_file, self.buildroot.make_chroot_path())
+                elif not self._restore_cache_tree():
+                    mockbuild.util.do(
+                        ["tar"] + compress_args + ["-xf", cache_file, "-C", self.buildroot.make_chroot_path()],
+                        shell=False, printOutput=True
+                    )
                 for item in self.exclude_dirs:
                     mockbuild.util.mkdirIfAbsent(self.buildroot.make_chroot_path(item))
                 self._rootCacheUnlock()
                 self.buildroot.chrootWasCached = True
+                self.buildroot.root_cache_status = 'hit'
+                self._mark_used()
                 self.state.finish("unpacking root cache")
                 if prev_cwd:
                     os.chdir(prev_cwd)
@@ -183,21 +452,42 @@ class RootCache(object):
                 self._root_cache_handle_mounts()
                 self.state.start("creating root cache")
                 try:
-                    mockbuild.util.do(
-                        ["tar", "--one-file-system", "--exclude-caches", "--exclude-caches-under"] +
-                        self.compressArgs +
-                        ["-cf", self.rootCacheFile,
-                         "-C", self.buildroot.make_chroot_path()] +
-                        self.exclude_tar_cmds + ["."],
-                        shell=False
-                    )
+                    if self.store:
+                        self.store.save(self.buildroot.make_chroot_path(), self.rootCacheFile,
+                                        [cmd[len("--exclude="):] for cmd in self.exclude_tar_cmds])
+                    else:
+                        mockbuild.util.do(
+                            ["tar", "--one-file-system", "--exclude-caches", "--exclude-caches-under"] +
+                            self.compressArgs +
+                            ["-cf", self.rootCacheFile,
+                             "-C", self.buildroot.make_chroot_path()] +
+                            self.exclude_tar_cmds + ["."],
+                            shell=False
+                        )
                 except:
                     if os.path.exists(self.rootCacheFile):
                         os.remove(self.rootCacheFile)
                     raise
+                for path, _ in list(self._other_caches(available_only=False)):
+                    os.remove(path)
+                manifest = os.path.join(self.rootCacheDir, "cache.manifest")
+                if not self.store and os.path.exists(manifest):
+                    os.remove(manifest)
+                if self.root_cache_opts.get('cow_restore', True) and not self.store:
+                    self._update_cache_tree()
+                else:
+                    self._remove_tree(self.rootCacheTree)
                 # now create the cache log file
-                with open(os.path.join(self.rootSharedCachePath, "cache.log"), "w") as l:
+                with open(os.path.join(self.rootCacheDir, "cache.log"), "w") as l:
                     l.write(self.buildroot.pkg_manager.init_install_output.encode())
+                if self.rootCacheDir != self.rootSharedCachePath:
+                    with open(os.path.join(self.rootCacheDir, "inputs.json"), "w") as f:
+                        json.dump(self.cacheInputs, f, sort_keys=True, indent=4)
+                    self._mark_used()
+                    self._evict_variants()
+                    self._remove_unkeyed_cache()
+                if self.store and self.root_cache_opts.get('store_gc', True):
+                    self.store.gc()
                 self.state.finish("creating root cache")
         finally:
             self._rootCacheUnlock()
@@ -5,12 +5,12 @@
 # Copyright (C) 2007 Michael E Brown <mebrown@michaels-house.net>
 
 # python library imports
-import fcntl
 import glob
 import os
 import time
 
 # our imports
+from mockbuild import locks
 from mockbuild.mounts import BindMountPoint
 from mockbuild.trace_decorator import getLog, traceLog
 import mockbuild.util
@@ -47,7 +47,8 @@ class YumCache(object):
         buildroot.mounts.add(BindMountPoint(srcpath=self.yumSharedCachePath,
                                             bindpath=buildroot.make_chroot_path(self.target_path)))
         mockbuild.util.mkdirIfAbsent(self.yumSharedCachePath)
-        self.yumCacheLock = open(os.path.join(self.yumSharedCachePath, "yumcache.lock"), "a+")
+        self.yumCacheLock = locks.Lock(os.path.join(self.yumSharedCachePath, "yumcache.lock"),
+                                       "yumcache", self.state)
 
     # =============
     # 'Private' API
@@ -58,16 +59,11 @@ class YumCache(object):
     # mock instances with --uniqueext=
     @traceLog()
     def _yumCachePreYumHook(self):
-        try:
-            fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError:
-            self.state.start("Waiting for yumcache lock")
-            fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_EX)
-            self.state.finish("Waiting for yumcache lock")
+        self.yumCacheLock.acquire(exclusive=True)
 
     @traceLog()
     def _yumCachePostYumHook(self):
-        fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_UN)
+        self.yumCacheLock.release()
 
     def _format_pm(self, s):
         return s.format(pm=self.config['package_manager'])
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""Background download of SRPMs for mockchain.
+
+URLs are fetched by a small pool of threads sharing one HTTP session (so
+connections are kept alive and reused) in the order they were submitted,
+which is the planned build order, while earlier packages already build.
+At most `lookahead` downloaded SRPMs wait for their build at any time.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from six.moves import queue
+# pylint: disable=import-error
+from six.moves.urllib_parse import urlsplit
+
+from . import util
+from .exception import Error
+from .trace_decorator import getLog, traceLog
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Error):
+    "Failed or corrupted SRPM download."
+    pass
+
+
+class Download(object):
+    """state of one URL"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, url):
+        self.url = url
+        self.path = None
+        self.sha256 = None
+        self.header = None
+        # URL of earlier download with identical content
+        self.duplicate_of = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Prefetcher(object):
+    """Download SRPMs with `workers` threads, call callback(download) when each is finished.
+
+    The callback is called from the download thread once per URL, also
+    when the download failed (download.error is set then). When the callback
+    raises, the download is marked failed and the callback is called once
+    more, so that the caller can give up on it.
+
+    A download which succeeded takes one of `lookahead` places until
+    release() is called for its URL, i.e. its build started; no more
+    downloads are started while all places are taken. None is no limit.
+    """
+    # pylint: disable=too-many-instance-attributes
+    @traceLog()
+    def __init__(self, download_dir, callback=None, workers=4, chunk_size=CHUNK_SIZE, lookahead=None):
+        self.download_dir = download_dir
+        self.callback = callback
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.lookahead = lookahead
+        # requests takes long to import, only load it when something is downloaded
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.workers,
+                                                pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.downloads = {}
+        self._by_hash = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = []
+        # URLs of downloads taking a lookahead place
+        self._ahead = set()
+        # places taken by workers waiting for the next URL
+        self._reserved = 0
+        # downloads not passed to the callback yet
+        self._fetching = 0
+        self._room = threading.Condition(self._lock)
+        self._stopping = False
+
+    @traceLog()
+    def submit(self, url):
+        """queue url for download, the same URL is downloaded only once"""
+        with self._lock:
+            if url in self.downloads:
+                return self.downloads[url]
+            download = self.downloads[url] = Download(url)
+        self._queue.put(download)
+        return download
+
+    @traceLog()
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name="prefetch-%s" % i)
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    @traceLog()
+    def release(self, url):
+        """the SRPM of url is not waiting anymore, let another download start"""
+        with self._room:
+            if url in self._ahead:
+                self._ahead.remove(url)
+                self._room.notify()
+
+    @traceLog()
+    def widen(self):
+        """allow one more download to wait when all places are taken by finished
+        downloads, e.g. because the builds wait for an SRPM not downloaded yet"""
+        with self._room:
+            if self.lookahead is not None and len(self._ahead) >= self.lookahead and not self._fetching:
+                self.lookahead += 1
+                self._room.notify()
+
+    @traceLog()
+    def stop(self):
+        """wait for the queued downloads and stop worker threads"""
+        with self._room:
+            self._stopping = True
+            self._room.notify_all()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.session.close()
+
+    def _worker(self):
+        while True:
+            # take a place before the URL, so that downloads start in order
+            with self._room:
+                while self.lookahead is not None and len(self._ahead) + self._reserved >= self.lookahead \
+                        and not self._stopping:
+                    self._room.wait()
+                self._reserved += 1
+            download = self._queue.get()
+            with self._room:
+                self._reserved -= 1
+                if download is None:
+                    self._room.notify()
+                    return
+                self._ahead.add(download.url)
+                self._fetching += 1
+            try:
+                self._fetch(download)
+            # pylint: disable=broad-except
+            except Exception as e:
+                download.error = e
+            if download.error or download.duplicate_of:
+                self.release(download.url)
+            download.done.set()
+            self._finish(download)
+            with self._room:
+                self._fetching -= 1
+
+    def _finish(self, download):
+        if not self.callback:
+            return
+        try:
+            self.callback(download)
+            return
+        # pylint: disable=broad-except
+        except Exception as e:
+            getLog().exception("Processing download of %s failed", download.url)
+            if download.error is not None:
+                return
+            download.error = e
+        self.release(download.url)
+        try:
+            self.callback(download)
+        # pylint: disable=broad-except
+        except Exception:
+            getLog().exception("Processing download of %s failed", download.url)
+
+    def _filename(self, response):
+        fn = urlsplit(response.url).path.rsplit('/', 1)[1]
+        if 'content-disposition' in response.headers:
+            import cgi
+            _, params = cgi.parse_header(response.headers['content-disposition'])
+            if 'filename' in params and params['filename']:
+                fn = os.path.basename(params['filename'])
+        return fn
+
+    def _fetch(self, download):
+        getLog().debug("Fetching %s", download.url)
+        response = self.session.get(download.url, stream=True)
+        try:
+            if response.status_code != 200:
+                raise DownloadError("HTTP status %s" % response.status_code)
+            fn = self._filename(response)
+            fd, tmp = tempfile.mkstemp(prefix='.' + fn, dir=self.download_dir)
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in response.iter_content(self.chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                download.header = self._verify(response, tmp, size)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        finally:
+            response.close()
+
+        download.sha256 = digest.hexdigest()
+        with self._lock:
+            first = self._by_hash.setdefault(download.sha256, download)
+        if first is not download:
+            os.unlink(tmp)
+            download.duplicate_of = first.url
+            return
+
+        with self._lock:
+            path = os.path.join(self.download_dir, fn)
+            if os.path.exists(path):
+                # same file name, different content
+                path = os.path.join(tempfile.mkdtemp(dir=self.download_dir), fn)
+            os.rename(tmp, path)
+        download.path = path
+
+    def _verify(self, response, path, size):
+        length = response.headers.get('content-length')
+        if length and 'content-encoding' not in response.headers and int(length) != size:
+            raise DownloadError("Incomplete download, got %s of %s bytes" % (size, length))
+        # raises when the file is not a (readable) source rpm
+        return next(util.yieldSrpmHeaders([path]))
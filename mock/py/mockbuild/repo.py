@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""Incremental repository metadata generation.
+
+Instead of rescanning the whole repository after each new package, only the
+new packages are passed to createrepo_c (--pkglist) and everything else is
+recycled from the existing repodata (--update --recycle-pkglist). Publishes
+which arrive while metadata are being generated are batched into the next
+single createrepo_c run.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from . import exception
+from . import util
+from .trace_decorator import getLog, traceLog
+
+CREATEREPO = '/usr/bin/createrepo_c'
+
+
+class RepoMetadata(object):
+    """repodata of one local repository"""
+    # pylint: disable=too-many-instance-attributes
+    @traceLog()
+    def __init__(self, path, command=None, cachedir=None, delay=0):
+        self.path = os.path.normpath(path)
+        self.command = list(command or [CREATEREPO])
+        # per-package checksum cache, reused across metadata generations
+        self.cachedir = cachedir
+        # how long to wait for more publishes before starting createrepo
+        self.delay = delay
+        self.incremental = True
+        self._cond = threading.Condition()
+        self._pending = set()
+        self._publishing = False
+        self._next_batch = 0
+        self._done_batch = -1
+        # batch -> result (or the exception which stopped its generation),
+        # kept until all its publishers have read it
+        self._results = {}
+        # batch -> number of publishers waiting for it
+        self._waiters = {}
+
+    def has_metadata(self):
+        return os.path.exists(os.path.join(self.path, 'repodata', 'repomd.xml'))
+
+    def _argv(self, pkglist=None):
+        argv = list(self.command)
+        if self.cachedir:
+            argv += ['--cachedir', self.cachedir]
+        if self.has_metadata():
+            argv.append('--update')
+            if pkglist:
+                argv += ['--recycle-pkglist', '--pkglist', pkglist]
+        argv.append(self.path)
+        return argv
+
+    @staticmethod
+    def _run(argv):
+        try:
+            return 0, util.do(argv, returnOutput=True), ''
+        except exception.Error as e:
+            return e.resultcode, '', str(e)
+
+    @traceLog()
+    def generate(self, new_pkgs=None):
+        """(re)generate metadata, returns (returncode, output, error message)
+
+        When new_pkgs are given and the repository already has metadata, only
+        those packages are read, the rest is taken from the old repodata.
+        """
+        if not (new_pkgs and self.incremental and self.has_metadata()):
+            return self._run(self._argv())
+
+        if self.cachedir and not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        fd, pkglist = tempfile.mkstemp(prefix='mock-pkglist.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for pkg in sorted(new_pkgs):
+                    f.write(os.path.relpath(os.path.abspath(pkg), self.path) + '\n')
+            ret, out, err = self._run(self._argv(pkglist))
+        finally:
+            os.unlink(pkglist)
+        if ret:
+            # e.g. createrepo without --recycle-pkglist support, do it the slow way
+            getLog().warning("Incremental metadata update failed, regenerating whole repo: %s", err.strip())
+            self.incremental = False
+            return self._run(self._argv())
+        return ret, out, err
+
+    @traceLog()
+    def publish(self, pkgs):
+        """Add pkgs to the repository; thread safe, blocks until they are in repodata.
+
+        Packages published by several threads while createrepo is running (or
+        during `delay`) end up in one metadata generation.
+        """
+        if not pkgs:
+            return 0, '', ''
+        with self._cond:
+            self._pending.update(pkgs)
+            batch = self._next_batch
+            self._waiters[batch] = self._waiters.get(batch, 0) + 1
+            if self._publishing:
+                while self._done_batch < batch:
+                    self._cond.wait()
+                result = self._take_result(batch)
+                if isinstance(result, BaseException):
+                    raise result
+                return result
+            self._publishing = True
+
+        try:
+            while True:
+                if self.delay:
+                    time.sleep(self.delay)
+                with self._cond:
+                    if not self._pending:
+                        self._publishing = False
+                        break
+                    current = self._next_batch
+                    self._next_batch += 1
+                    new_pkgs = self._pending
+                    self._pending = set()
+                try:
+                    result = self.generate(new_pkgs)
+                # pylint: disable=broad-except
+                except Exception as e:
+                    result = (1, '', str(e))
+                with self._cond:
+                    self._results[current] = result
+                    self._done_batch = current
+                    self._cond.notify_all()
+        except BaseException as e:
+            with self._cond:
+                # nobody is left to generate the batches waited for, pass the
+                # error on to their publishers
+                for failed in range(self._done_batch + 1, self._next_batch + 1):
+                    if failed in self._waiters:
+                        self._results[failed] = e
+                self._done_batch = self._next_batch
+                self._next_batch += 1
+                self._pending = set()
+                self._publishing = False
+                self._take_result(batch)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            return self._take_result(batch)
+
+    def _take_result(self, batch):
+        """result of batch for one of its publishers, self._cond held"""
+        result = self._results[batch]
+        self._waiters[batch] -= 1
+        if not self._waiters[batch]:
+            del self._waiters[batch]
+            del self._results[batch]
+        return result
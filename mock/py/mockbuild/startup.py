@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+"""Where the start-up time of mock goes (--profile-startup).
+
+enable() times every module imported from then on (time of its own code
+and including the modules it imports) and mark() records the phases of
+the initialization. Both are printed to stderr when mock exits. Without
+enable(), mark() does nothing.
+"""
+
+from __future__ import print_function
+
+import atexit
+import sys
+import time
+
+from six.moves import builtins
+
+# python 2 has no monotonic clock
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_enabled = False
+_origin = None
+_last_mark = None
+# module name -> [own seconds, cumulative seconds]
+_imports = {}
+# (phase, seconds)
+_phases = []
+# seconds spent in the modules imported by the imports in progress
+_nested = []
+
+
+def _timed_import(import_, name, globals_=None, locals_=None, fromlist=(), level=0):
+    loaded = len(sys.modules)
+    _nested.append(0.0)
+    start = _monotonic()
+    try:
+        return import_(name, globals_, locals_, fromlist, level)
+    finally:
+        elapsed = _monotonic() - start
+        children = _nested.pop()
+        if len(sys.modules) != loaded:
+            if level and globals_:
+                package = globals_.get('__package__') or globals_.get('__name__', '')
+                name = package + '.' + name if name else package
+            times = _imports.setdefault(name, [0.0, 0.0])
+            times[0] += elapsed - children
+            times[1] += elapsed
+            if _nested:
+                _nested[-1] += elapsed
+
+
+def enable():
+    """time imports and phases from now on, print them when mock exits"""
+    global _enabled, _origin, _last_mark
+    if _enabled:
+        return
+    _enabled = True
+    _origin = _last_mark = _monotonic()
+    import_ = builtins.__import__
+
+    def timed_import(name, globals_=None, locals_=None, fromlist=(), level=0):
+        return _timed_import(import_, name, globals_, locals_, fromlist, level)
+    builtins.__import__ = timed_import
+    atexit.register(report)
+
+
+def mark(phase):
+    """the phase of the initialization which ends now"""
+    global _last_mark
+    if not _enabled:
+        return
+    now = _monotonic()
+    _phases.append((phase, now - _last_mark))
+    _last_mark = now
+
+
+def report(stream=None, limit=25):
+    stream = stream or sys.stderr
+    print("Start-up profile, seconds since enabled: %.3f" % (_monotonic() - _origin), file=stream)
+    print("Slowest imports (own, cumulative):", file=stream)
+    slowest = sorted(_imports.items(), key=lambda item: item[1][0], reverse=True)
+    for name, (own, cumulative) in slowest[:limit]:
+        print("  %8.4f %8.4f  %s" % (own, cumulative, name), file=stream)
+    print("Phases:", file=stream)
+    for phase, elapsed in _phases:
+        print("  %8.4f  %s" % (elapsed, phase), file=stream)
@@ -1,17 +1,126 @@
 # -*- coding: utf-8 -*-
 # vim: noai:ts=4:sw=4:expandtab
 
+import contextlib
+import json
+import os
+import time
+
 from .exception import StateError
 from .trace_decorator import getLog
 
+# python 2 has no monotonic clock
+_monotonic = getattr(time, 'monotonic', time.time)
+
+TIMING_FILE = 'timing.json'
+TRACE_FILE = 'timing.trace.json'
+
+
+class Timeline(object):
+    """Nested spans of the phases of one mock run, shared by its States.
+
+    Times are seconds from the start of the run on a monotonic clock; the
+    wall clock time of the start is kept to compare runs. With accounting
+    (a cgroups.Accounting) each span also gets the resources used by mock
+    and its commands during the span.
+    """
+    def __init__(self, accounting=None):
+        self.origin = _monotonic()
+        self.wall_origin = time.time()
+        self.accounting = accounting
+        self.spans = []
+        self._open = []
+        # resource snapshots at the start of the open spans
+        self._snapshots = []
+
+    def begin(self, name, bootstrap=False):
+        parent = self._open[-1] if self._open else None
+        span = {
+            'name': name,
+            'bootstrap': bool(bootstrap),
+            'parent': parent['name'] if parent else None,
+            'depth': len(self._open),
+            'start': _monotonic() - self.origin,
+            'end': None,
+        }
+        self.spans.append(span)
+        self._open.append(span)
+        self._snapshots.append(self.accounting.snapshot() if self.accounting else None)
+
+    def end(self, name, bootstrap=False):
+        for i in range(len(self._open) - 1, -1, -1):
+            span = self._open[i]
+            if span['name'] == name and span['bootstrap'] == bool(bootstrap):
+                span['end'] = _monotonic() - self.origin
+                snapshot = self._snapshots[i]
+                if snapshot is not None and self.accounting:
+                    span['resources'] = self.accounting.delta(snapshot, self.accounting.snapshot())
+                del self._open[i]
+                del self._snapshots[i]
+                return
+
+    def _finished_spans(self):
+        """spans with duration, unfinished ones (e.g. after a failure) end now"""
+        now = _monotonic() - self.origin
+        for span in self.spans:
+            span = dict(span)
+            if span['end'] is None:
+                span['end'] = now
+                span['unfinished'] = True
+            span['duration'] = span['end'] - span['start']
+            yield span
+
+    def to_json(self):
+        return {
+            'version': 1,
+            'start': self.wall_origin,
+            'spans': list(self._finished_spans()),
+        }
+
+    def to_trace_events(self):
+        """Chrome trace-event format (chrome://tracing, Perfetto, speedscope)"""
+        pid = os.getpid()
+        events = [
+            {'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0, 'args': {'name': 'mock'}},
+            {'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': 1, 'args': {'name': 'buildroot'}},
+            {'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': 2, 'args': {'name': 'bootstrap'}},
+        ]
+        for span in self._finished_spans():
+            events.append({
+                'ph': 'X',
+                'name': span['name'],
+                'cat': 'bootstrap' if span['bootstrap'] else 'buildroot',
+                'pid': pid,
+                'tid': 2 if span['bootstrap'] else 1,
+                'ts': int(span['start'] * 1e6),
+                'dur': int(span['duration'] * 1e6),
+                'args': dict(span.get('resources', {}), parent=span['parent'],
+                             unfinished=span.get('unfinished', False)),
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'start': self.wall_origin}}
+
+    def write(self, resultdir):
+        """write TIMING_FILE and TRACE_FILE to resultdir (if there is one)"""
+        if not self.spans or not os.path.isdir(resultdir):
+            return
+        try:
+            with open(os.path.join(resultdir, TIMING_FILE), 'w') as f:
+                json.dump(self.to_json(), f, indent=1)
+            with open(os.path.join(resultdir, TRACE_FILE), 'w') as f:
+                json.dump(self.to_trace_events(), f)
+        except (IOError, OSError) as e:
+            getLog().warning("Cannot write timing of phases to %s: %s", resultdir, e)
+
 
 class State(object):
-    def __init__(self, bootstrap=None):
+    def __init__(self, bootstrap=None, timeline=None):
         self._state = []
         # can be "unknown", "success" or "fail"
         self.result = "unknown"
         self.bootstrap = bootstrap
         self.state_log = getLog("mockbuild.Root.state")
+        self.timeline = timeline if timeline is not None else Timeline()
 
     def state(self):
         if not len(self._state):
@@ -22,6 +131,7 @@ class State(object):
         if state is None:
             raise StateError("start called with None State")
         self._state.append(state)
+        self.timeline.begin(state, self.bootstrap)
         if self.bootstrap:
             self.state_log.info("Start(bootstrap): %s", state)
         else:
@@ -33,11 +143,21 @@ class State(object):
         current = self._state.pop()
         if state != current:
             raise StateError("state finish mismatch: current: %s, state: %s" % (current, state))
+        self.timeline.end(state, self.bootstrap)
         if self.bootstrap:
             self.state_log.info("Finish(bootstrap): %s", state)
         else:
             self.state_log.info("Finish: %s", state)
 
+    @contextlib.contextmanager
+    def span(self, name):
+        """time a phase without logging it to state.log (e.g. plugin hooks)"""
+        self.timeline.begin(name, self.bootstrap)
+        try:
+            yield
+        finally:
+            self.timeline.end(name, self.bootstrap)
+
     def alldone(self):
         if len(self._state) != 0:
             raise StateError("alldone called with pending states: %s" % ",".join(self._state))
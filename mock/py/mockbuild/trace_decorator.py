@@ -17,6 +17,18 @@ except NameError:
     basestring = str
 
 
+# functions are wrapped by traceLog() only when tracing is enabled (mock
+# --trace, or MOCK_TRACE in environment); otherwise the decorator returns
+# the function as it is and costs nothing per call. It has to be decided
+# before the traced modules are imported.
+_tracing = bool(os.environ.get('MOCK_TRACE'))
+
+
+def set_tracing(enabled):
+    global _tracing
+    _tracing = bool(enabled)
+
+
 # defaults to module verbose log
 # does a late binding on log. Forwards all attributes to logger.
 # works around problem where reconfiguring the logging module means loggers
@@ -25,8 +37,8 @@ class getLog(object):
     # pylint: disable=unused-argument,too-few-public-methods
     def __init__(self, name=None, prefix="", *args, **kargs):
         if name is None:
-            frame = inspect.getouterframes(inspect.currentframe())[1][0]
-            name = frame.f_globals["__name__"]
+            # pylint: disable=protected-access
+            name = sys._getframe(1).f_globals["__name__"]
 
         self.name = prefix + name
 
@@ -55,39 +67,53 @@ def safe_repr(arg):
     except AttributeError:
         return str(type(arg))
 
+
+def _enabled(logger):
+    return logger.manager.disable < logging.INFO and logger.isEnabledFor(logging.INFO)
+
+
 def traceLog(logger=None):
     def decorator(func):
+        if not _tracing:
+            return func
+
+        # everything known about func is resolved once, not per call
+        filename = os.path.normcase(inspect.getsourcefile(func))
+        func_name = func.__name__
+        if hasattr(func, 'func_code'):
+            lineno = func.func_code.co_firstlineno
+        else:
+            lineno = func.__code__.co_firstlineno
+        default_logger = logger
+        if default_logger is None:
+            default_logger = logging.getLogger("trace.%s" % func.__module__)
+        elif isinstance(default_logger, basestring):
+            default_logger = logging.getLogger(default_logger)
+
         @functools.wraps(func)
         def trace(*args, **kw):
             # default to logger that was passed by module, but
             # can override by passing logger=foo as function parameter.
             # make sure this doesn't conflict with one of the parameters
             # you are expecting
-
-            filename = os.path.normcase(inspect.getsourcefile(func))
-            func_name = func.__name__
-            if hasattr(func, 'func_code'):
-                lineno = func.func_code.co_firstlineno
-            else:
-                lineno = func.__code__.co_firstlineno
-
-            l2 = kw.get('logger', logger)
-            if l2 is None:
-                l2 = logging.getLogger("trace.%s" % func.__module__)
+            l2 = kw.get('logger', default_logger)
             if isinstance(l2, basestring):
                 l2 = logging.getLogger(l2)
+            if not _enabled(l2):
+                return func(*args, **kw)
 
-            message = "ENTER %s("
-            message = message + ', '.join([safe_repr(arg) for arg in args])
+            message = ', '.join([safe_repr(arg) for arg in args])
             if args and kw:
                 message += ', '
             for k, v in list(kw.items()):
                 message = message + "%s=%s" % (k, safe_repr(v))
-            message = message + ")"
+            # the arguments must not be taken for format directives
+            message = "ENTER %s(" + message.replace('%', '%%') + ")"
 
-            frame = inspect.getouterframes(inspect.currentframe())[1][0]
+            # pylint: disable=protected-access
+            frame = sys._getframe(1)
             doLog(l2, logging.INFO, os.path.normcase(frame.f_code.co_filename),
-                  frame.f_lineno, message, args=[func_name], exc_info=None,
+                  frame.f_lineno, message, args=(func_name,), exc_info=None,
                   func=frame.f_code.co_name)
             try:
                 result = "Bad exception raised: Exception was not a derived "\
@@ -97,12 +123,12 @@ def traceLog(logger=None):
                 except (KeyboardInterrupt, Exception) as e:
                     result = "EXCEPTION RAISED"
                     doLog(l2, logging.INFO, filename, lineno,
-                          "EXCEPTION: %s\n", args=[e],
+                          "EXCEPTION: %s\n", args=(e,),
                           exc_info=sys.exc_info(), func=func_name)
                     raise
             finally:
                 doLog(l2, logging.INFO, filename, lineno,
-                      "LEAVE %s --> %s\n", args=[func_name, result],
+                      "LEAVE %s --> %s\n", args=(func_name, result),
                       exc_info=None, func=func_name)
 
             return result
@@ -120,6 +146,7 @@ def decorateAllFunctions(module, logger=None):
 
 # unit tests...
 if __name__ == "__main__":
+    set_tracing(True)
     logging.basicConfig(
         level=logging.WARNING,
         format='%(name)s %(levelname)s %(filename)s, %(funcName)s, Line: %(lineno)d:  %(message)s',)
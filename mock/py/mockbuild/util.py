@@ -8,11 +8,13 @@
 from __future__ import print_function
 
 from ast import literal_eval
+import collections
 import ctypes
 import errno
 import fcntl
 from glob import glob
 import grp
+import hashlib
 import locale
 import logging
 import os
@@ -27,18 +29,18 @@ import stat
 import struct
 import subprocess
 import sys
+import tempfile
 # pylint: disable=wrong-import-order
 import termios
 from textwrap import dedent
+import threading
 import time
 import uuid
 
-import distro
-
 from . import exception
+from . import hostfacts
 from .trace_decorator import getLog, traceLog
 from .uid import getresuid, setresuid
-from pyroute2 import IPRoute
 
 encoding = locale.getpreferredencoding()
 
@@ -81,11 +83,13 @@ personality_defs = {
 PLUGIN_LIST = ['tmpfs', 'root_cache', 'yum_cache', 'bind_mount',
                'ccache', 'selinux', 'package_state', 'chroot_scan',
                'lvm_root', 'compress_logs', 'sign', 'pm_request',
-               'hw_info']
+               'hw_info', 'metrics']
 
 USE_NSPAWN = False
 
 _OPS_TIMEOUT = 0
+_OUTPUT_LIMIT = None
+_LOG_FLUSH_INTERVAL = 1
 
 class commandTimeoutExpired(exception.Error):
     def __init__(self, msg):
@@ -196,6 +200,8 @@ def _safe_check_output(*args):
 @traceLog()
 def get_machinectl_uuid(chroot_path):
     """ Get UUID from machinectl. This function does not check if NSPAWN is used """
+    if not hostfacts.have_machinectl():
+        return None
     # we will ignore errors in machinectl, it sometimes fails for various errors (cannot find IP addr...)
     # we do not care about exit code, we just want the output
     # RHEL7 does not know --no-legend, so we must filter the legend out
@@ -286,11 +292,18 @@ def getNEVRA(hdr):
     return tuple(x.decode() if i != 1 else x for i, x in enumerate(ret))
 
 
+# (str1, str2) -> result of cmpKernelVer()
+_VERSION_COMPARISONS = {}
+
+
 @traceLog()
 def cmpKernelVer(str1, str2):
     'compare two kernel version strings and return -1, 0, 1 for less, equal, greater'
-    import rpm
-    return rpm.labelCompare(('', str1, ''), ('', str2, ''))
+    key = (str1, str2)
+    if key not in _VERSION_COMPARISONS:
+        import rpm
+        _VERSION_COMPARISONS[key] = rpm.labelCompare(('', str1, ''), ('', str2, ''))
+    return _VERSION_COMPARISONS[key]
 
 
 @traceLog()
@@ -380,6 +393,21 @@ def condUnshareIPC(unshare_ipc=True):
             # fails, there had to be a warning already
             pass
 
+# pyroute2.IPRoute, see _import_iproute()
+_IPRoute = None
+
+
+def _import_iproute():
+    """pyroute2 takes long to import, it is only loaded when a network namespace
+    is set up; ChildPreExec does it before forking, as importing in the forked
+    child of a multithreaded mock could deadlock on the import lock"""
+    global _IPRoute
+    if _IPRoute is None:
+        from pyroute2 import IPRoute
+        _IPRoute = IPRoute
+    return _IPRoute
+
+
 def condUnshareNet(unshare_net=True):
     if USE_NSPAWN and unshare_net:
         try:
@@ -387,7 +415,7 @@ def condUnshareNet(unshare_net=True):
             # Set up loopback interface and add default route via loopback in the namespace.
             # Missing default route may confuse some software, see
             # https://github.com/rpm-software-management/mock/issues/113
-            ipr = IPRoute()
+            ipr = _import_iproute()()
             dev = ipr.link_lookup(ifname='lo')[0]
 
             ipr.link('set', index=dev, state='up')
@@ -401,8 +429,11 @@ def condUnshareNet(unshare_net=True):
             getLog().warning("network namespace setup failed: %s", e)
 
 def process_input(line):
+    line = line.rstrip('\r')
+    if '\r' not in line and '\b' not in line:
+        return line
     out = []
-    for char in line.rstrip('\r'):
+    for char in line:
         if char == '\r':
             out = []
         elif char == '\b':
@@ -412,9 +443,196 @@ def process_input(line):
     return ''.join(out)
 
 
+class OutputBuffer(object):
+    """Captured output of a command.
+
+    Chunks are collected in a list and joined only once, in getvalue(). With
+    limit, only the first and the last limit/2 characters are kept, so memory
+    stays bounded, and OMITTED_MARKER tells how much was left out between
+    them. Without it, all the output is kept.
+    """
+    OMITTED_MARKER = "\n[... %s characters of output omitted ...]\n"
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._head = []
+        self._head_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._omitted = 0
+
+    def write(self, text):
+        if not text:
+            return
+        if self.limit is None:
+            self._head.append(text)
+            return
+
+        head_room = self.limit // 2 - self._head_size
+        if head_room > 0:
+            self._head.append(text[:head_room])
+            self._head_size += len(self._head[-1])
+            text = text[head_room:]
+            if not text:
+                return
+        self._tail.append(text)
+        self._tail_size += len(text)
+        tail_limit = self.limit - self.limit // 2
+        while self._tail_size > tail_limit:
+            excess = self._tail_size - tail_limit
+            first = self._tail[0]
+            if len(first) <= excess:
+                self._tail.popleft()
+                excess = len(first)
+            else:
+                self._tail[0] = first[excess:]
+            self._tail_size -= excess
+            self._omitted += excess
+
+    def getvalue(self):
+        value = ''.join(self._head)
+        if self._omitted:
+            value += self.OMITTED_MARKER % self._omitted
+        return value + ''.join(self._tail)
+
+
+_ANSI_ESCAPE = re.compile(r'\x1b\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]\x0f?')
+_EMPTY_LINES = re.compile(r'\n{2,}')
+_NOT_XTRACE = re.compile(r'^(?!\+ )', re.M)
+
+
+def _log_handlers(logger, level):
+    """handlers which would emit a record of level sent to logger"""
+    if logger is None or not logger.isEnabledFor(level):
+        return []
+    handlers = []
+    current = logger
+    while current:
+        handlers.extend(h for h in current.handlers if level >= h.level)
+        if not current.propagate:
+            break
+        current = current.parent
+    return handlers
+
+
+def _unadorned(handler):
+    # the default formatter is '%(message)s' as well
+    return handler.formatter is None or getattr(handler.formatter, '_fmt', None) == '%(message)s'
+
+
+class OutputLogger(object):
+    """Sends command output to logger, chunk by chunk.
+
+    When every handler which accepts the records prints just the message
+    (like build.log), the whole chunk is logged as one record. Otherwise one
+    record per line is created, but without looking up the caller for each
+    of them. When no handler accepts debug records, nothing is done at all.
+    Handlers are flushed at most once per flush_interval seconds.
+    """
+    def __init__(self, logger, flush_interval=None):
+        self.logger = logger
+        self.handlers = _log_handlers(logger, logging.DEBUG)
+        self.enabled = bool(self.handlers)
+        self.batch = all(_unadorned(h) for h in self.handlers)
+        self.flush_interval = _LOG_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._flushed = time.time()
+        caller = sys._getframe(1)  # pylint: disable=protected-access
+        self._caller = (caller.f_code.co_filename, caller.f_lineno, caller.f_code.co_name)
+
+    def _emit(self, msg):
+        filename, lineno, func = self._caller
+        record = self.logger.makeRecord(self.logger.name, logging.DEBUG, filename, lineno,
+                                        msg, (), None, func)
+        self.logger.handle(record)
+
+    def log(self, text, stderr=False):
+        """log complete lines from text, empty lines are skipped"""
+        if not self.enabled:
+            return
+        text = _ANSI_ESCAPE.sub('', text)
+        if self.batch:
+            text = _EMPTY_LINES.sub('\n', text).strip('\n')
+            if text:
+                if stderr:
+                    text = _NOT_XTRACE.sub('BUILDSTDERR: ', text)
+                self._emit(text)
+        else:
+            for line in text.split('\n'):
+                if line:
+                    if stderr and not line.startswith('+ '):
+                        line = 'BUILDSTDERR: ' + line
+                    self._emit(line)
+        if time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.enabled:
+            return
+        for h in self.handlers:
+            h.flush()
+        self._flushed = time.time()
+
+
+class ChildWatcher(object):
+    """File descriptor which becomes readable once the child exits.
+
+    It is a pidfd where both kernel and python support it, otherwise a pipe
+    written by a thread which waits for the child. Either way the child is
+    waited for without polling it periodically.
+    """
+    def __init__(self, child):
+        self.child = child
+        self._fd = None
+        self._thread = None
+        pidfd_open = getattr(os, 'pidfd_open', None)
+        if pidfd_open is not None:
+            try:
+                self._fd = pidfd_open(child.pid)
+            except OSError:
+                pass
+        if self._fd is None:
+            self._fd, wfd = os.pipe()
+            self._thread = threading.Thread(target=self._wait, args=(wfd,),
+                                            name="wait-%s" % child.pid)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _wait(self, wfd):
+        try:
+            self.child.wait()
+        finally:
+            try:
+                os.write(wfd, b'x')
+            except OSError:
+                pass
+            os.close(wfd)
+
+    def fileno(self):
+        return self._fd
+
+    def wait(self, timeout=None):
+        """wait for the child at most timeout seconds, return True when it exited"""
+        if self.child.returncode is not None:
+            return True
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        if timeout is not None:
+            timeout = max(0, timeout * 1000)
+        if not poller.poll(timeout):
+            return False
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            self.child.wait()
+        return True
+
+    def close(self):
+        os.close(self._fd)
+
+
 def logOutput(fdout, fderr, logger, returnOutput=1, start=0, timeout=0, printOutput=False,
-              child=None, chrootPath=None, pty=False):
-    output = ""
+              child=None, chrootPath=None, pty=False, watcher=None, output_limit=None):
+    output = OutputBuffer(limit=output_limit)
     done = False
     fds = [fdout, fderr]
 
@@ -430,26 +648,47 @@ def logOutput(fdout, fderr, logger, returnOutput=1, start=0, timeout=0, printOut
         # prevent output being printed twice when log propagates to stdout
         mockbuild_logger.propagate = 0
         sys.stdout.flush()
+    poller = select.poll()
+    for fd in fds:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    if watcher is not None:
+        poller.register(watcher, select.POLLIN)
+    # without watcher the child has to be checked periodically
+    child_dead = False
+    # after propagate is changed, it decides which handlers get the output
+    output_logger = OutputLogger(logger)
     try:
         tail = ""
-        ansi_escape = re.compile(r'\x1b\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]\x0f?')
         while not done:
-            if (time.time() - start) > timeout and timeout != 0:
-                done = True
-                break
+            poll_timeout = None
+            if timeout != 0:
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    done = True
+                    break
+                poll_timeout = remaining * 1000
+            if child_dead or (child and watcher is None):
+                # orphans may keep the output open after child's death
+                poll_timeout = 1000 if poll_timeout is None else min(poll_timeout, 1000)
 
-            i_rdy, o_rdy, e_rdy = select.select(fds, [], [], 1)
+            ready = [fd for fd, _ in poller.poll(poll_timeout)]
 
-            if not i_rdy and not o_rdy and not e_rdy:
-                if child and child.poll() is not None:
+            if not ready:
+                if child_dead or (child and watcher is None and child.poll() is not None):
                     logger.info("Child pid '%s' is dead", child.pid)
                     done = True
                     if chrootPath:
                         logger.info("Child dead, killing orphans")
                         orphansKill(chrootPath)
-                    continue
+                continue
+
+            if watcher is not None and watcher.fileno() in ready:
+                poller.unregister(watcher)
+                child_dead = True
 
-            for s in i_rdy:
+            for s in fds:
+                if s.fileno() not in ready:
+                    continue
                 # slurp as much input as is ready
                 raw = s.read()
                 if not raw:
@@ -463,63 +702,42 @@ def logOutput(fdout, fderr, logger, returnOutput=1, start=0, timeout=0, printOut
                     else:
                         print(raw, end='')
                     sys.stdout.flush()
-                txt_input = raw.decode(encoding, 'replace')
-                lines = txt_input.split("\n")
-                if tail:
-                    lines[0] = tail + lines[0]
+                if not (returnOutput or output_logger.enabled):
+                    continue
+                txt_input = tail + raw.decode(encoding, 'replace')
                 # we may not have all of the last line
-                tail = lines.pop()
-                if not lines:
+                cut = txt_input.rfind('\n')
+                if cut < 0:
+                    tail = txt_input
                     continue
+                tail = txt_input[cut + 1:]
+                processed_input = txt_input[:cut + 1]
                 if pty:
-                    lines = [process_input(line) for line in lines]
-                processed_input = '\n'.join(lines) + '\n'
-                if logger is not None:
-                    for line in lines:
-                        if line != '':
-                            line = ansi_escape.sub('', line)
-                            if fderr is s and not line.startswith('+ '):
-                                logger.debug("BUILDSTDERR: %s", line)
-                            else:
-                                logger.debug(line)
-                    for h in logger.handlers:
-                        h.flush()
+                    # pty terminates lines with \r\n, only real carriage returns need the slow path
+                    processed_input = processed_input.replace('\r\n', '\n')
+                if pty and ('\r' in processed_input or '\b' in processed_input):
+                    processed_input = '\n'.join(
+                        process_input(line) for line in processed_input[:-1].split('\n')) + '\n'
+                output_logger.log(processed_input, stderr=fderr is s)
                 if returnOutput:
-                    output += processed_input
+                    output.write(processed_input)
 
         if tail:
             if pty:
                 tail = process_input(tail) + '\n'
-            if logger is not None:
-                logger.debug(tail)
+            output_logger.log(tail)
             if returnOutput:
-                output += tail
+                output.write(tail)
+        output_logger.flush()
+        return output.getvalue()
     finally:
         mockbuild_logger.propagate = stored_propagate
 
-    return output
-
 
 @traceLog()
 def selinuxEnabled():
     """Check if SELinux is enabled (enforcing or permissive)."""
-    with open("/proc/mounts") as f:
-        for mount in f.readlines():
-            (fstype, mountpoint, _) = mount.split(None, 2)
-            if fstype == "selinuxfs":
-                selinux_mountpoint = mountpoint
-                break
-        else:
-            selinux_mountpoint = "/selinux"
-
-    try:
-        enforce_filename = os.path.join(selinux_mountpoint, "enforce")
-        with open(enforce_filename) as f:
-            if f.read().strip() in ("1", "0"):
-                return True
-    except:
-        pass
-    return False
+    return hostfacts.selinux_enabled()
 
 
 def resize_pty(pty):
@@ -543,29 +761,34 @@ def resize_pty(pty):
 def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True,
        returnOutput=0, uid=None, gid=None, user=None, personality=None,
        printOutput=False, env=None, pty=False, nspawn_args=None, unshare_net=False,
-       *_, **kargs):
+       output_limit=None, *_, **kargs):
 
     logger = kargs.get("logger", getLog())
     if timeout == 0:
         timeout = _OPS_TIMEOUT
+    if output_limit is None:
+        output_limit = _OUTPUT_LIMIT
     output = ""
     start = time.time()
     if pty:
         master_pty, slave_pty = os.openpty()
         resize_pty(slave_pty)
         reader = os.fdopen(master_pty, 'rb')
-    preexec = ChildPreExec(personality, chrootPath, cwd, uid, gid, unshare_ipc=bool(chrootPath), unshare_net=unshare_net)
     if env is None:
         env = clean_env()
     stdout = None
+    watcher = None
     try:
         child = None
         if shell and isinstance(command, list):
             command = ['/bin/sh', '-c'] + command
             shell = False
         if chrootPath and USE_NSPAWN:
-            command = _prepare_nspawn_command(chrootPath, user, command,
-                                              nspawn_args=nspawn_args, env=env, cwd=cwd)
+            command, unshare_net = _nspawn_command(chrootPath, command, user=user, uid=uid, gid=gid,
+                                                   cwd=cwd, env=env, nspawn_args=nspawn_args,
+                                                   unshare_net=unshare_net)
+        preexec = ChildPreExec(personality, chrootPath, cwd, uid, gid, unshare_ipc=bool(chrootPath),
+                               unshare_net=unshare_net)
         logger.debug("Executing command: %s with env %s and shell %s", command, env, shell)
         with open(os.devnull, "r") as stdin:
             child = subprocess.Popen(
@@ -578,21 +801,26 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
                 stderr=subprocess.PIPE,
                 preexec_fn=preexec,
             )
+            watcher = ChildWatcher(child)
             if not pty:
                 stdout = child.stdout
             with child.stderr:
-                # use select() to poll for output so we dont block
+                # use poll() to wait for output so we dont block
                 output = logOutput(
                     reader if pty else child.stdout, child.stderr,
                     logger, returnOutput, start, timeout, pty=pty,
                     printOutput=printOutput, child=child,
-                    chrootPath=chrootPath)
+                    chrootPath=chrootPath, watcher=watcher,
+                    output_limit=output_limit)
     except:
         # kill children if they arent done
         if child is not None and child.returncode is None:
             os.killpg(child.pid, 9)
         try:
-            if child is not None:
+            if watcher is not None:
+                watcher.wait()
+                watcher.close()
+            elif child is not None:
                 os.waitpid(child.pid, 0)
         except:
             pass
@@ -606,13 +834,13 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
 
     # wait until child is done, kill it if it passes timeout
     niceExit = 1
-    while child.poll() is None:
-        if (time.time() - start) > timeout and timeout != 0:
-            niceExit = 0
-            os.killpg(child.pid, 15)
-        if (time.time() - start) > (timeout + 1) and timeout != 0:
-            niceExit = 0
+    if timeout != 0 and not watcher.wait(start + timeout - time.time()):
+        niceExit = 0
+        os.killpg(child.pid, 15)
+        if not watcher.wait(1):
             os.killpg(child.pid, 9)
+    watcher.wait()
+    watcher.close()
 
     # only logging from this point, convert command to string
     if isinstance(command, list):
@@ -639,6 +867,8 @@ class ChildPreExec(object):
         self.shell = shell
         self.unshare_ipc = unshare_ipc
         self.unshare_net = unshare_net
+        if USE_NSPAWN and unshare_net:
+            _import_iproute()
         getLog().debug("child environment: %s", env)
 
     def __call__(self, *args, **kargs):
@@ -671,7 +901,7 @@ def is_in_dir(path, directory):
     return os.path.commonprefix([path, directory]) == directory
 
 
-def _prepare_nspawn_command(chrootPath, user, cmd, nspawn_args=None, env=None, cwd=None):
+def _prepare_nspawn_command(chrootPath, user, cmd, nspawn_args=None, env=None, cwd=None, machine=None):
     cmd_is_list = isinstance(cmd, list)
     if nspawn_args is None:
         nspawn_args = []
@@ -683,8 +913,8 @@ def _prepare_nspawn_command(chrootPath, user, cmd, nspawn_args=None, env=None, c
             raise exception.Error('Internal Error: command must be list or shell=True.')
     elif not cmd_is_list:
         cmd = [cmd]
-    nspawn_argv = ['/usr/bin/systemd-nspawn', '-q', '-M', uuid.uuid4().hex, '-D', chrootPath]
-    distro_label = distro.linux_distribution(full_distribution_name=False)[0]
+    nspawn_argv = ['/usr/bin/systemd-nspawn', '-q', '-M', machine or uuid.uuid4().hex, '-D', chrootPath]
+    distro_label = hostfacts.distribution()[0]
     if (distro_label != 'centos') and (distro_label != 'ol') and (distro_label != 'rhel') and (distro_label != 'deskos'):
         # EL7 does not support it (yet). See BZ 1417387
         nspawn_argv += ['-a']
@@ -701,6 +931,195 @@ def _prepare_nspawn_command(chrootPath, user, cmd, nspawn_args=None, env=None, c
         return " ".join(cmd)
 
 
+def _nspawn_command(chrootPath, command, user=None, uid=None, gid=None, cwd=None, env=None,
+                    nspawn_args=None, unshare_net=False):
+    """command running in an nspawn container, in the chroot's session if there is one
+
+    Returns (command, unshare_net), the latter tells whether the child still
+    has to get its own network namespace.
+    """
+    session = _NSPAWN_SESSIONS.get(chrootPath)
+    if session is not None:
+        session_command = session.command(command, user=user, uid=uid, gid=gid, cwd=cwd,
+                                          nspawn_args=nspawn_args, unshare_net=unshare_net)
+        if session_command is not None:
+            return session_command, False
+    return _prepare_nspawn_command(chrootPath, user, command, nspawn_args=nspawn_args,
+                                   env=env, cwd=cwd), unshare_net
+
+
+# running sessions, by chroot path
+_NSPAWN_SESSIONS = {}
+
+
+class NspawnSession(object):
+    """One systemd-nspawn container for successive commands in a chroot.
+
+    While the session is open, util.do() runs commands for the chroot (with
+    the same nspawn arguments and network setup) in the running container
+    through nsenter, instead of starting a new container for each of them.
+    Commands for a named user get its groups from setpriv --init-groups and
+    its HOME, USER and LOGNAME, like with systemd-nspawn --user. Anything the
+    session cannot run the same way (e.g. different nspawn arguments, no
+    setpriv in the chroot, or the container died) still gets its own
+    container.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, chrootPath, nspawn_args=None, unshare_net=False, env=None):
+        self.chrootPath = chrootPath
+        self.nspawn_args = list(nspawn_args or [])
+        self.unshare_net = unshare_net
+        self.env = env
+        self.machine = uuid.uuid4().hex
+        self.process = None
+        self.leader = None
+
+    @traceLog()
+    def start(self, timeout=30):
+        """start the container, return False (commands get their own containers) if that fails"""
+        try:
+            self._start(timeout)
+        # pylint: disable=broad-except
+        except Exception as e:
+            getLog().warning("Cannot start nspawn session, using a container per command: %s", e)
+            self.stop()
+            return False
+        _NSPAWN_SESSIONS[self.chrootPath] = self
+        getLog().debug("nspawn session for %s has leader pid %s", self.chrootPath, self.leader)
+        return True
+
+    def _start(self, timeout):
+        command = _prepare_nspawn_command(self.chrootPath, None, ['/bin/sh', '-c', 'exec sleep infinity'],
+                                          nspawn_args=self.nspawn_args, env=self.env, machine=self.machine)
+        preexec = ChildPreExec(None, self.chrootPath, None, None, None,
+                               unshare_ipc=True, unshare_net=self.unshare_net)
+        getLog().debug("Starting nspawn session: %s", command)
+        with open(os.devnull, "r+") as devnull:
+            self.process = subprocess.Popen(command, env=self.env, close_fds=True, preexec_fn=preexec,
+                                            stdin=devnull, stdout=devnull, stderr=devnull)
+        root = os.stat(self.chrootPath)
+        deadline = time.time() + timeout
+        while self.leader is None:
+            if self.process.poll() is not None:
+                raise exception.Error("systemd-nspawn exited with %s" % self.process.returncode)
+            if time.time() > deadline:
+                raise exception.Error("container did not start in %s seconds" % timeout)
+            time.sleep(0.05)
+            leader = self._find_leader()
+            try:
+                if leader and os.path.samestat(os.stat('/proc/%s/root' % leader), root):
+                    self.leader = leader
+            except OSError:
+                pass
+
+    def _find_leader(self):
+        """pid of the container's init, from machinectl once the container is registered"""
+        if not hostfacts.have_machinectl() or '--register=no' in self.nspawn_args:
+            return self._scan_leader()
+        with open(os.devnull, "w") as devnull:
+            try:
+                output = subprocess.check_output([hostfacts.MACHINECTL, 'show', '-p', 'Leader', self.machine],
+                                                 stderr=devnull)
+            except subprocess.CalledProcessError:
+                # not registered yet
+                return None
+        leader = output.decode('utf-8').strip().partition('=')[2]
+        return int(leader) if leader.isdigit() else None
+
+    def _scan_leader(self):
+        """pid of the first process in the container's pid namespace, once the payload runs"""
+        children = collections.defaultdict(list)
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % pid) as f:
+                    children[int(f.read().rsplit(')', 1)[1].split()[1])].append(int(pid))
+            except (IOError, OSError, IndexError):
+                continue
+        try:
+            host_ns = os.readlink('/proc/%s/ns/pid' % self.process.pid)
+        except OSError:
+            return None
+        # breadth first, the first process in another pid namespace is its init
+        pending = collections.deque(children[self.process.pid])
+        leader = None
+        sleeping = False
+        while pending:
+            pid = pending.popleft()
+            try:
+                in_container = os.readlink('/proc/%s/ns/pid' % pid) != host_ns
+                with open('/proc/%s/comm' % pid) as f:
+                    comm = f.read().strip()
+            except (IOError, OSError):
+                continue
+            if in_container:
+                leader = leader or pid
+                sleeping = sleeping or comm == 'sleep'
+            pending.extend(children[pid])
+        return leader if sleeping else None
+
+    def alive(self):
+        return self.leader is not None and self.process.poll() is None
+
+    def _user_argv(self, user):
+        """setpriv and env arguments which run a command as user like
+        systemd-nspawn --user does, None when not possible"""
+        if not os.path.exists(os.path.join(self.chrootPath, 'usr/bin/setpriv')):
+            return None
+        try:
+            with open(os.path.join(self.chrootPath, 'etc/passwd')) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split(':')
+                    if len(fields) >= 7 and str(user) in (fields[0], fields[2]):
+                        break
+                else:
+                    return None
+        except (IOError, OSError):
+            return None
+        name, _, uid, gid, _, home = fields[:6]
+        return ['/usr/bin/setpriv', '--reuid', uid, '--regid', gid, '--init-groups',
+                '/usr/bin/env', 'HOME=' + home, 'USER=' + name, 'LOGNAME=' + name]
+
+    def command(self, command, user=None, uid=None, gid=None, cwd=None, nspawn_args=None, unshare_net=False):
+        """command running in the session as user or uid/gid, None when it has
+        to get its own container"""
+        if not self.alive() or list(nspawn_args or []) != self.nspawn_args \
+                or bool(unshare_net) != bool(self.unshare_net):
+            return None
+        argv = ['/usr/bin/nsenter', '-t', str(self.leader), '-m', '-u', '-i', '-n', '-p', '-r', '-w']
+        if user:
+            user_argv = self._user_argv(user)
+            if user_argv is None:
+                return None
+            argv += user_argv
+        elif uid is not None:
+            argv += ['-S', str(uid), '-G', str(gid if gid is not None else uid)]
+        if not isinstance(command, list):
+            if cwd:
+                return None
+            return ' '.join(argv + [command])
+        if cwd:
+            command = ['/bin/sh', '-c', 'cd "$0" && exec "$@"', cwd] + command
+        return argv + command
+
+    @traceLog()
+    def stop(self):
+        if _NSPAWN_SESSIONS.get(self.chrootPath) is self:
+            del _NSPAWN_SESSIONS[self.chrootPath]
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                # killing the container's init takes the whole container down
+                os.kill(self.leader or self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.process.wait()
+        self.process = None
+        self.leader = None
+
+
 def doshell(chrootPath=None, environ=None, uid=None, gid=None, cmd=None,
             nspawn_args=None,
             unshare_ipc=True,
@@ -751,12 +1170,7 @@ def clean_env():
 
 
 def get_fs_type(path):
-    cmd = ['/usr/bin/stat', '-f', '-L', '-c', '%T', path]
-    p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE,
-                         universal_newlines=True)
-    p.wait()
-    with p.stdout as f:
-        return f.readline().strip()
+    return hostfacts.fs_type(path)
 
 
 def find_non_nfs_dir():
@@ -795,6 +1209,7 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
     config_opts['use_nspawn'] = True
     config_opts['rpmbuild_networking'] = False
     config_opts['nspawn_args'] = []
+    config_opts['nspawn_session'] = False
     config_opts['use_container_host_hostname'] = True
     config_opts['use_bootstrap_container'] = False
 
@@ -819,7 +1234,7 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
     #    root_cache next.
     #    after that, any plugins that must create dirs (yum_cache)
     #    any plugins without preinit hooks should be last.
-    config_opts['plugins'] = PLUGIN_LIST
+    config_opts['plugins'] = list(PLUGIN_LIST)
     config_opts['plugin_dir'] = os.path.join(pkgpythondir, "plugins")
     config_opts['plugin_conf'] = {
         'ccache_enable': False,
@@ -839,9 +1254,19 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
             'age_check': True,
             'max_age_days': 15,
             'dir': "%(cache_topdir)s/%(root)s/root_cache/",
-            'compress_program': 'pigz',
+            'compress_program': 'auto',
+            'compress_level': None,
+            'compress_threads': 0,
+            'zstd_long': False,
+            'cow_restore': True,
+            'content_key': True,
+            'key_repo_revision': False,
+            'max_variants': 3,
+            'backend': 'tar',
+            'store_dir': "%(cache_topdir)s/root_cache_store/",
+            'store_gc': True,
             'exclude_dirs': ["./proc", "./sys", "./dev", "./tmp/ccache", "./var/cache/yum", "./var/cache/dnf"],
-            'extension': '.gz'},
+            'extension': None},
         'bind_mount_enable': True,
         'bind_mount_opts': {
             'dirs': [
@@ -888,6 +1313,11 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
         'hw_info_enable': True,
         'hw_info_opts': {
         },
+        'metrics_enable': False,
+        'metrics_opts': {
+            'dir': '/var/lib/node_exporter/textfile_collector',
+            'file': 'mock-%(root)s.prom',
+        },
     }
 
     config_opts['environment'] = {
@@ -974,6 +1404,10 @@ def setup_default_config_opts(unprivUid, version, pkgpythondir):
     config_opts['rpmbuild_command'] = '/usr/bin/rpmbuild'
 
     config_opts['opstimeout'] = 0
+    config_opts['output_capture_limit'] = None
+    config_opts['log_flush_interval'] = 1
+    config_opts['cgroup_accounting'] = False
+    config_opts['config_cache'] = False
 
     return config_opts
 
@@ -1231,8 +1665,10 @@ def update_config_from_file(config_opts, config_file, uid_manager):
 
 
 def setup_operations_timeout(config_opts):
-    global _OPS_TIMEOUT
+    global _OPS_TIMEOUT, _OUTPUT_LIMIT, _LOG_FLUSH_INTERVAL
     _OPS_TIMEOUT = config_opts.get('opstimeout', 0)
+    _OUTPUT_LIMIT = config_opts.get('output_capture_limit')
+    _LOG_FLUSH_INTERVAL = config_opts.get('log_flush_interval', 1)
 
 @traceLog()
 def do_update_config(log, config_opts, cfg, uidManager, name, skipError=True):
@@ -1250,6 +1686,80 @@ def do_update_config(log, config_opts, cfg, uidManager, name, skipError=True):
         sys.exit(1)
 
 
+CONFIG_CACHE_VERSION = 2
+CONFIG_CACHE_DIR = '.cache/mock/configs'
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def _config_cache_file(defaults, cfg_files):
+    """cache of the configuration read from cfg_files on top of defaults
+
+    The defaults are computed on each start, they depend on the version,
+    the uid, the installed plugins, ...
+    """
+    key = repr([CONFIG_CACHE_VERSION, sys.version_info[:2], sorted(defaults.items()),
+                [os.path.abspath(cfg) for cfg in cfg_files]])
+    home = pwd.getpwuid(os.geteuid()).pw_dir
+    return os.path.join(home, CONFIG_CACHE_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.cfg')
+
+
+@traceLog()
+def load_cached_config(cache_file):
+    """configuration from cache_file, None when any of its files changed
+
+    The cache is a python literal, nothing in it is executed.
+    """
+    try:
+        with open(cache_file) as f:
+            info = os.fstat(f.fileno())
+            if info.st_uid != os.geteuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return None
+            cached = literal_eval(f.read())
+        for path, digest in cached['files'].items():
+            if _file_digest(path) != digest:
+                return None
+        return cached['config_opts']
+    except (IOError, OSError, SyntaxError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+@traceLog()
+def save_cached_config(cache_file, config_opts, cfg_files):
+    if not config_opts.get('config_cache'):
+        return
+    paths = set(cfg_files) | set(config_opts['config_paths'])
+    if any(not os.path.isabs(path) for path in config_opts['config_paths']):
+        # includes relative to the current directory
+        return
+    text = repr({
+        'files': dict((os.path.abspath(path), _file_digest(path)) for path in paths),
+        'config_opts': config_opts,
+    })
+    try:
+        if literal_eval(text)['config_opts'] != config_opts:
+            raise ValueError("configuration changes by repr()")
+    except (SyntaxError, ValueError) as e:
+        getLog().debug("Configuration cannot be cached: %s", e)
+        return
+    try:
+        directory = os.path.dirname(cache_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(tmp, cache_file)
+    except (IOError, OSError) as e:
+        getLog().debug("Cannot cache configuration in %s: %s", cache_file, e)
+
+
 @traceLog()
 def load_config(config_path, name, uidManager, version, pkg_python_dir):
     log = logging.getLogger()
@@ -1273,18 +1783,26 @@ def load_config(config_path, name, uidManager, version, pkg_python_dir):
         chroot_cfg_path = '%s/%s.cfg' % (config_path, name)
     config_opts['config_file'] = chroot_cfg_path
 
-    cfg = os.path.join(config_path, 'site-defaults.cfg')
-    do_update_config(log, config_opts, cfg, uidManager, name)
-
-    do_update_config(log, config_opts, chroot_cfg_path, uidManager, name, skipError=False)
-
-    # Read user specific config file
-    cfg = os.path.join(os.path.expanduser(
-        '~' + pwd.getpwuid(os.getuid())[0]), '.mock/user.cfg')
-    do_update_config(log, config_opts, cfg, uidManager, name)
-    cfg = os.path.join(os.path.expanduser(
-        '~' + pwd.getpwuid(os.getuid())[0]), '.config/mock.cfg')
-    do_update_config(log, config_opts, cfg, uidManager, name)
+    home = os.path.expanduser('~' + pwd.getpwuid(os.getuid())[0])
+    cfg_files = [
+        os.path.join(config_path, 'site-defaults.cfg'),
+        chroot_cfg_path,
+        # user specific config files
+        os.path.join(home, '.mock/user.cfg'),
+        os.path.join(home, '.config/mock.cfg'),
+    ]
+
+    # executing the config files needs a fork each, reuse the result if
+    # none of them changed
+    cache_file = _config_cache_file(config_opts, cfg_files)
+    cached = load_cached_config(cache_file)
+    if cached is not None:
+        config_opts = cached
+        setup_operations_timeout(config_opts)
+    else:
+        for cfg in cfg_files:
+            do_update_config(log, config_opts, cfg, uidManager, name, skipError=cfg != chroot_cfg_path)
+        save_cached_config(cache_file, config_opts, cfg_files)
 
     # default /etc/hosts contents
     if not config_opts['use_host_resolv'] and 'etc/hosts' not in config_opts['files']:
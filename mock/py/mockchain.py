@@ -21,12 +21,12 @@
 # SUMMARY
 # mockchain
 # take a mock config and a series of srpms
-# rebuild them one at a time
+# rebuild them in dependency order, optionally several at once
 # adding each to a local repo
 # so they are available as build deps to next pkg being built
 from __future__ import print_function
 
-import cgi
+import glob
 # pylint: disable=deprecated-module
 import optparse
 import os
@@ -35,12 +35,17 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
-import requests
 # pylint: disable=import-error
 from six.moves.urllib_parse import urlsplit
 
+import mockbuild.chain
+import mockbuild.exception
+import mockbuild.ledger
+import mockbuild.prefetch
+import mockbuild.repo
 import mockbuild.util
 
 # all of the variables below are substituted by the build system
@@ -53,16 +58,13 @@ MOCKCONFDIR = os.path.join(SYSCONFDIR, "mock")
 
 mockconfig_path = '/etc/mock'
 
-
-def createrepo(path):
-    if os.path.exists(path + '/repodata/repomd.xml'):
-        comm = ['/usr/bin/createrepo_c', '--update', path]
-    else:
-        comm = ['/usr/bin/createrepo_c', path]
-    cmd = subprocess.Popen(
-        comm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = cmd.communicate()
-    return out, err
+# per-package files in the results dir with output of mock itself
+STDOUT_LOG = 'mock_stdout.log'
+STDERR_LOG = 'mock_stderr.log'
+# lines of stderr printed when the build fails
+TAIL_LINES = 30
+PROGRESS_INTERVAL = 10
+STATE_RE = re.compile(r'(Start|Finish)(\(bootstrap\))?: (.*)$')
 
 
 def parse_args(args):
@@ -95,6 +97,26 @@ def parse_args(args):
         '-m', '--mock-option', default=[], action='append',
         dest='mock_option',
         help="option to pass directly to mock")
+    parser.add_option(
+        '-j', '--jobs', default=1, type='int',
+        help="run up to this many mock builds at once, default 1")
+    parser.add_option(
+        '--reuse-chroot', default=False, action='store_true', dest='reuse_chroot',
+        help="initialize one chroot per job and reuse it for the following packages"
+             " instead of cleaning and initializing it for every package")
+    parser.add_option(
+        '--progress', default=False, action='store_true',
+        help="periodically print the current phase of all running builds")
+    parser.add_option(
+        '--prefetch', default=4, type='int',
+        help="download up to this many srpms given as URLs at once, default 4")
+    parser.add_option(
+        '--prefetch-ahead', default=8, type='int', dest='prefetch_ahead',
+        help="keep at most this many downloaded srpms waiting for their build, default 8, 0 for no limit")
+    parser.add_option(
+        '--plan', default=None, dest='plan',
+        help="reuse the build plan (dependency graph) from this file if it exists"
+             " and save the computed plan there, defaults to build-plan.json in the local repo dir")
 
     opts, args = parser.parse_args(args)
     if opts.recurse:
@@ -167,34 +189,25 @@ best=1
     return True, ''
 
 
-def do_build(opts, cfg, pkg):
-
-    # returns 0, cmd, out, err = failure
-    # returns 1, cmd, out, err  = success
-    # returns 2, None, None, None = already built
-
-    s_pkg = os.path.basename(pkg)
-    pdn = s_pkg.replace('.src.rpm', '')
-    resdir = '%s/%s' % (opts.local_repo_dir, pdn)
-    resdir = os.path.normpath(resdir)
-    if not os.path.exists(resdir):
-        os.makedirs(resdir)
+def get_resdir(opts, pkg):
+    pdn = os.path.basename(pkg).replace('.src.rpm', '')
+    return os.path.normpath('%s/%s' % (opts.local_repo_dir, pdn))
 
-    success_file = resdir + '/success'
-    fail_file = resdir + '/fail'
 
-    if os.path.exists(success_file):
-        return 2, None, None, None
+def slot_uniqueext(opts, slot):
+    """each concurrently running build needs its own chroot"""
+    if opts.jobs > 1:
+        return '%s-%s' % (opts.uniqueext, slot)
+    return opts.uniqueext
 
-    # clean it up if we're starting over :)
-    if os.path.exists(fail_file):
-        os.unlink(fail_file)
 
+def mock_command(opts, cfg, uniqueext=None, resdir=None):
     mockcmd = ['/usr/bin/mock',
-               '--configdir', opts.config_path,
-               '--resultdir', resdir,
-               '--uniqueext', opts.uniqueext,
-               '-r', cfg, ]
+               '--configdir', opts.config_path]
+    if resdir:
+        mockcmd += ['--resultdir', resdir]
+    mockcmd += ['--uniqueext', uniqueext or opts.uniqueext,
+                '-r', cfg, ]
     # heuristic here, if user pass for mock "-d foo", but we must be care to leave
     # "-d'foo bar'" or "--define='foo bar'" as is
     compiled_re_1 = re.compile(r'^(-\S)\s+(.+)')
@@ -209,20 +222,78 @@ def do_build(opts, cfg, pkg):
                 mockcmd.extend([r_match.group(1), r_match.group(2)])
             else:
                 mockcmd.append(option)
+    return mockcmd
 
-    print('building %s' % s_pkg)
-    mockcmd.append(pkg)
+
+def uses_snapshots():
+    """whether chroot clean is a cheap rollback to the postinit snapshot"""
+    plugin_conf = config_opts.get('plugin_conf', {})
+    return bool(plugin_conf.get('lvm_root_enable') or plugin_conf.get('overlayfs_enable'))
+
+
+def init_worker(opts, cfg, uniqueext):
+    """initialize chroot which will be reused by do_build(..., reuse=True)"""
+    mockcmd = mock_command(opts, cfg, uniqueext) + ['--init']
     cmd = subprocess.Popen(
         mockcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = cmd.communicate()
+    err = cmd.communicate()[1]
+    if cmd.returncode != 0:
+        if (isinstance(err, bytes)):
+            err = err.decode("utf-8")
+        sys.stderr.write(err)
+    return cmd.returncode == 0
+
+
+def clean_worker(opts, cfg, uniqueext):
+    mockcmd = mock_command(opts, cfg, uniqueext) + ['--clean']
+    return subprocess.call(mockcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
+
+
+def do_build(opts, cfg, pkg, uniqueext=None, reuse=False):
+
+    # returns 0, cmd, out, err = failure
+    # returns 1, cmd, out, err  = success
+    # whether the pkg is already built is decided by the ledger, the
+    # success/fail files are only kept for whoever looks at the results dir
+    # with reuse, the chroot initialized by init_worker() is used and kept
+
+    s_pkg = os.path.basename(pkg)
+    resdir = get_resdir(opts, pkg)
+    if not os.path.exists(resdir):
+        os.makedirs(resdir)
+
+    success_file = resdir + '/success'
+    fail_file = resdir + '/fail'
+
+    # clean it up if we're starting over :)
+    for marker in (success_file, fail_file):
+        if os.path.exists(marker):
+            os.unlink(marker)
+
+    mockcmd = mock_command(opts, cfg, uniqueext, resdir)
+    if reuse:
+        mockcmd.append('--no-cleanup-after')
+        if not uses_snapshots():
+            # only the build user, its home and the build dirs are recreated
+            mockcmd.append('--no-clean')
+
+    print('building %s' % s_pkg)
+    mockcmd.append(pkg)
+    # mock output goes straight to files, it can be huge for chatty builds
+    out = os.path.join(resdir, STDOUT_LOG)
+    err_log = os.path.join(resdir, STDERR_LOG)
+    with open(out, 'wb') as out_f, open(err_log, 'wb') as err_f:
+        cmd = subprocess.Popen(mockcmd, stdout=out_f, stderr=err_f)
+        cmd.wait()
+    err = None
     if cmd.returncode == 0:
         with open(success_file, 'w') as f:
             f.write('done\n')
         ret = 1
     else:
-        if (isinstance(err, bytes)):
-            err = err.decode("utf-8")
+        err = tail(err_log)
         sys.stderr.write(err)
+        sys.stderr.write('(see %s for the whole output)\n' % err_log)
         with open(fail_file, 'w') as f:
             f.write('undone\n')
         ret = 0
@@ -230,15 +301,99 @@ def do_build(opts, cfg, pkg):
     return ret, cmd, out, err
 
 
-def log(lf, msg):
-    if lf:
+def tail(filename, lines=TAIL_LINES, blocksize=8192):
+    """last lines of file, reads at most blocksize * 8 bytes"""
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        data = b''
+        while pos > 0 and data.count(b'\n') <= lines and end - pos < blocksize * 8:
+            pos = max(0, pos - blocksize)
+            f.seek(pos)
+            data = f.read(end - pos)
+    text = data.decode('utf-8', 'replace').splitlines(True)
+    return ''.join(text[-lines:])
+
+
+def current_phase(resdir):
+    """innermost unfinished phase from mock's state.log, None if not started yet"""
+    state_log = os.path.join(resdir, 'state.log')
+    if not os.path.exists(state_log):
+        return None
+    stack = []
+    for line in tail(state_log, lines=200).splitlines():
+        match = STATE_RE.search(line)
+        if not match:
+            continue
+        action, bootstrap, phase = match.groups()
+        if bootstrap:
+            phase = 'bootstrap ' + phase
+        if action == 'Start':
+            stack.append(phase)
+        elif stack and stack[-1] == phase:
+            stack.pop()
+    return stack[-1] if stack else None
+
+
+def show_progress(running, lock, stop):
+    """print phase of all running builds every PROGRESS_INTERVAL seconds until stop is set"""
+    while not stop.wait(PROGRESS_INTERVAL):
         now = time.time()
-        try:
-            with open(lf, 'a') as f:
-                f.write(str(now) + ':' + msg + '\n')
-        except (IOError, OSError) as e:
-            print('Could not write to logfile %s - %s' % (lf, str(e)))
-    print(msg)
+        with lock:
+            builds = sorted(running.items())
+        if not builds:
+            continue
+        status = []
+        for name, (resdir, started) in builds:
+            status.append('%s: %s (%ds)' % (name, current_phase(resdir) or 'starting', now - started))
+        print('Running: ' + ', '.join(status))
+
+
+LOG_LOCK = threading.Lock()
+
+
+def log(lf, msg):
+    with LOG_LOCK:
+        if lf:
+            now = time.time()
+            try:
+                with open(lf, 'a') as f:
+                    f.write(str(now) + ':' + msg + '\n')
+            except (IOError, OSError) as e:
+                print('Could not write to logfile %s - %s' % (lf, str(e)))
+        print(msg)
+
+
+def save_plan(opts, graph):
+    try:
+        graph.write_plan(opts.plan)
+    except (IOError, OSError) as e:
+        log(opts.logfile, "Could not write build plan to %s: %s" % (opts.plan, e))
+
+
+def plan_build(opts, srpms, urls=(), durations=None):
+    """create dependency graph of srpms, reusing saved plan when possible
+
+    urls are added as placeholders, the plan is saved once all of them are downloaded;
+    durations of previous builds are used to prioritize the packages on the critical path
+    """
+    graph = mockbuild.chain.BuildGraph()
+    graph.durations = durations or {}
+    plan = {}
+    if os.path.exists(opts.plan):
+        log(opts.logfile, "Reusing build plan: %s" % opts.plan)
+        plan = mockbuild.chain.BuildGraph.read_plan(opts.plan)
+    graph.add_srpms(srpms, plan)
+    for url in urls:
+        fn = os.path.basename(urlsplit(url).path)
+        graph.add_placeholder(url, fn, plan.get(fn))
+    graph.resolve()
+    if not urls:
+        save_plan(opts, graph)
+    order = graph.order()
+    log(opts.logfile, "Build order: %s" % ' '.join(node.name for node in order))
+    return graph
 
 
 config_opts = {}
@@ -278,6 +433,11 @@ def main(args):
         if os.path.exists(opts.logfile):
             os.unlink(opts.logfile)
 
+    if opts.plan:
+        opts.plan = os.path.abspath(opts.plan)
+    else:
+        opts.plan = os.path.join(local_tmp_dir, 'build-plan.json')
+
     log(opts.logfile, "starting logfile: %s" % opts.logfile)
     opts.local_repo_dir = os.path.normpath(local_tmp_dir + '/results/' + config_opts['chroot_name'] + '/')
 
@@ -312,8 +472,12 @@ def main(args):
         pth = mockconfig_path + '/' + fn
         shutil.copyfile(pth, opts.config_path + '/' + fn)
 
-    # createrepo on it
-    err = createrepo(opts.local_repo_dir)[1]
+    # createrepo on it; with parallel builds, wait a moment for more packages
+    # to publish in the same run
+    repo = mockbuild.repo.RepoMetadata(opts.local_repo_dir,
+                                       cachedir=os.path.join(local_tmp_dir, 'createrepo-cache'),
+                                       delay=1 if opts.jobs > 1 else 0)
+    err = repo.generate()[2]
     if err.strip():
         log(opts.logfile, "Error making local repo: %s" % opts.local_repo_dir)
         log(opts.logfile, "Err: %s" % err)
@@ -321,81 +485,150 @@ def main(args):
 
     download_dir = tempfile.mkdtemp()
     downloaded_pkgs = {}
-    built_pkgs = []
-    try_again = True
-    to_be_built = pkgs
+    failed = []
+    srpms = []
+    urls = []
+    for pkg in pkgs:
+        if not pkg.endswith('.rpm'):
+            log(opts.logfile, "%s doesn't appear to be an rpm - skipping" % pkg)
+            failed.append(pkg)
+            continue
+
+        elif pkg.startswith('http://') or pkg.startswith('https://') or pkg.startswith('ftp://'):
+            if pkg not in urls:
+                urls.append(pkg)
+            continue
+        srpms.append(pkg)
+
+    with open(my_mock_config, 'rb') as f:
+        config_hash = mockbuild.ledger.config_sha256(f.read(), opts.mock_option)
+    ledger = mockbuild.ledger.BuildLedger(
+        os.path.join(opts.local_repo_dir, mockbuild.ledger.LEDGER_FILE), config_hash)
+
+    graph = plan_build(opts, srpms, urls, ledger.durations())
+    digests = ledger.digests(srpms)
+    statuses = ledger.statuses()
+
+    # slot -> whether its chroot was initialized for reuse
+    workers = {}
+    # name -> (resdir, start time) of builds in progress
+    running = {}
+    running_lock = threading.Lock()
+    build_started = {}
+
+    def build(node, slot):
+        pkg = node.path
+        if pkg in downloaded_pkgs:
+            prefetcher.release(downloaded_pkgs[pkg])
+        srpm_hash = digests[pkg]
+        if statuses.get(srpm_hash) == mockbuild.ledger.STATUS_SUCCESS:
+            log(opts.logfile, "Skipping already built pkg %s" % os.path.basename(pkg))
+            return 2
+        uniqueext = slot_uniqueext(opts, slot)
+        reuse = False
+        if opts.reuse_chroot:
+            if slot not in workers:
+                log(opts.logfile, "Initializing chroot %s" % uniqueext)
+                workers[slot] = init_worker(opts, config_opts['chroot_name'], uniqueext)
+                if not workers[slot]:
+                    log(opts.logfile, "Error initializing chroot %s, it will not be reused" % uniqueext)
+            reuse = workers[slot]
+        log(opts.logfile, "Start build: %s" % pkg)
+        started = build_started[node.index] = time.time()
+        with running_lock:
+            running[node.name] = (get_resdir(opts, pkg), started)
+        try:
+            ret = do_build(opts, config_opts['chroot_name'], pkg, uniqueext, reuse)[0]
+        finally:
+            with running_lock:
+                del running[node.name]
+        log(opts.logfile, "End build: %s" % pkg)
+        new_rpms = [p for p in glob.glob(os.path.join(get_resdir(opts, pkg), '*.rpm'))
+                    if os.path.getmtime(p) >= started]
+        if ret == 0:
+            ledger.record(srpm_hash, node.name, pkg, mockbuild.ledger.STATUS_FAILED, started)
+            log(opts.logfile, "Error building %s." % os.path.basename(pkg))
+            log(opts.logfile, "See logs/results in %s" % get_resdir(opts, pkg))
+        elif ret == 1:
+            log(opts.logfile, "Success building %s" % os.path.basename(pkg))
+            ledger.record(srpm_hash, node.name, pkg, mockbuild.ledger.STATUS_SUCCESS, started,
+                          mockbuild.ledger.rpm_nevras(new_rpms))
+            # add the new pkgs to the repo, together with whatever finished meanwhile
+            err = repo.publish(new_rpms)[2]
+            if err.strip():
+                log(opts.logfile, "Error making local repo: %s" % opts.local_repo_dir)
+                log(opts.logfile, "Err: %s" % err)
+        return ret
+
+    def classify(node):
+        root_log = os.path.join(get_resdir(opts, node.path), 'root.log')
+        # mock appends to logs in the results dir, ignore what is left from earlier runs
+        if not os.path.exists(root_log) or os.path.getmtime(root_log) < build_started[node.index]:
+            return None
+        return mockbuild.chain.missing_requires(tail(root_log, lines=200))
+
+    def fetched(download):
+        node = graph.by_path(download.url)
+        if download.error:
+            log(opts.logfile, 'Error Downloading %s: %s' % (download.url, str(download.error)))
+            failed.append(download.url)
+            scheduler.discard(node)
+            return
+        if download.duplicate_of:
+            log(opts.logfile, 'Skipping %s, same content as %s' % (download.url, download.duplicate_of))
+            scheduler.discard(node)
+            return
+        downloaded_pkgs[download.path] = download.url
+        digests[download.path] = download.sha256
+        try:
+            scheduler.fill(node, download.path, *mockbuild.chain.header_deps(download.header))
+        except mockbuild.exception.Error as e:
+            log(opts.logfile, 'Error Downloading %s: %s' % (download.url, str(e)))
+            failed.append(download.url)
+            scheduler.discard(node)
+            prefetcher.release(download.url)
+
+    # download in build order, while the first packages already build
+    prefetcher = mockbuild.prefetch.Prefetcher(download_dir, fetched, workers=opts.prefetch,
+                                               lookahead=opts.prefetch_ahead or None)
+    # more may wait when the builds need an SRPM queued behind the waiting ones
+    scheduler = mockbuild.chain.ChainScheduler(graph, build, jobs=opts.jobs, recurse=opts.recurse,
+                                               log=lambda msg: log(opts.logfile, msg), classify=classify,
+                                               idle=prefetcher.widen)
+    for node in graph.order():
+        if not node.available:
+            log(opts.logfile, 'Fetching %s' % node.path)
+            prefetcher.submit(node.path)
+    prefetcher.start()
+
+    stop_progress = threading.Event()
+    if opts.progress:
+        progress = threading.Thread(target=show_progress, args=(running, running_lock, stop_progress))
+        progress.daemon = True
+        progress.start()
+
+    failed_nodes = scheduler.run()
+    stop_progress.set()
+    prefetcher.stop()
+    for slot, initialized in workers.items():
+        if initialized:
+            uniqueext = slot_uniqueext(opts, slot)
+            if not clean_worker(opts, config_opts['chroot_name'], uniqueext):
+                log(opts.logfile, "Error cleaning chroot %s" % uniqueext)
+    ledger.close()
+    if urls:
+        save_plan(opts, graph)
+    failed.extend(node.path for node in failed_nodes)
+    built_pkgs = [node.path for node in scheduler.built]
+
     return_code = 0
-    num_of_tries = 0
-    while try_again:
-        num_of_tries += 1
-        failed = []
-        for pkg in to_be_built:
-            if not pkg.endswith('.rpm'):
-                log(opts.logfile, "%s doesn't appear to be an rpm - skipping" % pkg)
-                failed.append(pkg)
-                continue
-
-            elif pkg.startswith('http://') or pkg.startswith('https://') or pkg.startswith('ftp://'):
-                url = pkg
-                try:
-                    log(opts.logfile, 'Fetching %s' % url)
-                    r = requests.get(url)
-                    # pylint: disable=no-member
-                    if r.status_code == requests.codes.ok:
-                        fn = urlsplit(r.url).path.rsplit('/', 1)[1]
-                        if 'content-disposition' in r.headers:
-                            _, params = cgi.parse_header(r.headers['content-disposition'])
-                            if 'filename' in params and params['filename']:
-                                fn = params['filename']
-                        pkg = download_dir + '/' + fn
-                        with open(pkg, 'wb') as fd:
-                            for chunk in r.iter_content(4096):
-                                fd.write(chunk)
-                except Exception as e:
-                    log(opts.logfile, 'Error Downloading %s: %s' % (url, str(e)))
-                    failed.append(url)
-                    continue
-                else:
-                    downloaded_pkgs[pkg] = url
-            log(opts.logfile, "Start build: %s" % pkg)
-            ret = do_build(opts, config_opts['chroot_name'], pkg)[0]
-            log(opts.logfile, "End build: %s" % pkg)
-            if ret == 0:
-                failed.append(pkg)
-                log(opts.logfile, "Error building %s." % os.path.basename(pkg))
-                if opts.recurse:
-                    log(opts.logfile, "Will try to build again (if some other package will succeed).")
-                else:
-                    log(opts.logfile, "See logs/results in %s" % opts.local_repo_dir)
-            elif ret == 1:
-                log(opts.logfile, "Success building %s" % os.path.basename(pkg))
-                built_pkgs.append(pkg)
-                # createrepo with the new pkgs
-                err = createrepo(opts.local_repo_dir)[1]
-                if err.strip():
-                    log(opts.logfile, "Error making local repo: %s" % opts.local_repo_dir)
-                    log(opts.logfile, "Err: %s" % err)
-            elif ret == 2:
-                log(opts.logfile, "Skipping already built pkg %s" % os.path.basename(pkg))
-
-        if failed and opts.recurse:
-            if len(failed) != len(to_be_built):
-                to_be_built = failed
-                try_again = True
-                log(opts.logfile, 'Some package succeeded, some failed.')
-                log(opts.logfile, 'Trying to rebuild %s failed pkgs, because --recurse is set.' % len(failed))
-            else:
-                log(opts.logfile, "Tried %s times - following pkgs could not be successfully built:" % num_of_tries)
-                for pkg in failed:
-                    msg = pkg
-                    if pkg in downloaded_pkgs:
-                        msg = downloaded_pkgs[pkg]
-                    log(opts.logfile, msg)
-                try_again = False
+    if failed:
+        if opts.recurse:
+            log(opts.logfile, "Following pkgs could not be successfully built:")
+            for pkg in failed:
+                log(opts.logfile, downloaded_pkgs.get(pkg, pkg))
         else:
-            try_again = False
-            if failed:
-                return_code = 2
+            return_code = 2
 
     # cleaning up our download dir
     shutil.rmtree(download_dir, ignore_errors=True)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3 -tt
+#
+# Measure how fast mock logs command output (util.do -> logOutput), in MB/s
+# of build output. Run from the mock checkout:
+#   scripts/bench-log-output.py [--size MB] [--pty]
+#
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py'))
+
+# pylint: disable=wrong-import-position
+from mockbuild import util
+
+LINE = 'g++ -O2 -c src/module_%06d.cpp -o obj/module_%06d.o -Iinclude -DNDEBUG\n'
+
+FORMATS = [
+    ('build.log', '%(message)s'),
+    ('root.log', '%(levelname)s %(filename)s:%(lineno)d:  %(message)s'),
+    ('no handler', None),
+]
+
+
+def make_output(path, size):
+    with open(path, 'w') as f:
+        written = i = 0
+        while written < size:
+            line = LINE % (i, i)
+            if i % 10 == 0:
+                line = '\x1b[01;35mwarning:\x1b[0m unused variable %d\n' % i
+            f.write(line)
+            written += len(line)
+            i += 1
+
+
+def run(output_file, fmt, pty, returnOutput):
+    log = logging.getLogger('mockbuild.bench')
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    fd, logfile = tempfile.mkstemp(prefix='mock-bench-log.')
+    os.close(fd)
+    handler = None
+    if fmt is not None:
+        handler = logging.FileHandler(logfile)
+        handler.setFormatter(logging.Formatter(fmt))
+        # util.do() is traced to the logger it gets, only measure its output
+        handler.addFilter(lambda record: record.levelno == logging.DEBUG)
+        log.addHandler(handler)
+    try:
+        start = time.time()
+        util.do(['cat', output_file], logger=log, pty=pty, returnOutput=returnOutput)
+        return time.time() - start
+    finally:
+        if handler is not None:
+            log.removeHandler(handler)
+            handler.close()
+        os.unlink(logfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=100, help="MB of output (default 100)")
+    parser.add_argument('--pty', action='store_true', help="run the command in a pty")
+    parser.add_argument('--repeat', type=int, default=3, help="best of N runs (default 3)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    fd, output_file = tempfile.mkstemp(prefix='mock-bench-output.')
+    os.close(fd)
+    try:
+        make_output(output_file, args.size * 1024 * 1024)
+        size = os.path.getsize(output_file) / 1024.0 / 1024.0
+        for returnOutput in (0, 1):
+            for name, fmt in FORMATS:
+                best = min(run(output_file, fmt, args.pty, returnOutput) for _ in range(args.repeat))
+                print("%-12s returnOutput=%s: %8.1f MB/s" % (name, returnOutput, size / best))
+    finally:
+        os.unlink(output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3 -tt
+#
+# Compare the compress programs of the root_cache plugin on a real buildroot:
+# time to create and unpack the cache tarball, and its size. Run as root from
+# the mock checkout, on an initialized chroot:
+#   scripts/bench-root-cache-compress.py /var/lib/mock/fedora-rawhide-x86_64/root
+#   scripts/bench-root-cache-compress.py --codec zstd:3 --codec zstd:19 --threads 4 ROOT
+#
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py'))
+
+# pylint: disable=wrong-import-position
+from mockbuild.plugins import root_cache
+
+
+def tar(args, cwd=None):
+    start = time.time()
+    subprocess.check_call(["tar"] + args, cwd=cwd)
+    return time.time() - start
+
+
+def bench(root, workdir, program, level, args, exclude_dirs):
+    command = root_cache.compress_command(program, level, args.threads, args.zstd_long)
+    cache_file = os.path.join(workdir, "cache.tar" + dict(root_cache.CODECS).get(program, ''))
+    create = tar(["--one-file-system", "--exclude-caches", "--exclude-caches-under",
+                  "--use-compress-program", command, "-cf", cache_file, "-C", root] +
+                 ["--exclude=" + item for item in exclude_dirs] + ["."])
+    size = os.path.getsize(cache_file)
+    unpack = []
+    for _ in range(args.repeat):
+        target = os.path.join(workdir, "root")
+        os.mkdir(target)
+        subprocess.check_call(["sync"])
+        unpack.append(tar(["--use-compress-program", command, "-xf", cache_file, "-C", target]))
+        shutil.rmtree(target)
+    os.remove(cache_file)
+    return command, create, min(unpack), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark root_cache compress programs")
+    parser.add_argument('root', help="chroot directory to archive")
+    parser.add_argument('--codec', action='append', default=[],
+                        help="PROGRAM[:LEVEL] to compare, may be repeated (default: all installed)")
+    parser.add_argument('--threads', type=int, default=0, help="compress_threads (default 0, one per CPU)")
+    parser.add_argument('--zstd-long', type=int, default=False, metavar='WINDOWLOG',
+                        help="zstd_long window log (default off)")
+    parser.add_argument('--repeat', type=int, default=3, help="unpacks per codec, best is reported (default 3)")
+    parser.add_argument('--workdir', default=None, help="where to write the tarballs (default $TMPDIR)")
+    args = parser.parse_args()
+
+    codecs = []
+    for codec in args.codec or [p for p, _ in root_cache.CODECS if root_cache._available(p)]:
+        program, _, level = codec.partition(':')
+        codecs.append((program, int(level) if level else None))
+
+    exclude_dirs = ["./proc", "./sys", "./dev", "./tmp/ccache", "./var/cache/yum", "./var/cache/dnf"]
+    workdir = tempfile.mkdtemp(prefix="bench-root-cache-", dir=args.workdir)
+    try:
+        uncompressed = tar(["--one-file-system", "-cf", os.path.join(workdir, "cache.tar"), "-C", args.root] +
+                           ["--exclude=" + item for item in exclude_dirs] + ["."])
+        raw_size = os.path.getsize(os.path.join(workdir, "cache.tar"))
+        os.remove(os.path.join(workdir, "cache.tar"))
+        print("%-32s %9s %9s %11s %7s" % ("program", "create s", "unpack s", "size MiB", "ratio"))
+        print("%-32s %9.2f %9s %11.1f %7.2f" % ("(uncompressed tar)", uncompressed, "", raw_size / 2.0**20, 1.0))
+        for program, level in codecs:
+            command, create, unpack, size = bench(args.root, workdir, program, level, args, exclude_dirs)
+            print("%-32s %9.2f %9.2f %11.1f %7.2f" % (command, create, unpack, size / 2.0**20,
+                                                       float(raw_size) / size))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/python3 -tt
+#
+# Measure the per-call overhead of trace_decorator.traceLog and getLog.
+# Run from the mock checkout:
+#   scripts/bench-trace.py [--calls N]
+#
+
+import argparse
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py'))
+
+# pylint: disable=wrong-import-position
+from mockbuild import trace_decorator
+
+
+def make_chroot_path(*args):
+    return os.path.join('/var/lib/mock/fedora-rawhide-x86_64/root', *args)
+
+
+def decorated(tracing, logger_name):
+    trace_decorator.set_tracing(tracing)
+    return trace_decorator.traceLog(logger_name)(make_chroot_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=100000, help="calls per case (default 100000)")
+    args = parser.parse_args()
+
+    # like mock's logging.ini: levels are NOTSET, so the handlers filter,
+    # and without --trace the trace loggers do not propagate to any handler
+    logging.getLogger().setLevel(logging.NOTSET)
+    logging.getLogger('trace').propagate = False
+    logging.getLogger('bench.filtered').setLevel(logging.WARNING)
+
+    cases = [
+        ('plain function', make_chroot_path),
+        ('traceLog, tracing disabled', decorated(False, None)),
+        ('traceLog, logger filtered', decorated(True, 'bench.filtered')),
+        ('traceLog, tracing', decorated(True, None)),
+    ]
+    for name, func in cases:
+        elapsed = min(timeit.repeat(lambda: func('builddir', 'build'), number=args.calls, repeat=3))
+        print("%-30s %8.2f us/call" % (name, elapsed / args.calls * 1e6))
+    elapsed = min(timeit.repeat(trace_decorator.getLog, number=args.calls, repeat=3))
+    print("%-30s %8.2f us/call" % ('getLog()', elapsed / args.calls * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+#!/bin/sh
+
+. ${TESTDIR}/functions
+
+header "test mockchain with srpms downloaded over http"
+port=8765
+(cd ${TESTDIR} && exec python3 -m http.server --bind 127.0.0.1 $port >/dev/null 2>&1) &
+server=$!
+sleep 2
+url=http://127.0.0.1:$port
+runcmd "$MOCKCHAIN -c --prefetch 2 $url/test-C-1.1-0.src.rpm $url/test-B-1.1-0.src.rpm $url/test-A-1.1-0.src.rpm"
+res=$?
+kill $server
+
+if [ $res -ne 0 ]; then
+   echo "mockchain returned fail when should have succeeded!"
+   exit 1
+fi
+exit 0
@@ -0,0 +1,17 @@
+#!/bin/sh
+# This file is simple shell wrapper for aio_test.py test.
+# For more details about test itself look into test's file.
+
+set -e
+
+if [ -z "${TESTDIR:-}" ] ; then
+    TESTDIR="$( cd "$( dirname "$0" )" && pwd )"
+fi
+
+. ${TESTDIR}/functions
+
+header "Concurrent commands test"
+
+export PYTHONPATH="$( dirname "${TESTDIR}" )/py${PYTHONPATH:+:${PYTHONPATH}}"
+cd "${TESTDIR}"
+runcmd "python3 aio_test.py"
@@ -0,0 +1,26 @@
+#!/bin/sh
+# This file is simple shell wrapper for objectstore_test.py test.
+# For more details about test itself look into test's file.
+
+set -e
+
+onExit() {
+    if [ -n "${tmpDir}" ] ; then
+        rm -rf "${tmpDir}"
+    fi
+}
+
+if [ -z "${TESTDIR:-}" ] ; then
+    TESTDIR="$( cd "$( dirname "$0" )" && pwd )"
+fi
+
+. ${TESTDIR}/functions
+
+header "Object store test"
+
+tmpDir="$( mktemp -d )"
+trap onExit EXIT
+
+export PYTHONPATH="$( dirname "${TESTDIR}" )/py${PYTHONPATH:+:${PYTHONPATH}}"
+cd "${TESTDIR}"
+runcmd "python3 objectstore_test.py ${tmpDir}"
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from mockbuild import aio
+from mockbuild import util
+
+# About test:
+# Runs short commands concurrently with mockbuild.aio and checks they finish
+# at once, without any of them being taken for a dead child whose orphans
+# keep its output open (which would kill everything in its chroot). Then
+# checks that real orphans are still detected. As root, the commands run in
+# chroot "/" with orphansKill() replaced by a recorder, otherwise no chroot
+# is used and the "Child pid ... is dead" log message is checked only.
+
+# How to run:
+# PYTHONPATH=../py python3 aio_test.py
+
+#######################
+#    Dummy classes    #
+#######################
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+####################
+#    TEST class    #
+####################
+
+class AioTest(object):
+
+    def __init__(self):
+        self.killed = []
+        util.orphansKill = lambda rootToKill, *_, **__: self.killed.append(rootToKill)
+        self.chrootPath = "/" if os.getuid() == 0 else None
+        self.log = RecordingHandler()
+        logging.getLogger().addHandler(self.log)
+        logging.getLogger().setLevel(logging.INFO)
+
+    def deadChildren(self):
+        return [m for m in self.log.messages if "is dead" in m]
+
+    @staticmethod
+    def assertTrue(value, errMsg):
+        if not value:
+            raise Exception("Assertion error: " + errMsg)
+
+    def run(self, commands):
+        start = time.time()
+        result = aio.run(*[aio.do(command, returnOutput=True, chrootPath=self.chrootPath)
+                           for command in commands])
+        return result, time.time() - start
+
+    def testConcurrentShortCommands(self):
+        sibling = subprocess.Popen(["sleep", "30"])
+        try:
+            commands = [["echo", "hi%d" % i] for i in range(8)] + [["true"], ["sh", "-c", "echo err >&2"]]
+            result, elapsed = self.run(commands)
+            self.assertTrue(result[:8] == ["hi%d\n" % i for i in range(8)], "unexpected output %s" % result)
+            self.assertTrue(result[9] == "err\n", "unexpected stderr output %r" % result[9])
+            self.assertTrue(elapsed < 0.5, "short commands took %.2f seconds" % elapsed)
+            self.assertTrue(not self.deadChildren(), "unexpected %s" % self.deadChildren())
+            self.assertTrue(not self.killed, "orphans killed in %s" % self.killed)
+            self.assertTrue(sibling.poll() is None, "sibling process was killed")
+        finally:
+            os.kill(sibling.pid, signal.SIGTERM)
+            sibling.wait()
+
+    def testOrphans(self):
+        # the background sleep keeps the output open after sh exited
+        result, elapsed = self.run([["sh", "-c", "sleep 3 & echo out"]])
+        self.assertTrue(result == ["out\n"], "unexpected output %s" % result)
+        self.assertTrue(elapsed < 2, "orphans were not detected in %.2f seconds" % elapsed)
+        self.assertTrue(len(self.deadChildren()) == 1, "orphans not reported")
+        if self.chrootPath:
+            self.assertTrue(self.killed == [self.chrootPath], "orphans not killed")
+
+    def runTest(self):
+        self.testConcurrentShortCommands()
+        self.testOrphans()
+
+
+def main():
+    if sys.version_info < (3, 6):
+        print("mockbuild.aio needs python 3.6, skipping")
+        return
+    test = AioTest()
+    test.runTest()
+
+
+if __name__ == "__main__":
+    main()
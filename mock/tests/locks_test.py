@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mockbuild import locks
+from mockbuild.exception import LockTimeout
+
+# About test:
+# Takes mockbuild.locks locks in this process and in helper processes and
+# checks that shared and exclusive holders conflict as they should, that a
+# held lock can be converted to the other mode, that acquire() and held()
+# give up after the timeout and that holder() describes the exclusive
+# holder. Nothing is mounted, it can be run as unprivileged user.
+
+# How to run:
+# PYTHONPATH=../py python locks_test.py [directory for the lock files]
+
+HOLDER = """
+import sys
+from mockbuild import locks
+lock = locks.Lock(sys.argv[1])
+lock.acquire(exclusive=sys.argv[2] == 'exclusive')
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sys.stdin.readline()
+"""
+
+#######################
+#    Dummy classes    #
+#######################
+
+class DummyState(object):
+
+    def __init__(self):
+        self.started = []
+        self.finished = []
+
+    def start(self, name):
+        self.started.append(name)
+
+    def finish(self, name):
+        self.finished.append(name)
+
+####################
+#    TEST class    #
+####################
+
+class Holder(object):
+    """other process holding the lock until release()"""
+
+    def __init__(self, path, exclusive):
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', HOLDER, path, 'exclusive' if exclusive else 'shared'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        if self.process.stdout.readline() != 'locked\n':
+            raise Exception("Helper process did not take the lock")
+
+    def release(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class LocksTest(object):
+
+    def __init__(self, lockDir):
+        self.lockDir = lockDir
+
+    def lock(self, name, state=None):
+        return locks.Lock(os.path.join(self.lockDir, name), name, state)
+
+    @staticmethod
+    def assertTrue(value, errMsg):
+        if not value:
+            raise Exception("Assertion error: " + errMsg)
+
+    def testSharedExclusive(self):
+        other = Holder(os.path.join(self.lockDir, "shared"), exclusive=False)
+        try:
+            lock = self.lock("shared")
+            self.assertTrue(lock.acquire(exclusive=False, timeout=0), "shared lock not shared")
+            lock.release()
+            self.assertTrue(not lock.acquire(exclusive=True, timeout=0),
+                            "exclusive lock taken while shared lock is held")
+            self.assertTrue(lock.exclusive is None, "lock recorded as held")
+        finally:
+            other.release()
+        self.assertTrue(lock.acquire(exclusive=True, timeout=0), "released lock not free")
+        lock.close()
+
+        other = Holder(os.path.join(self.lockDir, "exclusive"), exclusive=True)
+        try:
+            lock = self.lock("exclusive")
+            self.assertTrue(not lock.acquire(exclusive=False, timeout=0),
+                            "shared lock taken while exclusive lock is held")
+            self.assertTrue(not lock.acquire(exclusive=True, timeout=0),
+                            "exclusive lock taken twice")
+        finally:
+            other.release()
+        # the lock goes away with the process holding it
+        self.assertTrue(lock.acquire(exclusive=True, timeout=0), "lock of dead process not free")
+        lock.close()
+
+    def testConversion(self):
+        lock = self.lock("convert")
+        self.assertTrue(lock.acquire(exclusive=True), "free lock not taken")
+        # exclusive -> shared lets others share it
+        self.assertTrue(lock.acquire(exclusive=False), "lock not converted to shared")
+        self.assertTrue(lock.exclusive is False, "lock not recorded as shared")
+        other = Holder(lock.path, exclusive=False)
+        try:
+            # shared -> exclusive fails while someone else shares it
+            self.assertTrue(not lock.acquire(exclusive=True, timeout=0),
+                            "lock converted to exclusive while shared by another process")
+        finally:
+            other.release()
+        self.assertTrue(lock.acquire(exclusive=True, timeout=0), "lock not converted to exclusive")
+        self.assertTrue(lock.exclusive is True, "lock not recorded as exclusive")
+        lock.close()
+
+    def testTimeout(self):
+        state = DummyState()
+        other = Holder(os.path.join(self.lockDir, "timeout"), exclusive=True)
+        try:
+            lock = self.lock("timeout", state)
+            start = time.time()
+            self.assertTrue(not lock.acquire(exclusive=True, timeout=0.3), "held lock taken")
+            elapsed = time.time() - start
+            self.assertTrue(0.3 <= elapsed < 2, "waited %.2f seconds instead of 0.3" % elapsed)
+            self.assertTrue(lock.waits == 1 and lock.wait_time >= 0.3, "wait not measured")
+            self.assertTrue(state.started == ["Waiting for timeout lock"] and state.finished == state.started,
+                            "wait not recorded in state: %s" % state.started)
+            try:
+                with lock.held(exclusive=False, timeout=0.1):
+                    raise Exception("Assertion error: held() entered while lock is held")
+            except LockTimeout as e:
+                self.assertTrue("pid %s" % other.process.pid in str(e), "holder not in message: %s" % e)
+        finally:
+            other.release()
+        with lock.held(exclusive=True, timeout=1):
+            self.assertTrue(lock.exclusive is True, "lock not held in with block")
+        self.assertTrue(lock.exclusive is None, "lock not released after with block")
+        lock.close()
+
+    def testHolder(self):
+        lock = self.lock("holder")
+        self.assertTrue(lock.holder() is None, "holder of free lock")
+        other = Holder(lock.path, exclusive=True)
+        try:
+            holder = lock.holder()
+            self.assertTrue(holder is not None and holder.startswith("pid %s (" % other.process.pid),
+                            "unexpected holder %s" % holder)
+        finally:
+            other.release()
+        # the holder information of dead processes is ignored
+        self.assertTrue(lock.holder() is None, "holder of lock of dead process")
+        # nor does this process describe itself
+        lock.acquire(exclusive=True)
+        self.assertTrue(lock.holder() is None, "holder of own lock")
+        lock.close()
+
+    def runTest(self):
+        self.testSharedExclusive()
+        self.testConversion()
+        self.testTimeout()
+        self.testHolder()
+
+
+def main():
+    args = sys.argv
+    if len(args) == 2:
+        lockDir = args[1]
+    else:
+        lockDir = tempfile.mkdtemp()
+    try:
+        test = LocksTest(lockDir)
+        test.runTest()
+    finally:
+        if len(args) != 2:
+            shutil.rmtree(lockDir)
+
+
+if __name__ == "__main__":
+    main()
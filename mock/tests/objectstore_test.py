@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+import errno
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+from mockbuild.objectstore import ObjectStore
+
+# About test:
+# Saves a tree with files of various modes, a symlink, hardlinked files and
+# a file with an extended attribute to a mockbuild.objectstore store,
+# materializes it elsewhere and checks that both trees are the same, that
+# writing to a materialized file does not change the store, and that gc()
+# removes only the objects no registered manifest refers to. Nothing is
+# mounted, it can be run as unprivileged user (the xattr check is skipped
+# where user xattrs are not supported).
+
+# How to run:
+# PYTHONPATH=../py python objectstore_test.py [directory for the trees]
+
+MTIME = 1500000000
+
+####################
+#    TEST class    #
+####################
+
+class ObjectStoreTest(object):
+
+    def __init__(self, testDir):
+        self.testDir = testDir
+        self.store = ObjectStore(os.path.join(testDir, 'store'))
+        self.xattrs = False
+
+    def path(self, *paths):
+        return os.path.join(self.testDir, *paths)
+
+    @staticmethod
+    def assertTrue(value, errMsg):
+        if not value:
+            raise AssertionError(errMsg)
+
+    @staticmethod
+    def writeFile(path, content, mode):
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, mode)
+        os.utime(path, (MTIME, MTIME))
+
+    def makeTree(self, root, extra=None):
+        os.makedirs(os.path.join(root, 'etc'))
+        os.mkdir(os.path.join(root, 'bin'), 0o700)
+        self.writeFile(os.path.join(root, 'etc', 'config'), 'config\n', 0o640)
+        self.writeFile(os.path.join(root, 'etc', 'same'), 'config\n', 0o640)
+        self.writeFile(os.path.join(root, 'bin', 'tool'), '#!/bin/sh\n', 0o755)
+        os.link(os.path.join(root, 'bin', 'tool'), os.path.join(root, 'bin', 'tool-alias'))
+        os.symlink('../etc/config', os.path.join(root, 'bin', 'config-link'))
+        if extra:
+            self.writeFile(os.path.join(root, 'etc', 'extra'), extra, 0o600)
+        if hasattr(os, 'setxattr'):
+            try:
+                os.setxattr(os.path.join(root, 'bin', 'tool'), 'user.mock', b'value')
+                self.xattrs = True
+            except OSError as e:
+                if e.errno not in (errno.ENOTSUP, errno.EPERM):
+                    raise
+        for directory in ('etc', 'bin', '.'):
+            os.utime(os.path.join(root, directory), (MTIME, MTIME))
+
+    def assertSameTrees(self, src, dst):
+        for directory, dirs, files in os.walk(src):
+            rel = os.path.relpath(directory, src)
+            for name in ['.'] + dirs + files:
+                a = os.path.normpath(os.path.join(src, rel, name))
+                b = os.path.normpath(os.path.join(dst, rel, name))
+                sta, stb = os.lstat(a), os.lstat(b)
+                for attr in ('st_mode', 'st_uid', 'st_gid'):
+                    self.assertTrue(getattr(sta, attr) == getattr(stb, attr),
+                                    "%s of %s differs: %s" % (attr, b, getattr(stb, attr)))
+                if stat.S_ISLNK(sta.st_mode):
+                    self.assertTrue(os.readlink(a) == os.readlink(b), "target of %s differs" % b)
+                    continue
+                self.assertTrue(int(sta.st_mtime) == int(stb.st_mtime), "mtime of %s differs" % b)
+                if stat.S_ISREG(sta.st_mode):
+                    with open(a) as fa, open(b) as fb:
+                        self.assertTrue(fa.read() == fb.read(), "content of %s differs" % b)
+        self.assertTrue(len(set(os.listdir(src)) ^ set(os.listdir(dst))) == 0, "%s has other files" % dst)
+        tool, alias = os.stat(os.path.join(dst, 'bin', 'tool')), os.stat(os.path.join(dst, 'bin', 'tool-alias'))
+        self.assertTrue(tool.st_ino == alias.st_ino, "hardlinks were not kept")
+        if self.xattrs:
+            value = os.getxattr(os.path.join(dst, 'bin', 'tool'), 'user.mock')
+            self.assertTrue(value == b'value', "xattr was not restored: %r" % value)
+
+    def objects(self):
+        return sorted(os.path.join(directory, name)
+                      for directory, _, files in os.walk(self.store.objects) for name in files)
+
+    def testRoundTrip(self):
+        src, dst = self.path('src'), self.path('dst')
+        self.makeTree(src)
+        entries = self.store.save(src, self.path('src.manifest'))
+        # the hardlinked tool is one entry of each kind, both configs are
+        # the same object
+        kinds = sorted(e['type'] for e in entries)
+        self.assertTrue(kinds == ['d', 'd', 'd', 'f', 'f', 'f', 'h', 'l'], "unexpected entries %s" % kinds)
+        self.assertTrue(len(self.objects()) == 2, "objects not deduplicated: %s" % self.objects())
+        os.mkdir(dst)
+        self.store.materialize(self.path('src.manifest'), dst)
+        self.assertSameTrees(src, dst)
+
+    def testIsolation(self):
+        # materialized files never share the inode of an object, writing to
+        # them in place leaves the store alone
+        dst = self.path('dst')
+        objects = set(os.stat(path).st_ino for path in self.objects())
+        for directory, _, files in os.walk(dst):
+            for name in files:
+                st = os.lstat(os.path.join(directory, name))
+                self.assertTrue(st.st_ino not in objects, "%s is linked to the store" % name)
+        with open(os.path.join(dst, 'etc', 'config'), 'r+') as f:
+            f.write('changed')
+        os.mkdir(self.path('again'))
+        self.store.materialize(self.path('src.manifest'), self.path('again'))
+        self.assertSameTrees(self.path('src'), self.path('again'))
+
+    def testGc(self):
+        self.makeTree(self.path('other'), extra='only in other\n')
+        self.store.save(self.path('other'), self.path('other.manifest'))
+        before = self.objects()
+        self.assertTrue(len(before) == 3, "unexpected objects %s" % before)
+        self.assertTrue(self.store.gc() == (0, 0), "gc removed referenced objects")
+        os.unlink(self.path('other.manifest'))
+        removed, size = self.store.gc()
+        self.assertTrue(removed == 1 and size == len('only in other\n'),
+                        "gc removed %d objects, %d bytes" % (removed, size))
+        self.assertTrue(len(os.listdir(self.store.manifests)) == 1, "manifest of removed tree kept")
+        # the remaining manifest still materializes
+        os.mkdir(self.path('last'))
+        self.store.materialize(self.path('src.manifest'), self.path('last'))
+        self.assertSameTrees(self.path('src'), self.path('last'))
+        # nothing is removed while another user has the store open
+        with ObjectStore(self.store.path).lock.held(exclusive=False):
+            os.unlink(self.path('src.manifest'))
+            self.assertTrue(self.store.gc() is None, "gc ran while the store was in use")
+        self.assertTrue(self.store.gc() == (2, len('config\n') + len('#!/bin/sh\n')),
+                        "gc did not remove the objects of the last manifest")
+
+    def runTest(self):
+        self.testRoundTrip()
+        self.testIsolation()
+        self.testGc()
+
+
+def main():
+    args = sys.argv
+    if len(args) == 2:
+        testDir = args[1]
+    else:
+        testDir = tempfile.mkdtemp()
+    try:
+        test = ObjectStoreTest(testDir)
+        test.runTest()
+    finally:
+        if len(args) != 2:
+            shutil.rmtree(testDir)
+
+
+if __name__ == "__main__":
+    main()